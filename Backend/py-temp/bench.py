@@ -0,0 +1,922 @@
+#!/usr/bin/env python3
+"""
+main.py 相关组件的性能测试脚本
+"""
+
+import os
+import re
+import time
+import asyncio
+import random
+import logging
+import resource
+import argparse
+import tempfile
+import itertools
+from pathlib import Path
+from threading import Thread
+
+from watchdog.observers import Observer
+from watchdog.events import FileCreatedEvent, FileMovedEvent, FileDeletedEvent, FileModifiedEvent, FileClosedEvent
+
+import main as watcher
+from main import (
+    BatchQueue, FileRenamer, FileBuffer, FileMonitorHandler, BatchFileProcessor, AsyncPipeline, BatchController,
+    StabilityTracker
+)
+
+
+def percentile(values, pct):
+    """计算百分位数(values 需已排序)"""
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(len(values) * pct / 100))
+    return values[index]
+
+
+def bench_queue(num_items, workers, batch_size, max_wait):
+    """
+    BatchQueue 微基准：测量入队到出队的延迟以及每个元素消耗的 CPU 时间
+
+    Args:
+        num_items: 元素总数
+        workers: 消费者线程数
+        batch_size: 批处理大小
+        max_wait: 批次最长等待时间(秒)
+
+    Returns:
+        dict: 测试结果
+    """
+    queue = BatchQueue(batch_size=batch_size, max_wait=max_wait)
+    latencies = [[] for _ in range(workers)]
+
+    def consume(index):
+        while True:
+            batch = queue.get_batch()
+            if not batch:
+                return
+            now = time.perf_counter()
+            latencies[index].extend(now - enqueued for enqueued in batch)
+
+    threads = [Thread(target=consume, args=(i,), daemon=True) for i in range(workers)]
+    for thread in threads:
+        thread.start()
+
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    for _ in range(num_items):
+        queue.put(time.perf_counter())
+    queue.close()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+
+    merged = sorted(value for values in latencies for value in values)
+    return {
+        'workers': workers,
+        'items': len(merged),
+        'wall': wall,
+        'cpu_per_item_us': cpu / max(1, len(merged)) * 1e6,
+        'p50_ms': percentile(merged, 50) * 1000,
+        'p99_ms': percentile(merged, 99) * 1000,
+    }
+
+
+def run_queue(args):
+    """运行 BatchQueue 微基准"""
+    print(f"{'线程数':>6} {'元素数':>8} {'耗时(s)':>9} {'CPU/元素(us)':>13} {'p50(ms)':>9} {'p99(ms)':>9}")
+    for workers in args.workers:
+        result = bench_queue(args.items, workers, args.batch_size, args.max_wait)
+        print(
+            f"{result['workers']:>6} {result['items']:>8} {result['wall']:>9.3f} "
+            f"{result['cpu_per_item_us']:>13.2f} {result['p50_ms']:>9.3f} {result['p99_ms']:>9.3f}"
+        )
+
+
+class SyscallCounter:
+    """统计基准测试期间的重命名、链接和 fsync 次数"""
+
+    NAMES = ('rename', 'replace', 'link', 'unlink', 'fsync')
+
+    def __init__(self):
+        self.counts = dict.fromkeys(self.NAMES + ('move_noreplace',), 0)
+        self._originals = {}
+
+    def _wrap(self, module, name):
+        original = getattr(module, name)
+        self._originals[(module, name)] = original
+
+        def counted(*args, **kwargs):
+            self.counts[name] += 1
+            return original(*args, **kwargs)
+
+        setattr(module, name, counted)
+
+    def __enter__(self):
+        for name in self.NAMES:
+            self._wrap(os, name)
+        self._wrap(watcher, 'move_noreplace')
+        return self
+
+    def __exit__(self, *exc_info):
+        for (module, name), original in self._originals.items():
+            setattr(module, name, original)
+
+
+def make_scratch_files(base_dir, num_files, prefix):
+    """在 base_dir 下新建目录并创建 num_files 个空文件"""
+    work_dir = Path(tempfile.mkdtemp(prefix=prefix, dir=base_dir))
+    files = []
+    for i in range(num_files):
+        path = work_dir / f"file_{i}.jpg"
+        path.touch()
+        files.append(path)
+    return work_dir, files
+
+
+def bench_rename(base_dir, num_files, direct_rename, batch_size):
+    """
+    FileRenamer 重命名基准：在 base_dir 下新建目录并批量重命名
+
+    Args:
+        base_dir: 测试所在目录(可分别指向 tmpfs 和 ext4)
+        num_files: 文件数量
+        direct_rename: 是否使用直接重命名模式
+        batch_size: 每批文件数
+
+    Returns:
+        dict: 测试结果
+    """
+    work_dir, files = make_scratch_files(base_dir, num_files, "bench_rename_")
+
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        with SyscallCounter() as counter:
+            renamer = FileRenamer(r"\.jpg$", digit_count=6, direct_rename=direct_rename)
+            start = time.perf_counter()
+            for i in range(0, num_files, batch_size):
+                renamer.process_batch(files[i:i + batch_size])
+            elapsed = time.perf_counter() - start
+            renamer.close()
+    finally:
+        os.chdir(cwd)
+
+    renamed = sum(1 for entry in os.scandir(work_dir) if entry.name[:1].isdigit())
+    return {
+        'mode': 'direct' if direct_rename else 'temp_dir',
+        'renamed': renamed,
+        'files_per_sec': num_files / elapsed if elapsed else 0.0,
+        'counts': counter.counts,
+    }
+
+
+def run_rename(args):
+    """运行重命名模式对比"""
+    logging.getLogger().setLevel(logging.WARNING)
+    print(f"测试目录: {args.dir}")
+    print(f"{'模式':>8} {'成功数':>8} {'文件/秒':>10} {'rename':>7} {'renameat2':>9} {'link':>6} {'unlink':>6} {'fsync':>6}")
+    for direct_rename in (False, True):
+        result = bench_rename(args.dir, args.files, direct_rename, args.batch_size)
+        counts = result['counts']
+        print(
+            f"{result['mode']:>8} {result['renamed']:>8} {result['files_per_sec']:>10.0f} "
+            f"{counts['rename'] + counts['replace']:>7} {counts['move_noreplace']:>9} "
+            f"{counts['link']:>6} {counts['unlink']:>6} {counts['fsync']:>6}"
+        )
+
+
+def wait_processed(get_stats, total, timeout=60.0):
+    """等待处理数量达到 total"""
+    deadline = time.monotonic() + timeout
+    while get_stats()['processed'] < total and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def run_thread_pipeline(renamer, files, workers, batch_size, batch_timeout):
+    """线程引擎：事件从独立线程送入 FileMonitorHandler，与 watchdog 线程一致"""
+    file_buffer = FileBuffer(max_size=len(files), batch_size=batch_size, batch_timeout=batch_timeout)
+    handler = FileMonitorHandler(file_buffer, renamer)
+    processor = BatchFileProcessor(file_buffer, renamer, num_workers=workers)
+    processor.start()
+
+    feeder = Thread(target=lambda: [handler._handle_file_event(str(path), 'created') for path in files])
+    feeder.start()
+    feeder.join()
+    wait_processed(processor.get_stats, len(files))
+
+    processor.should_stop = True
+    file_buffer.close()
+    processor.join()
+    return processor.get_stats()
+
+
+def run_asyncio_pipeline(renamer, files, workers, batch_size, batch_timeout):
+    """asyncio 引擎：事件从独立线程提交到事件循环，与 watchdog 线程一致"""
+    pipeline = AsyncPipeline(
+        renamer, buffer_size=len(files), batch_size=batch_size,
+        batch_timeout=batch_timeout, num_workers=workers
+    )
+
+    async def run():
+        await pipeline.start()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            None, lambda: [pipeline.event_handler._handle_file_event(str(path), 'created') for path in files]
+        )
+        await loop.run_in_executor(None, wait_processed, pipeline.get_stats, len(files))
+        await pipeline.stop()
+
+    asyncio.run(run())
+    return pipeline.get_stats()
+
+
+def bench_engine(base_dir, engine, num_files, workers, batch_size, batch_timeout):
+    """
+    引擎对比基准：测量处理同一批文件的耗时、CPU 时间和上下文切换次数
+
+    Args:
+        base_dir: 测试所在目录
+        engine: thread 或 asyncio
+        num_files: 文件数量
+        workers: 处理线程/协程数量
+        batch_size: 批处理大小
+        batch_timeout: 批处理超时时间(秒)
+
+    Returns:
+        dict: 测试结果
+    """
+    work_dir, files = make_scratch_files(base_dir, num_files, f"bench_{engine}_")
+    run = run_thread_pipeline if engine == "thread" else run_asyncio_pipeline
+
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        renamer = FileRenamer(r"\.jpg$", digit_count=6, journal_file="")
+        usage_start = resource.getrusage(resource.RUSAGE_SELF)
+        start = time.perf_counter()
+        stats = run(renamer, files, workers, batch_size, batch_timeout)
+        elapsed = time.perf_counter() - start
+        usage_end = resource.getrusage(resource.RUSAGE_SELF)
+        renamer.cleanup_temp_dirs()
+    finally:
+        os.chdir(cwd)
+
+    return {
+        'engine': engine,
+        'succeeded': stats['succeeded'],
+        'files_per_sec': num_files / elapsed if elapsed else 0.0,
+        'cpu': (usage_end.ru_utime - usage_start.ru_utime) + (usage_end.ru_stime - usage_start.ru_stime),
+        'voluntary_switches': usage_end.ru_nvcsw - usage_start.ru_nvcsw,
+        'involuntary_switches': usage_end.ru_nivcsw - usage_start.ru_nivcsw,
+    }
+
+
+def run_engines(args):
+    """运行线程引擎与 asyncio 引擎对比"""
+    logging.getLogger().setLevel(logging.WARNING)
+    print(f"{'引擎':>8} {'成功数':>8} {'文件/秒':>10} {'CPU(s)':>8} {'自愿切换':>10} {'非自愿切换':>10}")
+    for engine in ("thread", "asyncio"):
+        result = bench_engine(args.dir, engine, args.files, args.workers, args.batch_size, args.batch_timeout)
+        print(
+            f"{result['engine']:>8} {result['succeeded']:>8} {result['files_per_sec']:>10.0f} "
+            f"{result['cpu']:>8.3f} {result['voluntary_switches']:>10} {result['involuntary_switches']:>10}"
+        )
+
+
+class TimedBatchFileProcessor(BatchFileProcessor):
+    """记录每个文件处理完成时间的批处理器，key 决定按文件名还是完整路径记录"""
+
+    def __init__(self, *args, key=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.key = key or (lambda file_path: file_path.name)
+        self.done_times = {}
+
+    def _on_file_done(self, file_path, success):
+        if success:
+            self.done_times[self.key(file_path)] = time.perf_counter()
+        super()._on_file_done(file_path, success)
+
+
+def generate_load(work_dir, num_files, rate, burst_size, created):
+    """
+    负载生成器：按速率在 work_dir 中创建文件
+
+    Args:
+        work_dir: 目标目录
+        num_files: 文件总数
+        rate: 平均每秒创建多少个文件，0 表示尽快创建
+        burst_size: 每次连续创建多少个文件，1 表示均匀创建
+        created: 记录 {文件名: 创建时间}
+    """
+    interval = burst_size / rate if rate > 0 else 0
+    next_time = time.perf_counter()
+    for start in range(0, num_files, burst_size):
+        for i in range(start, min(num_files, start + burst_size)):
+            name = f"load_{i}.jpg"
+            with open(work_dir / name, 'wb'):
+                pass
+            created[name] = time.perf_counter()
+        if interval:
+            next_time += interval
+            delay = next_time - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+
+def bench_pipeline(base_dir, num_files, rate, burst_size, workers, batch_size, batch_timeout, buffer_size):
+    """
+    端到端基准：watchdog + FileBuffer + FileRenamer + BatchFileProcessor 处理负载生成器创建的文件
+
+    Returns:
+        dict: 测试结果
+    """
+    work_dir = Path(tempfile.mkdtemp(prefix="bench_pipeline_", dir=base_dir))
+    created = {}
+
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        renamer = FileRenamer(r"\.jpg$", digit_count=7, journal_file="")
+        file_buffer = FileBuffer(max_size=buffer_size, batch_size=batch_size, batch_timeout=batch_timeout)
+        handler = FileMonitorHandler(file_buffer, renamer)
+        processor = TimedBatchFileProcessor(file_buffer, renamer, num_workers=workers)
+        processor.start()
+        observer = Observer()
+        observer.schedule(handler, '.', recursive=False)
+        observer.start()
+
+        usage_start = resource.getrusage(resource.RUSAGE_SELF)
+        generate_load(work_dir, num_files, rate, burst_size, created)
+
+        # 等到全部处理完，或一段时间内没有进展
+        idle_limit = 2.0 + batch_timeout
+        last_progress, last_count = time.monotonic(), -1
+        while time.monotonic() - last_progress < idle_limit:
+            stats = processor.get_stats()
+            count = stats['processed'] + file_buffer.get_stats()['dropped']
+            if count >= num_files:
+                break
+            if count != last_count:
+                last_progress, last_count = time.monotonic(), count
+            time.sleep(0.05)
+        usage_end = resource.getrusage(resource.RUSAGE_SELF)
+
+        observer.stop()
+        observer.join()
+        processor.should_stop = True
+        file_buffer.close()
+        processor.join()
+        renamer.cleanup_temp_dirs()
+    finally:
+        os.chdir(cwd)
+
+    stats = processor.get_stats()
+    latencies = sorted(
+        done - created[name] for name, done in processor.done_times.items() if name in created
+    )
+    first_create = min(created.values()) if created else 0.0
+    last_done = max(processor.done_times.values()) if processor.done_times else first_create
+    elapsed = last_done - first_create
+    return {
+        'workers': workers,
+        'batch_size': batch_size,
+        'batch_timeout': batch_timeout,
+        'succeeded': stats['succeeded'],
+        'failed': stats['failed'],
+        'dropped': file_buffer.get_stats()['dropped'],
+        'missing': num_files - stats['processed'] - file_buffer.get_stats()['dropped'],
+        'files_per_sec': stats['succeeded'] / elapsed if elapsed > 0 else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'cpu': (usage_end.ru_utime - usage_start.ru_utime) + (usage_end.ru_stime - usage_start.ru_stime),
+    }
+
+
+def run_pipeline(args):
+    """运行端到端基准，遍历调优参数组合输出对比表"""
+    # 丢弃和失败会计入结果表，不再逐条输出警告
+    logging.getLogger().setLevel(logging.ERROR)
+    print(
+        f"文件数: {args.files}, 速率: {args.rate or '不限'}/秒, 突发大小: {args.burst_size}, "
+        f"缓冲区: {args.buffer_size}"
+    )
+    print(
+        f"{'线程':>4} {'批大小':>6} {'超时(s)':>7} {'文件/秒':>9} {'p50(ms)':>9} {'p99(ms)':>9} "
+        f"{'成功':>7} {'失败':>5} {'丢弃':>5} {'遗漏':>5} {'CPU(s)':>7}"
+    )
+    for workers, batch_size, batch_timeout in itertools.product(args.workers, args.batch_size, args.batch_timeout):
+        result = bench_pipeline(
+            args.dir, args.files, args.rate, args.burst_size,
+            workers, batch_size, batch_timeout, args.buffer_size
+        )
+        print(
+            f"{result['workers']:>4} {result['batch_size']:>6} {result['batch_timeout']:>7} "
+            f"{result['files_per_sec']:>9.0f} {result['p50_ms']:>9.1f} {result['p99_ms']:>9.1f} "
+            f"{result['succeeded']:>7} {result['failed']:>5} {result['dropped']:>5} {result['missing']:>5} "
+            f"{result['cpu']:>7.2f}"
+        )
+
+
+def bench_batching(base_dir, num_files, rate, burst_size, workers, batch_size, batch_timeout,
+                   adaptive=False, target_latency=0.2, max_batch_size=100):
+    """
+    批处理参数基准：文件预先创建，事件按速率直接送入 FileMonitorHandler，
+    不经过 watchdog，只比较缓冲区和批处理本身带来的延迟与开销
+
+    Args:
+        adaptive: 是否由 BatchController 调整批次参数，batch_size 和 batch_timeout 作为初始值
+
+    Returns:
+        dict: 测试结果
+    """
+    work_dir, files = make_scratch_files(base_dir, num_files, "bench_batching_")
+    submitted = {}
+
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        renamer = FileRenamer(r"\.jpg$", digit_count=7, journal_file="")
+        file_buffer = FileBuffer(max_size=num_files, batch_size=batch_size, batch_timeout=batch_timeout)
+        handler = FileMonitorHandler(file_buffer, renamer)
+        processor = TimedBatchFileProcessor(file_buffer, renamer, num_workers=workers)
+        processor.start()
+        controller = None
+        if adaptive:
+            controller = BatchController(
+                file_buffer, processor, target_latency=target_latency,
+                max_batch_size=max_batch_size, max_timeout=batch_timeout, interval=0.25
+            )
+            controller.start()
+
+        usage_start = resource.getrusage(resource.RUSAGE_SELF)
+        interval = burst_size / rate if rate > 0 else 0
+        next_time = time.perf_counter()
+        for start in range(0, num_files, burst_size):
+            for path in files[start:start + burst_size]:
+                submitted[path.name] = time.perf_counter()
+                handler._handle_file_event(str(path), 'created')
+            if interval:
+                next_time += interval
+                delay = next_time - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+        wait_processed(processor.get_stats, num_files)
+        usage_end = resource.getrusage(resource.RUSAGE_SELF)
+
+        if controller is not None:
+            controller.stop()
+        processor.should_stop = True
+        file_buffer.close()
+        processor.join()
+        renamer.cleanup_temp_dirs()
+    finally:
+        os.chdir(cwd)
+
+    stats = processor.get_stats()
+    latencies = sorted(done - submitted[name] for name, done in processor.done_times.items())
+    elapsed = max(processor.done_times.values()) - min(submitted.values()) if latencies else 0.0
+    return {
+        'succeeded': stats['succeeded'],
+        'batches': stats['batches'],
+        'final_batch_size': file_buffer.batch_size,
+        'final_batch_timeout': file_buffer.batch_timeout,
+        'files_per_sec': stats['succeeded'] / elapsed if elapsed > 0 else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'cpu': (usage_end.ru_utime - usage_start.ru_utime) + (usage_end.ru_stime - usage_start.ru_stime),
+    }
+
+
+def run_adaptive(args):
+    """在小流量和突发流量两种负载下对比固定批次参数与自适应批处理"""
+    logging.getLogger().setLevel(logging.ERROR)
+    workloads = [
+        ('trickle', args.trickle_files, args.trickle_rate, 1),
+        ('burst', args.burst_files, args.burst_rate, args.burst_size),
+    ]
+    print(f"固定参数: 批大小 {args.batch_size}, 超时 {args.batch_timeout}秒; 自适应 p99 目标: {args.target_latency}秒")
+    print(
+        f"{'负载':>8} {'模式':>8} {'文件/秒':>9} {'p50(ms)':>9} {'p99(ms)':>9} {'批次':>6} "
+        f"{'最终批大小':>10} {'最终超时(ms)':>12} {'成功':>7} {'CPU(s)':>7}"
+    )
+    for name, num_files, rate, burst_size in workloads:
+        for adaptive in (False, True):
+            result = bench_batching(
+                args.dir, num_files, rate, burst_size, args.workers, args.batch_size, args.batch_timeout,
+                adaptive=adaptive, target_latency=args.target_latency, max_batch_size=args.max_batch_size
+            )
+            print(
+                f"{name:>8} {'adaptive' if adaptive else 'static':>8} {result['files_per_sec']:>9.0f} "
+                f"{result['p50_ms']:>9.1f} {result['p99_ms']:>9.1f} {result['batches']:>6} "
+                f"{result['final_batch_size']:>10} {result['final_batch_timeout'] * 1000:>12.0f} "
+                f"{result['succeeded']:>7} {result['cpu']:>7.2f}"
+            )
+
+
+def make_names(num_names, digit_count, seed=0):
+    """生成混合各类文件名的合成数据：待处理、已编号、后缀不符、隐藏文件、超长文件名"""
+    rng = random.Random(seed)
+    kinds = (
+        lambda i: f"IMG_{i}.jpg",
+        lambda i: f"photo_{i}.PNG",
+        lambda i: f"{i % 10 ** digit_count:0{digit_count}d}.jpg",
+        lambda i: f"{i % 10 ** (digit_count + 1):0{digit_count + 1}d}.png",
+        lambda i: f"notes_{i}.txt",
+        lambda i: f"archive_{i}.tar.gz",
+        lambda i: f".hidden_{i}.jpg",
+        lambda i: f"{i}.jpg.part",
+        lambda i: "x" * 260 + ".jpg",
+    )
+    weights = (30, 10, 20, 5, 15, 5, 5, 8, 2)
+    return [rng.choices(kinds, weights)[0](i) for i in range(num_names)]
+
+
+def legacy_skip_reason(renamer, filename):
+    """原先的判断方式：should_process 逐个正则匹配，被跳过后再匹配一遍求原因"""
+    def should_process():
+        if str(renamer.temp_dir) in filename:
+            return False
+        if len(filename) > renamer.max_filename_length:
+            return False
+        if not renamer.pattern.search(filename):
+            return False
+        if renamer.renamed_files_pattern.match(filename):
+            return False
+        if filename.startswith('.'):
+            return False
+        return True
+
+    if should_process():
+        return None
+    if len(filename) > renamer.max_filename_length:
+        return 'too_long'
+    elif not renamer.pattern.search(filename):
+        return 'wrong_extension'
+    elif renamer.renamed_files_pattern.match(filename):
+        return 'already_numbered'
+    elif filename.startswith('.'):
+        return 'hidden'
+    return 'other'
+
+
+def bench_classify(names, extension, ignore_case, digit_count):
+    """
+    文件名分类基准：对比原先的正则链、后缀集合快速路径与单次正则路径
+
+    Args:
+        names: 文件名列表
+        extension: 文件后缀，如 "jpg,png"
+        ignore_case: 是否忽略大小写
+        digit_count: 序号位数
+
+    Returns:
+        list: 每种方式的 (名称, 每个文件名耗时(ns), 各原因计数)
+    """
+    pattern, flags = watcher.create_pattern_from_extension(extension, ignore_case)
+    extensions = watcher.parse_extension_list(extension)
+    work_dir = tempfile.mkdtemp(prefix="bench_classify_")
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        suffix_renamer = FileRenamer(pattern, digit_count, flags, extensions=extensions, intent_file=None)
+        regex_renamer = FileRenamer(pattern, digit_count, flags, intent_file=None)
+    finally:
+        os.chdir(cwd)
+
+    methods = [
+        ('legacy', lambda name: legacy_skip_reason(regex_renamer, name)),
+        ('regex', regex_renamer.classify),
+        ('suffix', suffix_renamer.classify),
+    ]
+    results = []
+    for label, classify in methods:
+        start = time.perf_counter()
+        reasons = list(map(classify, names))
+        elapsed = time.perf_counter() - start
+        counts = {}
+        for reason in reasons:
+            counts[reason] = counts.get(reason, 0) + 1
+        results.append((label, elapsed / len(names) * 1e9, counts))
+    return results
+
+
+def run_classify(args):
+    """运行文件名分类微基准"""
+    logging.getLogger().setLevel(logging.ERROR)
+    names = make_names(args.names, args.digits)
+    print(f"文件名数量: {len(names)}, 后缀: {args.extension}, 忽略大小写: {args.ignore_case}")
+    print(f"{'方式':>8} {'ns/个':>8} {'处理':>9} {'已编号':>9} {'后缀不符':>9} {'隐藏':>9} {'过长':>9}")
+    results = bench_classify(names, args.extension, args.ignore_case, args.digits)
+    for label, ns_per_name, counts in results:
+        print(
+            f"{label:>8} {ns_per_name:>8.0f} {counts.get(None, 0):>9} {counts.get('already_numbered', 0):>9} "
+            f"{counts.get('wrong_extension', 0):>9} {counts.get('hidden', 0):>9} {counts.get('too_long', 0):>9}"
+        )
+    if len({tuple(sorted(counts.items(), key=str)) for _, _, counts in results}) != 1:
+        print("警告: 各方式的分类结果不一致")
+
+
+REPLAY_EVENTS = {
+    'created': lambda src, dest: FileCreatedEvent(src),
+    'moved': lambda src, dest: FileMovedEvent(src, dest),
+    'deleted': lambda src, dest: FileDeletedEvent(src),
+    'modified': lambda src, dest: FileModifiedEvent(src),
+    'closed': lambda src, dest: FileClosedEvent(src),
+}
+
+
+def replay_path(work_dirs, index, path):
+    """把事件日志中的路径映射到合成目录"""
+    if index == watcher.TRACE_ABSOLUTE:
+        return str(work_dirs[-1] / path.lstrip(os.sep))
+    return str(work_dirs[index] / path)
+
+
+def write_sized(path, size):
+    """创建(或截断)文件到指定大小，使用稀疏文件，不实际写入数据"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'ab') as f:
+        f.truncate(max(0, size))
+
+
+def apply_event(renamer, event_type, src, dest, size, pending=()):
+    """
+    在合成目录中重现事件对应的文件变化
+
+    只重现会产生待处理文件的变化；日志中也包含重命名器自身产生的事件(移入临时目录、
+    改为编号文件名)，这些由回放时的重命名器自己完成，不能再做一次。移入临时目录在
+    监控目录中表现为 deleted，所以仍在等待重命名的文件(pending)不按日志删除
+    """
+    try:
+        if event_type == 'created':
+            if renamer.filter(Path(src)) is None:
+                write_sized(src, size)
+        elif event_type == 'moved':
+            if renamer.filter(Path(dest)) is None:
+                if os.path.exists(src):
+                    os.makedirs(os.path.dirname(dest), exist_ok=True)
+                    os.replace(src, dest)
+                else:
+                    write_sized(dest, size)
+        elif event_type == 'deleted':
+            if src not in pending and renamer.filter(Path(src)) is None and os.path.exists(src):
+                os.unlink(src)
+        elif size >= 0 and renamer.filter(Path(src)) is None and os.path.exists(src):
+            os.truncate(src, size)
+    except OSError:
+        pass  # 与实际环境一样，文件可能已被处理线程移走
+
+
+def bench_replay(trace, base_dir, speed, workers, batch_size, batch_timeout, buffer_size, stable_quiet):
+    """
+    事件回放基准：在合成目录中按日志重现文件变化，并把事件送入 FileMonitorHandler + BatchFileProcessor
+
+    事件由单个线程按日志顺序送入，与 watchdog 线程一致；同一个日志每次回放的输入完全相同，
+    可用于对比代码改动前后的表现
+
+    Args:
+        trace: 事件日志文件(main.py --record-trace 生成)
+        base_dir: 合成目录所在目录
+        speed: 回放速度倍数，1 表示按记录时的时间间隔，0 表示尽快回放
+        workers: 处理线程数
+        batch_size: 批处理大小
+        batch_timeout: 批处理超时时间(秒)
+        buffer_size: 缓冲区大小
+        stable_quiet: 文件稳定等待时间(秒)，0 表示不等待
+
+    Returns:
+        dict: 测试结果
+    """
+    metadata, events = watcher.read_trace(trace)
+    work_dir = Path(tempfile.mkdtemp(prefix="bench_replay_", dir=base_dir))
+    work_dirs = [work_dir / str(i) for i in range(len(metadata['directories']))] + [work_dir / "abs"]
+    for directory in work_dirs:
+        directory.mkdir()
+
+    if metadata.get('pattern'):
+        pattern = metadata['pattern']
+        flags = re.IGNORECASE if metadata.get('ignore_case') else 0
+        extensions = None
+    else:
+        pattern, flags = watcher.create_pattern_from_extension(metadata['extension'], metadata.get('ignore_case'))
+        extensions = watcher.parse_extension_list(metadata['extension'])
+
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        renamer = FileRenamer(
+            pattern, digit_count=metadata.get('digits', 3), flags=flags,
+            max_filename_length=metadata.get('max_filename_length', 255), journal_file="",
+            directories=[str(directory) for directory in work_dirs[:-1]], extensions=extensions
+        )
+        renamer.recover()
+        file_buffer = FileBuffer(max_size=buffer_size, batch_size=batch_size, batch_timeout=batch_timeout)
+        handler = FileMonitorHandler(file_buffer, renamer)
+        stability = None
+        if stable_quiet > 0:
+            stability = StabilityTracker(handler.add_to_buffer, quiet_period=stable_quiet)
+            stability.start()
+            handler.stability = stability
+            renamer.access_attempts = 1
+        processor = TimedBatchFileProcessor(file_buffer, renamer, num_workers=workers, key=str)
+        processor.start()
+
+        dispatched = {}  # 文件路径 -> 第一次收到事件的时间
+        num_events = 0
+        usage_start = resource.getrusage(resource.RUSAGE_SELF)
+        start = time.perf_counter()
+        for offset, event_type, index, src, dest, size in events:
+            if speed > 0:
+                delay = start + offset / speed - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            src = replay_path(work_dirs, index, src)
+            if dest is not None:
+                dest = replay_path(work_dirs, index, dest)
+            apply_event(renamer, event_type, src, dest, size, file_buffer.processing_files)
+            if event_type in ('created', 'moved'):
+                dispatched.setdefault(dest or src, time.perf_counter())
+            handler.dispatch(REPLAY_EVENTS[event_type](src, dest))
+            num_events += 1
+        feed_done = time.perf_counter()
+
+        # 等到缓冲区、处理中和重试都清空，或一段时间内没有进展
+        idle_limit = 2.0 + batch_timeout + stable_quiet
+        last_progress, last_count = time.monotonic(), -1
+        while time.monotonic() - last_progress < idle_limit:
+            buffer_stats = file_buffer.get_stats()
+            if not (buffer_stats['buffer_size'] or buffer_stats['processing_count'] or buffer_stats['retry_pending']
+                    or (stability is not None and stability.pending)):
+                break
+            count = processor.get_stats()['processed']
+            if count != last_count:
+                last_progress, last_count = time.monotonic(), count
+            time.sleep(0.05)
+        usage_end = resource.getrusage(resource.RUSAGE_SELF)
+
+        if stability is not None:
+            stability.stop()
+        processor.should_stop = True
+        file_buffer.close()
+        processor.join()
+        renamer.cleanup_temp_dirs()
+        renamer.close()
+    finally:
+        os.chdir(cwd)
+
+    stats = processor.get_stats()
+    buffer_stats = file_buffer.get_stats()
+    event_stats = handler.get_event_stats()
+    latencies = sorted(
+        done - dispatched[key] for key, done in processor.done_times.items() if key in dispatched
+    )
+    last_done = max(processor.done_times.values(), default=feed_done)
+    elapsed = max(last_done, feed_done) - start
+    return {
+        'events': num_events,
+        'accepted': event_stats.get('added_to_buffer', 0),
+        'succeeded': stats['succeeded'],
+        'failed': stats['failed'],
+        'duplicate': event_stats.get('duplicate', 0),
+        'dropped': buffer_stats['dropped'] + event_stats.get('buffer_rejected', 0) + len(buffer_stats['dead_letters']),
+        'missing': event_stats.get('added_to_buffer', 0) - stats['succeeded'] - len(buffer_stats['dead_letters']),
+        'events_per_sec': num_events / (feed_done - start) if feed_done > start else 0.0,
+        'files_per_sec': stats['succeeded'] / elapsed if elapsed > 0 else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p90_ms': percentile(latencies, 90) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'max_ms': (latencies[-1] if latencies else 0.0) * 1000,
+        'cpu': (usage_end.ru_utime - usage_start.ru_utime) + (usage_end.ru_stime - usage_start.ru_stime),
+    }
+
+
+def run_replay(args):
+    """回放事件日志，可重复多次以观察波动"""
+    logging.getLogger().setLevel(logging.ERROR)
+    metadata, _ = watcher.read_trace(args.trace)
+    print(
+        f"事件日志: {args.trace}, 记录目录: {', '.join(metadata['directories'])}, "
+        f"回放速度: {f'{args.speed}x' if args.speed > 0 else '不限'}"
+    )
+    print(
+        f"{'轮次':>4} {'事件数':>7} {'事件/秒':>9} {'文件/秒':>9} {'p50(ms)':>9} {'p90(ms)':>9} {'p99(ms)':>9} "
+        f"{'max(ms)':>9} {'入队':>7} {'成功':>7} {'失败':>5} {'重复':>6} {'丢弃':>5} {'遗漏':>5} {'CPU(s)':>7}"
+    )
+    for run in range(1, args.runs + 1):
+        result = bench_replay(
+            args.trace, args.dir, args.speed, args.workers, args.batch_size,
+            args.batch_timeout, args.buffer_size, args.stable_quiet
+        )
+        print(
+            f"{run:>4} {result['events']:>7} {result['events_per_sec']:>9.0f} {result['files_per_sec']:>9.0f} "
+            f"{result['p50_ms']:>9.1f} {result['p90_ms']:>9.1f} {result['p99_ms']:>9.1f} {result['max_ms']:>9.1f} "
+            f"{result['accepted']:>7} {result['succeeded']:>7} {result['failed']:>5} {result['duplicate']:>6} "
+            f"{result['dropped']:>5} {result['missing']:>5} {result['cpu']:>7.2f}"
+        )
+
+
+def parse_arguments():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description="main.py 性能测试")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    queue_parser = subparsers.add_parser("queue", help="BatchQueue 入队/出队微基准")
+    queue_parser.add_argument("--items", type=int, default=100000, help="元素总数，默认是 100000")
+    queue_parser.add_argument(
+        "--workers", type=int, nargs="+", default=[1, 4, 16],
+        help="要测试的消费者线程数，默认是 1 4 16"
+    )
+    queue_parser.add_argument("--batch-size", type=int, default=10, help="批处理大小，默认是 10")
+    queue_parser.add_argument("--max-wait", type=float, default=0.5, help="批次最长等待时间(秒)，默认是 0.5")
+    queue_parser.set_defaults(func=run_queue)
+
+    rename_parser = subparsers.add_parser("rename", help="临时目录两次重命名与直接重命名对比")
+    rename_parser.add_argument(
+        "--dir", default=tempfile.gettempdir(),
+        help="测试所在目录，可分别指定 tmpfs 与 ext4 上的目录，默认是系统临时目录"
+    )
+    rename_parser.add_argument("--files", type=int, default=10000, help="文件数量，默认是 10000")
+    rename_parser.add_argument("--batch-size", type=int, default=10, help="批处理大小，默认是 10")
+    rename_parser.set_defaults(func=run_rename)
+
+    engines_parser = subparsers.add_parser("engines", help="线程引擎与 asyncio 引擎对比")
+    engines_parser.add_argument("--dir", default=tempfile.gettempdir(), help="测试所在目录，默认是系统临时目录")
+    engines_parser.add_argument("--files", type=int, default=10000, help="文件数量，默认是 10000")
+    engines_parser.add_argument("--workers", type=int, default=3, help="处理线程/协程数量，默认是 3")
+    engines_parser.add_argument("--batch-size", type=int, default=10, help="批处理大小，默认是 10")
+    engines_parser.add_argument("--batch-timeout", type=float, default=0.5, help="批处理超时时间(秒)，默认是 0.5")
+    engines_parser.set_defaults(func=run_engines)
+
+    pipeline_parser = subparsers.add_parser("pipeline", help="端到端吞吐与延迟基准，可遍历调优参数")
+    pipeline_parser.add_argument("--dir", default=tempfile.gettempdir(), help="测试所在目录，默认是系统临时目录")
+    pipeline_parser.add_argument("--files", type=int, default=5000, help="文件数量，默认是 5000")
+    pipeline_parser.add_argument("--rate", type=float, default=0, help="每秒创建多少个文件，默认 0 表示尽快创建")
+    pipeline_parser.add_argument(
+        "--burst-size", type=int, default=1,
+        help="每次连续创建多少个文件，1 表示按速率均匀创建，默认是 1"
+    )
+    pipeline_parser.add_argument("--buffer-size", type=int, default=1000, help="缓冲区大小，默认是 1000")
+    pipeline_parser.add_argument(
+        "--workers", type=int, nargs="+", default=[3], help="要测试的处理线程数，可指定多个，默认是 3"
+    )
+    pipeline_parser.add_argument(
+        "--batch-size", type=int, nargs="+", default=[10], help="要测试的批处理大小，可指定多个，默认是 10"
+    )
+    pipeline_parser.add_argument(
+        "--batch-timeout", type=float, nargs="+", default=[0.5],
+        help="要测试的批处理超时时间(秒)，可指定多个，默认是 0.5"
+    )
+    pipeline_parser.set_defaults(func=run_pipeline)
+
+    adaptive_parser = subparsers.add_parser("adaptive", help="固定批次参数与自适应批处理对比")
+    adaptive_parser.add_argument("--dir", default=tempfile.gettempdir(), help="测试所在目录，默认是系统临时目录")
+    adaptive_parser.add_argument("--trickle-files", type=int, default=200, help="小流量负载的文件数，默认是 200")
+    adaptive_parser.add_argument("--trickle-rate", type=float, default=40, help="小流量负载每秒的事件数，默认是 40")
+    adaptive_parser.add_argument("--burst-files", type=int, default=50000, help="突发负载的文件数，默认是 50000")
+    adaptive_parser.add_argument("--burst-rate", type=float, default=10000, help="突发负载平均每秒的事件数，默认是 10000")
+    adaptive_parser.add_argument("--burst-size", type=int, default=5000, help="突发负载每次连续送入的事件数，默认是 5000")
+    adaptive_parser.add_argument("--workers", type=int, default=3, help="处理线程数，默认是 3")
+    adaptive_parser.add_argument("--batch-size", type=int, default=10, help="固定批处理大小及自适应初始值，默认是 10")
+    adaptive_parser.add_argument(
+        "--batch-timeout", type=float, default=0.5, help="固定批处理超时及自适应上限(秒)，默认是 0.5"
+    )
+    adaptive_parser.add_argument("--target-latency", type=float, default=0.2, help="p99 延迟目标(秒)，默认是 0.2")
+    adaptive_parser.add_argument("--max-batch-size", type=int, default=100, help="自适应批次大小上限，默认是 100")
+    adaptive_parser.set_defaults(func=run_adaptive)
+
+    classify_parser = subparsers.add_parser("classify", help="文件名分类微基准")
+    classify_parser.add_argument("--names", type=int, default=2000000, help="合成文件名数量，默认是 2000000")
+    classify_parser.add_argument("--extension", default="jpg,png", help="文件后缀，默认是 jpg,png")
+    classify_parser.add_argument("--ignore-case", action="store_true", help="忽略后缀大小写")
+    classify_parser.add_argument("--digits", type=int, default=3, help="序号位数，默认是 3")
+    classify_parser.set_defaults(func=run_classify)
+
+    replay_parser = subparsers.add_parser("replay", help="回放 main.py --record-trace 记录的事件日志")
+    replay_parser.add_argument("trace", help="事件日志文件")
+    replay_parser.add_argument("--dir", default=tempfile.gettempdir(), help="合成目录所在目录，默认是系统临时目录")
+    replay_parser.add_argument(
+        "--speed", type=float, default=1.0,
+        help="回放速度倍数，1 表示按记录时的时间间隔，0 表示尽快回放，默认是 1"
+    )
+    replay_parser.add_argument("--runs", type=int, default=1, help="重复回放几次，默认是 1")
+    replay_parser.add_argument("--workers", type=int, default=3, help="处理线程数，默认是 3")
+    replay_parser.add_argument("--batch-size", type=int, default=10, help="批处理大小，默认是 10")
+    replay_parser.add_argument("--batch-timeout", type=float, default=0.5, help="批处理超时时间(秒)，默认是 0.5")
+    replay_parser.add_argument("--buffer-size", type=int, default=1000, help="缓冲区大小，默认是 1000")
+    replay_parser.add_argument("--stable-quiet", type=float, default=0, help="文件稳定等待时间(秒)，默认 0 表示不等待")
+    replay_parser.set_defaults(func=run_replay)
+
+    return parser.parse_args()
+
+
+def main():
+    """主函数"""
+    args = parse_arguments()
+    watcher.setup_logging()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
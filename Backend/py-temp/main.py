@@ -1,470 +1,3930 @@
 #!/usr/bin/env python3
 """
 文件监控与重命名脚本
+
+asyncio、concurrent.futures、http.server、multiprocessing、ctypes、hashlib 和
+watchdog.observers 只在用到时导入，--help、参数检查和重启不必为不使用的功能付出导入时间
 """
 
-import re
 import time
+_IMPORT_STARTED = time.perf_counter()  # 启动耗时统计的起点
+
+import os
+import re
+import json
+import zlib
+import heapq
+import random
+import errno
 import signal
 import argparse
 import shutil
+import struct
 from pathlib import Path
-from collections import deque, defaultdict
-from threading import Lock, Thread, Event, Condition
+from collections import deque, defaultdict, OrderedDict
+from threading import Lock, Thread, Event, Condition, BoundedSemaphore, local, current_thread
+from weakref import WeakSet
 import logging
-from watchdog.observers import Observer
+try:
+    import fcntl
+except ImportError:  # Windows 没有 fcntl，不支持多实例租约
+    fcntl = None
 from watchdog.events import FileSystemEventHandler
 
-# 配置日志
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S'
-)
 logger = logging.getLogger(__name__)
 
-class FileBuffer:
-    """文件缓冲区 - 管理待处理文件"""
+def setup_logging(debug=False):
+    """配置日志，在入口处调用，导入本模块不会修改日志配置"""
+    logging.basicConfig(
+        level=logging.DEBUG if debug else logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S'
+    )
+
+# renameat2 相关常量(Linux)
+AT_FDCWD = -100
+RENAME_NOREPLACE = 1
+_renameat2 = None
+_renameat2_loaded = False
+
+def _get_renameat2():
+    """加载 libc 中的 renameat2，不支持时返回 None"""
+    global _renameat2, _renameat2_loaded
+    if not _renameat2_loaded:
+        _renameat2_loaded = True
+        try:
+            import ctypes
+            func = ctypes.CDLL(None, use_errno=True).renameat2
+            func.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_uint]
+            func.restype = ctypes.c_int
+            _renameat2 = func
+        except (OSError, AttributeError, TypeError):
+            _renameat2 = None
+    return _renameat2
+
+def move_noreplace(src, dst):
+    """
+    原子地将 src 移动到 dst，dst 已存在时抛出 FileExistsError
+    
+    优先使用 renameat2(RENAME_NOREPLACE)，文件系统或平台不支持时
+    回退为硬链接 + 删除原文件
+    """
+    renameat2 = _get_renameat2()
+    if renameat2 is not None:
+        if renameat2(AT_FDCWD, os.fsencode(src), AT_FDCWD, os.fsencode(dst), RENAME_NOREPLACE) == 0:
+            return
+        import ctypes
+        err = ctypes.get_errno()
+        if err not in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+            raise OSError(err, os.strerror(err), str(src), None, str(dst))
+    
+    os.link(src, dst)
+    os.unlink(src)
+
+class _ThreadCells:
+    """
+    每个线程一份累加单元：写入时只改本线程的单元，无需加锁，读取时汇总
+    
+    线程退出前调用 retire_thread_cells，把它的单元并入已退出线程的汇总单元后移除，
+    临时线程反复创建、退出时单元数量不会一直增长
+    """
     
-    def __init__(self, max_size=1000, batch_size=10, batch_timeout=0.5):
+    _instances = WeakSet()
+    _instances_lock = Lock()
+    
+    def __init__(self, factory, merge):
         """
-        初始化文件缓冲区
-        
         Args:
-            max_size: 最大缓冲区大小
-            batch_size: 批处理大小
-            batch_timeout: 批处理超时时间(秒)
+            factory: 创建空单元的函数
+            merge: 合并函数 merge(目标单元, 来源单元)，把来源累加到目标上
         """
-        self.max_size = max_size
-        self.batch_size = batch_size
-        self.batch_timeout = batch_timeout
-        self.buffer = deque()
-        self.lock = Lock()
-        self.condition = Condition()
-        self.processing_files = set()
-        self.failed_files = defaultdict(int)  # 文件失败次数记录
-        self.max_retries = 3
+        self._factory = factory
+        self._merge = merge
+        self._local = local()
+        self._cells = []
+        self._retired = factory()
+        self._lock = Lock()  # 只在线程第一次写入和退出时使用
+        with self._instances_lock:
+            self._instances.add(self)
         
-    def add_file(self, file_path):
-        """添加文件到缓冲区"""
-        with self.lock:
-            if len(self.buffer) >= self.max_size:
-                logger.warning("缓冲区已满，丢弃文件: %s", file_path.name)
-                return False
-                
-            if file_path.name in self.processing_files:
-                return False
-                
-            # 检查失败次数
-            if self.failed_files[file_path.name] >= self.max_retries:
-                logger.debug("文件 %s 已达到最大重试次数，跳过", file_path.name)
-                return False
-                
-            self.buffer.append(file_path)
-            self.processing_files.add(file_path.name)
-            
-            # 通知等待的消费者
-            with self.condition:
-                self.condition.notify_all()
-                
-            return True
+    def cell(self):
+        """获取当前线程的累加单元"""
+        try:
+            return self._local.cell
+        except AttributeError:
+            cell = self._factory()
+            with self._lock:
+                self._cells.append(cell)
+            self._local.cell = cell
+            return cell
     
-    def get_batch(self, timeout=None):
-        """获取一批文件进行处理"""
-        if timeout is None:
-            timeout = self.batch_timeout
-            
-        batch = []
-        start_time = time.time()
+    def cells(self):
+        """获取所有线程的累加单元，已退出线程的单元合并为一个"""
+        with self._lock:
+            return self._cells + [self._retired]
+    
+    def retire(self):
+        """把当前线程的单元并入汇总单元并移除"""
+        try:
+            cell = self._local.cell
+        except AttributeError:
+            return
+        del self._local.cell
+        # 合并到新的汇总单元再整体替换，读取方拿到的要么是旧汇总加该单元，要么是新汇总
+        retired = self._factory()
+        with self._lock:
+            self._merge(retired, self._retired)
+            self._merge(retired, cell)
+            self._retired = retired
+            self._cells.remove(cell)
+
+def retire_thread_cells():
+    """当前线程即将退出：合并并移除它在所有指标中的累加单元"""
+    with _ThreadCells._instances_lock:
+        instances = list(_ThreadCells._instances)
+    for cells in instances:
+        cells.retire()
+
+class Counter:
+    """计数器 - 只增不减，可按一个标签区分"""
+    
+    kind = 'counter'
+    
+    def __init__(self, name, help_text, label=None):
+        """
+        初始化计数器
         
-        with self.condition:
-            while len(batch) < self.batch_size and (time.time() - start_time) < timeout:
-                with self.lock:
-                    if self.buffer:
-                        file_path = self.buffer.popleft()
-                        batch.append(file_path)
-                
-                if len(batch) < self.batch_size:
-                    # 等待新文件或超时
-                    remaining_time = timeout - (time.time() - start_time)
-                    if remaining_time > 0:
-                        self.condition.wait(remaining_time)
+        Args:
+            name: 指标名称
+            help_text: 指标说明
+            label: 标签名，为 None 时不区分标签
+        """
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self._cells = _ThreadCells(lambda: defaultdict(int), self._merge)
         
-        return batch
+    def inc(self, label_value='', amount=1):
+        """增加计数"""
+        self._cells.cell()[label_value] += amount
     
-    def mark_success(self, filename):
-        """标记文件处理成功"""
-        with self.lock:
-            if filename in self.processing_files:
-                self.processing_files.remove(filename)
-            if filename in self.failed_files:
-                del self.failed_files[filename]
+    @staticmethod
+    def _merge(target, cell):
+        for label_value, count in cell.copy().items():
+            target[label_value] += count
     
-    def mark_failed(self, filename):
-        """标记文件处理失败"""
-        with self.lock:
-            self.failed_files[filename] += 1
-            if filename in self.processing_files:
-                self.processing_files.remove(filename)
-                
-    def get_stats(self):
-        """获取缓冲区统计信息"""
-        with self.lock:
-            return {
-                'buffer_size': len(self.buffer),
-                'processing_count': len(self.processing_files),
-                'failed_files': dict(self.failed_files)
-            }
+    def values(self):
+        """
+        汇总所有线程的计数
+        
+        Returns:
+            dict: {标签值: 计数}
+        """
+        totals = defaultdict(int)
+        for cell in self._cells.cells():
+            for label_value, count in cell.copy().items():
+                totals[label_value] += count
+        return dict(totals)
 
-class FileRenamer:
-    def __init__(self, pattern, digit_count=3, flags=0, temp_dir=".temp_rename", max_filename_length=255):
+class Gauge:
+    """仪表 - 记录当前值，或在读取时调用回调函数取值"""
+    
+    kind = 'gauge'
+    
+    def __init__(self, name, help_text, func=None, label=None, kind=None):
         """
-        初始化文件重命名器
+        初始化仪表
         
         Args:
-            pattern: 文件后缀正则表达式模式
-            digit_count: 序号位数
-            flags: 正则表达式标志
-            temp_dir: 临时目录名称
-            max_filename_length: 最大文件名长度限制
+            name: 指标名称
+            help_text: 指标说明
+            func: 取值回调，返回数值或 {标签值: 数值}
+            label: 回调返回字典时的标签名
+            kind: 导出类型，回调读取的是累计值时设为 counter
         """
-        self.pattern = re.compile(pattern, flags)
-        self.digit_count = digit_count
-        self.counter = 0
-        self.counter_lock = Lock()  # 专门用于计数器的锁
-        self.temp_dir = Path(temp_dir)
-        self.max_filename_length = max_filename_length
-        self.renamed_files_pattern = re.compile(r'^\d{' + str(digit_count) + r'}' + pattern)  # 精确匹配已重命名文件
-        
-        # 创建临时目录
-        self.temp_dir.mkdir(exist_ok=True)
+        self.name = name
+        self.help_text = help_text
+        self.func = func
+        self.label = label
+        if kind is not None:
+            self.kind = kind
+        self.value = 0
         
-        # 初始化计数器：找到已存在文件的最大序号
-        self._initialize_counter()
-        
-    def _initialize_counter(self):
-        """初始化计数器，基于已存在的文件"""
-        max_num = 0
-        current_dir = Path.cwd()
+    def set(self, value):
+        """设置当前值"""
+        self.value = value
+    
+    def values(self):
+        """获取当前值 {标签值: 数值}"""
+        if self.func is None:
+            return {'': self.value}
+        try:
+            value = self.func()
+        except Exception as e:
+            logger.debug(f"读取指标 {self.name} 失败: {e}")
+            return {}
+        return value if isinstance(value, dict) else {'': value}
+
+class Histogram:
+    """
+    直方图 - HDR 风格的对数-线性分桶
+    
+    每个 2 的幂区间再等分为 8 个子桶，相对误差不超过 12.5%；
+    每个线程写自己的桶数组，观测时不加锁
+    """
+    
+    kind = 'summary'
+    SUB_BUCKETS = 8
+    NUM_BUCKETS = 64 * SUB_BUCKETS
+    QUANTILES = (0.5, 0.9, 0.99, 0.999)
+    
+    def __init__(self, name, help_text, scale=1e6):
+        """
+        初始化直方图
         
-        # 扫描当前目录所有文件
-        for file_path in current_dir.iterdir():
-            if file_path.is_file():
-                # 使用精确匹配检查文件名是否符合序号格式
-                if self.renamed_files_pattern.search(file_path.name):
-                    try:
-                        # 提取数字部分
-                        num_str = file_path.stem  # 获取不带后缀的文件名
-                        num = int(num_str)
-                        max_num = max(max_num, num)
-                    except ValueError:
-                        # 如果不能转换为数字，跳过
-                        continue
+        Args:
+            name: 指标名称
+            help_text: 指标说明
+            scale: 观测值乘以该系数后取整分桶，秒为单位时默认精度为微秒
+        """
+        self.name = name
+        self.help_text = help_text
+        self.scale = scale
+        self._cells = _ThreadCells(lambda: [[0] * self.NUM_BUCKETS, 0.0, 0, 0.0], self._merge)  # [桶, 总和, 数量, 最大值]
         
-        self.counter = max_num
-        logger.info(f"计数器初始化为: {self.counter}")
+    @classmethod
+    def bucket_index(cls, value):
+        """整数值对应的桶序号"""
+        sub = cls.SUB_BUCKETS
+        if value < 2 * sub:
+            return max(0, value)
+        shift = value.bit_length() - 4  # 保留最高 4 位，即 8~15
+        return min((shift + 1) * sub + (value >> shift) - sub, cls.NUM_BUCKETS - 1)
     
-    def get_next_filename(self, original_ext):
-        """获取下一个文件名"""
-        with self.counter_lock:
-            self.counter += 1
-            num_str = str(self.counter).zfill(self.digit_count)
-            return f"{num_str}{original_ext}"
+    @classmethod
+    def bucket_upper(cls, index):
+        """桶的上界(不含)"""
+        sub = cls.SUB_BUCKETS
+        if index < 2 * sub:
+            return index + 1
+        shift = index // sub - 1
+        return (index % sub + sub + 1) << shift
     
-    def should_process(self, filename):
-        """检查文件是否符合处理条件"""
-        # 跳过临时目录中的文件
-        if str(self.temp_dir) in filename:
-            return False
-            
-        # 检查文件名长度是否超过限制
-        if len(filename) > self.max_filename_length:
-            logger.warning(f"文件名过长，跳过处理: {filename} (长度: {len(filename)})")
-            return False
-            
-        # 检查文件后缀是否符合要求
-        if not self.pattern.search(filename):
-            return False
-            
-        # 使用精确匹配检查是否已编号，而不是简单的数字开头
-        # 只有符合 "数字+后缀" 格式的文件才被认为是已编号的
-        if self.renamed_files_pattern.match(filename):
-            logger.debug(f"文件已编号，跳过: {filename}")
-            return False
-            
-        # 不是以点开头的隐藏文件
-        if filename.startswith('.'):
-            return False
-            
-        return True
+    def observe(self, value):
+        """记录一个观测值"""
+        cell = self._cells.cell()
+        cell[0][self.bucket_index(int(value * self.scale))] += 1
+        cell[1] += value
+        cell[2] += 1
+        if value > cell[3]:
+            cell[3] = value
     
-    def process_files_batch(self, file_paths):
+    @staticmethod
+    def _merge(target, cell):
+        for index, n in enumerate(cell[0]):
+            if n:
+                target[0][index] += n
+        target[1] += cell[1]
+        target[2] += cell[2]
+        target[3] = max(target[3], cell[3])
+    
+    def collect(self):
         """
-        批量处理文件
+        汇总所有线程的桶
         
-        Args:
-            file_paths: 文件路径列表
-            
         Returns:
-            dict: 处理结果 {文件路径: 成功/失败}
+            tuple: (各桶数量, 总和, 数量, 最大值)
         """
-        results = {}
-        
-        for file_path in file_paths:
-            try:
-                # 记录文件信息用于诊断
-                file_info = self._get_file_info(file_path)
-                logger.debug(f"处理文件: {file_info}")
-                
-                # 快速检查文件是否可访问
-                if not self._is_file_accessible(file_path):
-                    logger.warning(f"文件不可访问: {file_path.name}")
-                    results[file_path] = False
-                    continue
-                    
-                # 获取文件后缀
-                original_ext = file_path.suffix
-                
-                # 生成新文件名
-                new_filename = self.get_next_filename(original_ext)
-                new_filepath = file_path.parent / new_filename
-                
-                # 检查新文件名长度
-                if len(new_filename) > self.max_filename_length:
-                    logger.error(f"新文件名过长，无法重命名: {new_filename} (长度: {len(new_filename)})")
-                    results[file_path] = False
-                    continue
-                
-                # 先将文件移动到临时目录，避免被重复检测
-                temp_filepath = self.temp_dir / file_path.name
-                try:
-                    file_path.rename(temp_filepath)
-                except (OSError, IOError) as e:
-                    logger.warning(f"无法移动文件到临时目录 {file_path.name}: {e}")
-                    results[file_path] = False
-                    continue
-                
-                # 从临时目录重命名到目标位置
-                try:
-                    temp_filepath.rename(new_filepath)
-                    logger.info(f"重命名: {file_path.name} -> {new_filename}")
-                    results[file_path] = True
-                except (OSError, IOError) as e:
-                    logger.warning(f"无法从临时目录重命名文件 {file_path.name}: {e}")
-                    # 尝试将文件移回原位置
-                    try:
-                        temp_filepath.rename(file_path)
-                    except Exception as restore_error:
-                        logger.error(f"恢复文件失败 {file_path.name}: {restore_error}")
-                    results[file_path] = False
-                    
-            except Exception as e:
-                logger.error(f"处理文件 {file_path.name} 时发生未知错误: {e}")
-                results[file_path] = False
-                
-        return results
+        buckets = [0] * self.NUM_BUCKETS
+        total = 0.0
+        count = 0
+        maximum = 0.0
+        for cell in self._cells.cells():
+            for index, n in enumerate(cell[0]):
+                if n:
+                    buckets[index] += n
+            total += cell[1]
+            count += cell[2]
+            maximum = max(maximum, cell[3])
+        return buckets, total, count, maximum
     
-    def _is_file_accessible(self, file_path, max_attempts=2, delay=0.05):
+    def quantiles(self, buckets, quantiles=QUANTILES, maximum=None):
         """
-        快速检查文件是否可访问
+        根据桶计算分位数，可用于两次 collect 之间的差值
         
         Args:
-            file_path: 文件路径
-            max_attempts: 最大尝试次数
-            delay: 检查间隔
+            buckets: 各桶数量
+            quantiles: 要计算的分位数
+            maximum: 实际观测到的最大值，分位数不超过该值
             
         Returns:
-            bool: 文件是否可访问
+            dict: {分位数: 值}，没有观测值时为空
         """
-        for attempt in range(max_attempts):
-            try:
-                # 尝试以读写模式打开文件
-                with open(file_path, 'rb'):
-                    return True
-            except (OSError, IOError) as e:
-                logger.debug(f"文件访问失败 {file_path.name} (尝试 {attempt+1}/{max_attempts}): {e}")
-                if attempt < max_attempts - 1:
-                    time.sleep(delay)
-        return False
+        count = sum(buckets)
+        result = {}
+        if not count:
+            return result
+            
+        targets = [(q, q * count) for q in quantiles]
+        seen = 0
+        for index, n in enumerate(buckets):
+            if not n:
+                continue
+            seen += n
+            while targets and seen >= targets[0][1]:
+                q, _ = targets.pop(0)
+                # 取桶上界作为估计值
+                value = self.bucket_upper(index) / self.scale
+                result[q] = value if maximum is None else min(value, maximum)
+            if not targets:
+                break
+        return result
     
-    def _get_file_info(self, file_path):
+    def snapshot(self):
         """
-        获取文件信息用于诊断
+        汇总所有线程的观测值
         
-        Args:
-            file_path: 文件路径
-            
         Returns:
-            dict: 文件信息
+            dict: 数量、总和、最大值和各分位数
         """
-        try:
-            stat = file_path.stat()
-            return {
-                'name': file_path.name,
-                'name_length': len(file_path.name),
-                'size': stat.st_size,
-                'modified': stat.st_mtime,
-                'exists': file_path.exists()
-            }
-        except Exception as e:
-            return {
-                'name': file_path.name,
-                'name_length': len(file_path.name),
-                'error': str(e)
-            }
+        buckets, total, count, maximum = self.collect()
+        return {
+            'count': count,
+            'sum': total,
+            'max': maximum,
+            'quantiles': self.quantiles(buckets, maximum=maximum)
+        }
 
-class FileMonitorHandler(FileSystemEventHandler):
-    """文件系统事件处理器 - 修复已编号判断问题"""
+class MetricsRegistry:
+    """指标注册表 - 同名指标只创建一次，可导出为 Prometheus 文本格式或 JSON"""
     
-    def __init__(self, file_buffer, renamer):
-        super().__init__()
-        self.file_buffer = file_buffer
-        self.renamer = renamer
-        self.should_stop = False
-        self.recent_events = set()  # 近期事件集合，用于去重
-        self.event_processor_thread = None
-        self.process_event = Event()
-        self.event_stats = defaultdict(int)  # 事件统计
+    def __init__(self, prefix="renamer_"):
+        self.prefix = prefix
+        self._metrics = OrderedDict()
+        self._lock = Lock()
         
-    def on_created(self, event):
-        """文件创建事件处理"""
-        if not event.is_directory:
-            self._handle_file_event(event.src_path, 'created')
+    def _get_or_create(self, cls, name, *args, **kwargs):
+        name = self.prefix + name
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = cls(name, *args, **kwargs)
+                self._metrics[name] = metric
+            return metric
     
-    def on_moved(self, event):
-        """文件移动事件处理"""
-        if not event.is_directory:
-            self._handle_file_event(event.dest_path, 'moved')
+    def counter(self, name, help_text, label=None):
+        """获取或创建计数器"""
+        return self._get_or_create(Counter, name, help_text, label)
     
-    def on_deleted(self, event):
-        """文件删除事件处理"""
-        if not event.is_directory:
-            self.event_stats['deleted'] += 1
+    def histogram(self, name, help_text, scale=1e6):
+        """获取或创建直方图"""
+        return self._get_or_create(Histogram, name, help_text, scale)
     
-    def on_modified(self, event):
-        """文件修改事件处理"""
-        if not event.is_directory:
-            self.event_stats['modified'] += 1
+    def gauge(self, name, help_text, func=None, label=None, kind=None):
+        """创建仪表，同名的仪表会被替换(重新创建组件时)"""
+        return self.register(Gauge(self.prefix + name, help_text, func, label, kind))
     
-    def _handle_file_event(self, file_path, event_type):
-        """处理文件事件"""
-        path_obj = Path(file_path)
-        
-        # 记录事件统计
-        self.event_stats[event_type] += 1
-        
-        # 检查文件是否符合处理条件
-        if not self.renamer.should_process(path_obj.name):
-            # 记录被跳过的原因
-            if len(path_obj.name) > self.renamer.max_filename_length:
-                self.event_stats['skipped_too_long'] += 1
-            elif not self.renamer.pattern.search(path_obj.name):
-                self.event_stats['skipped_wrong_extension'] += 1
-            elif self.renamer.renamed_files_pattern.match(path_obj.name):
-                self.event_stats['skipped_already_numbered'] += 1
-            elif path_obj.name.startswith('.'):
-                self.event_stats['skipped_hidden'] += 1
-            else:
-                self.event_stats['skipped_other'] += 1
-            return
+    def register(self, metric):
+        """注册组件自己持有的指标，替换同名指标"""
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+    
+    def snapshot(self):
+        """
+        获取所有指标的当前值
         
-        # 使用文件路径和大小作为去重键
-        try:
-            file_size = path_obj.stat().st_size
-            event_key = f"{file_path}:{file_size}:{event_type}"
-        except:
-            event_key = f"{file_path}:{event_type}"
+        Returns:
+            dict: {指标名称: 值}，直方图为数量、总和、最大值和分位数
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
             
-        # 去重检查
-        if event_key in self.recent_events:
-            self.event_stats['duplicate'] += 1
-            return
+        snapshot = {}
+        for metric in metrics:
+            if isinstance(metric, Histogram):
+                value = metric.snapshot()
+                value['quantiles'] = {str(q): v for q, v in value['quantiles'].items()}
+            else:
+                value = metric.values()
+                if metric.label is None:
+                    value = value.get('', 0)
+            snapshot[metric.name] = value
+        return snapshot
+    
+    def render_prometheus(self):
+        """导出为 Prometheus 文本格式"""
+        with self._lock:
+            metrics = list(self._metrics.values())
             
-        # 添加到近期事件集合
-        self.recent_events.add(event_key)
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            if isinstance(metric, Histogram):
+                value = metric.snapshot()
+                for q, v in value['quantiles'].items():
+                    lines.append(f'{metric.name}{{quantile="{q}"}} {v:.9g}')
+                lines.append(f"{metric.name}_sum {value['sum']:.9g}")
+                lines.append(f"{metric.name}_count {value['count']}")
+                continue
+            for label_value, v in sorted(metric.values().items()):
+                if metric.label is None or label_value == '':
+                    lines.append(f"{metric.name} {v}")
+                else:
+                    lines.append(f'{metric.name}{{{metric.label}="{label_value}"}} {v}')
+        return '\n'.join(lines) + '\n'
+
+# 全局指标注册表
+METRICS = MetricsRegistry()
+QUEUE_WAIT = METRICS.histogram('queue_wait_seconds', "文件在缓冲区中等待处理的时间")
+BATCH_SIZE = METRICS.histogram('batch_size', "每个批次的文件数量", scale=1)
+STAT_SECONDS = METRICS.histogram('stat_seconds', "stat 调用耗时")
+OPEN_SECONDS = METRICS.histogram('open_seconds', "可访问性检查 open 调用耗时")
+RENAME_SECONDS = METRICS.histogram('rename_seconds', "重命名(含临时目录中转)耗时")
+CREATE_TO_RENAME = METRICS.histogram('create_to_rename_seconds', "从收到文件事件到重命名完成的时间")
+
+class MetricsExporter:
+    """指标导出器 - 本地 HTTP /metrics 接口和定期写入的 JSON 快照文件"""
+    
+    def __init__(self, registry, port=0, host="127.0.0.1", snapshot_file=None, snapshot_interval=10):
+        """
+        初始化指标导出器
         
-        # 添加到缓冲区
-        if self.file_buffer.add_file(path_obj):
-            logger.debug(f"添加到缓冲区: {path_obj.name} (事件: {event_type})")
-            self.event_stats['added_to_buffer'] += 1
-        else:
-            self.event_stats['buffer_rejected'] += 1
+        Args:
+            registry: 指标注册表
+            port: HTTP 端口，0 表示不启动 HTTP 接口
+            host: HTTP 监听地址，默认只监听本机
+            snapshot_file: JSON 快照文件路径，为空时不写快照
+            snapshot_interval: 写快照的间隔(秒)
+        """
+        self.registry = registry
+        self.port = port
+        self.host = host
+        self.snapshot_file = snapshot_file
+        self.snapshot_interval = snapshot_interval
+        self.server = None
+        self.should_stop = Event()
+        self.threads = []
         
-        # 定期清理近期事件集合
-        if len(self.recent_events) > 1000:
-            self.recent_events.clear()
+    def start(self):
+        """启动 HTTP 接口和快照线程"""
+        if self.port:
+            from http.server import ThreadingHTTPServer
+            self.server = ThreadingHTTPServer((self.host, self.port), self._make_handler())
+            self.server.daemon_threads = True
+            thread = Thread(target=self.server.serve_forever, daemon=True, name="MetricsHTTP")
+            thread.start()
+            self.threads.append(thread)
+            logger.info(f"指标接口: http://{self.host}:{self.server.server_port}/metrics")
+            
+        if self.snapshot_file:
+            thread = Thread(target=self._write_snapshots, daemon=True, name="MetricsSnapshot")
+            thread.start()
+            self.threads.append(thread)
+    
+    def stop(self):
+        """停止导出，退出前再写一次快照"""
+        self.should_stop.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        for thread in self.threads:
+            thread.join()
+        if self.snapshot_file:
+            self.write_snapshot()
+    
+    def write_snapshot(self):
+        """写入 JSON 快照：先写临时文件再原子替换，读取方不会看到半个文件"""
+        snapshot = {'timestamp': time.time(), 'metrics': self.registry.snapshot()}
+        tmp_path = f"{self.snapshot_file}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(snapshot, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.snapshot_file)
+        except OSError as e:
+            logger.warning(f"写入指标快照失败: {e}")
+    
+    def _write_snapshots(self):
+        """定期写入快照"""
+        while not self.should_stop.wait(self.snapshot_interval):
+            self.write_snapshot()
+    
+    def _make_handler(self):
+        from http.server import BaseHTTPRequestHandler
+        registry = self.registry
         
-    def start_event_cleaner(self):
-        """启动事件清理线程"""
-        self.event_processor_thread = Thread(target=self._clean_events, daemon=True)
-        self.event_processor_thread.start()
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.split('?', 1)[0]
+                if path == '/metrics':
+                    body = registry.render_prometheus().encode('utf-8')
+                    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+                elif path == '/metrics.json':
+                    body = json.dumps(registry.snapshot(), ensure_ascii=False).encode('utf-8')
+                    content_type = 'application/json; charset=utf-8'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                
+            def log_message(self, format, *args):
+                logger.debug(f"指标接口: {format % args}")
         
-    def _clean_events(self):
-        """定期清理近期事件集合"""
-        while not self.should_stop:
-            time.sleep(10)  # 每10秒清理一次
-            self.recent_events.clear()
-    
-    def get_event_stats(self):
-        """获取事件统计"""
-        return dict(self.event_stats)
+        return MetricsHandler
 
-class BatchFileProcessor:
-    """批量文件处理器"""
+def register_pipeline_metrics(file_buffer, batch_processor, event_handler):
+    """
+    把各组件已有的统计注册为回调指标，抓取时才读取
     
-    def __init__(self, file_buffer, renamer, num_workers=3):
-        self.file_buffer = file_buffer
+    Args:
+        file_buffer: 文件缓冲区(或提供相同统计字段的流水线)
+        batch_processor: 批处理器(或提供相同统计字段的流水线)
+        event_handler: 事件处理器
+    """
+    METRICS.gauge('buffer_size', "缓冲区中等待处理的文件数",
+                  lambda: file_buffer.get_stats()['buffer_size'])
+    METRICS.gauge('peak_buffer_size', "缓冲区峰值深度",
+                  lambda: file_buffer.get_stats()['peak_buffer_size'])
+    METRICS.gauge('processing_files', "已入队但尚未处理完成的文件数",
+                  lambda: file_buffer.get_stats()['processing_count'])
+    METRICS.gauge('buffer_overflow_total', "缓冲区满时阻塞或丢弃的次数",
+                  lambda: {key: file_buffer.get_stats()[key] for key in ('blocked', 'dropped')},
+                  label='result', kind='counter')
+    METRICS.gauge('files_total', "已处理的文件数",
+                  lambda: {key: batch_processor.get_stats()[key] for key in ('succeeded', 'failed')},
+                  label='result', kind='counter')
+    METRICS.gauge('batches_total', "已处理的批次数",
+                  lambda: batch_processor.get_stats()['batches'], kind='counter')
+    METRICS.gauge('dedup_total', "事件去重索引查询次数",
+                  lambda: {key: event_handler.get_dedup_stats()[key] for key in ('hits', 'misses', 'evictions')},
+                  label='result', kind='counter')
+    METRICS.gauge('dedup_entries', "事件去重索引当前条目数",
+                  lambda: event_handler.get_dedup_stats()['entries'])
+
+class BatchQueue:
+    """批处理队列 - 单锁 + 单个唤醒，按数量/时间刷新批次"""
+    
+    def __init__(self, batch_size=10, max_wait=0.5, max_size=None, wait_histogram=None):
+        """
+        初始化批处理队列
+        
+        Args:
+            batch_size: 凑满多少个元素立即刷新
+            max_wait: 第一个元素入队后最多等待多久刷新(秒)
+            max_size: 队列容量上限，None 表示不限制
+            wait_histogram: 记录元素排队时间的直方图，None 表示不记录
+        """
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.max_size = max_size
+        self.wait_histogram = wait_histogram
+        self._items = deque()  # (入队时间, 元素)
+        self._lock = Lock()
+        self._ready = Condition(self._lock)
+        self._not_full = Condition(self._lock)
+        self._closed = False
+        
+    def __len__(self):
+        with self._lock:
+            return len(self._items)
+        
+    def put(self, item, timeout=0):
+        """
+        放入一个元素
+        
+        Args:
+            item: 元素
+            timeout: 队列已满时最多等待多久(秒)，0 表示不等待，None 表示一直等到有空位或队列关闭
+        
+        Returns:
+            bool: 队列已满(等待超时)或已关闭时返回 False
+        """
+        with self._lock:
+            if self.max_size is not None and len(self._items) >= self.max_size and timeout != 0:
+                deadline = None if timeout is None else time.monotonic() + timeout
+                while not self._closed and len(self._items) >= self.max_size:
+                    if deadline is None:
+                        self._not_full.wait()
+                        continue
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._not_full.wait(remaining)
+                    
+            if self._closed:
+                return False
+            if self.max_size is not None and len(self._items) >= self.max_size:
+                return False
+                
+            self._items.append((time.monotonic(), item))
+            
+            # 只在队列由空变为非空(开始计时)或刚好凑满一批时唤醒一个消费者，
+            # 其余情况由取走批次的消费者负责接力唤醒
+            count = len(self._items)
+            if count == 1 or count == self.batch_size:
+                self._ready.notify()
+            return True
+    
+    def get_batch(self, timeout=None):
+        """
+        获取一批元素：凑满 batch_size 个，或第一个元素等待满 max_wait 后立即返回
+        
+        Args:
+            timeout: 队列为空时最多等待多久(秒)，None 表示一直等到有数据或队列关闭
+            
+        Returns:
+            list: 元素列表，超时或队列关闭且为空时返回空列表
+        """
+        idle_deadline = None if timeout is None else time.monotonic() + timeout
+        
+        with self._lock:
+            # 每次被唤醒都重新根据截止时间判断，虚假唤醒只会多算一次
+            while True:
+                if self._items:
+                    if len(self._items) >= self.batch_size or self._closed:
+                        break
+                    remaining = self._items[0][0] + self.max_wait - time.monotonic()
+                else:
+                    if self._closed:
+                        return []
+                    if idle_deadline is None:
+                        self._ready.wait()
+                        continue
+                    remaining = idle_deadline - time.monotonic()
+                    if remaining <= 0:
+                        return []
+                        
+                if remaining <= 0:
+                    break
+                self._ready.wait(remaining)
+            
+            count = min(self.batch_size, len(self._items))
+            entries = [self._items.popleft() for _ in range(count)]
+            self._not_full.notify(count)
+            
+            # 还有剩余元素时接力唤醒下一个消费者
+            if self._items:
+                self._ready.notify()
+                
+        # 排队时间在锁外记录
+        if self.wait_histogram is not None:
+            now = time.monotonic()
+            for enqueued, _ in entries:
+                self.wait_histogram.observe(now - enqueued)
+        return [item for _, item in entries]
+    
+    def configure(self, batch_size, max_wait):
+        """运行中调整批次大小和最长等待时间，唤醒消费者按新参数重新计算截止时间"""
+        with self._lock:
+            self.batch_size = batch_size
+            self.max_wait = max_wait
+            self._ready.notify_all()
+    
+    def close(self):
+        """关闭队列并唤醒所有等待的消费者"""
+        with self._lock:
+            self._closed = True
+            self._ready.notify_all()
+            self._not_full.notify_all()
+
+class SpillQueue:
+    """溢出队列 - 缓冲区满时把文件路径追加写入磁盘，按写入顺序读回"""
+    
+    def __init__(self, path):
+        """
+        初始化溢出队列，文件中残留的记录(上次未处理完)会继续处理
+        
+        Args:
+            path: 队列文件路径
+        """
+        self.path = Path(path)
+        self._lock = Lock()
+        self._read_offset = 0
+        self.depth = 0
+        self.peak_depth = 0
+        self.spilled = 0
+        self.drained = 0
+        
+        if self.path.exists():
+            with open(self.path, 'rb') as f:
+                self.depth = sum(1 for line in f if line.strip())
+            self.peak_depth = self.depth
+            if self.depth:
+                logger.info(f"溢出队列中有 {self.depth} 个上次未处理的文件")
+        
+    def __len__(self):
+        return self.depth
+        
+    def append(self, file_path):
+        """追加一个文件路径"""
+        line = json.dumps(str(file_path), ensure_ascii=False) + '\n'
+        with self._lock:
+            with open(self.path, 'ab') as f:
+                f.write(line.encode('utf-8'))
+            self.depth += 1
+            self.spilled += 1
+            self.peak_depth = max(self.peak_depth, self.depth)
+    
+    def drain(self, put):
+        """
+        按写入顺序取回文件路径，直到 put 返回 False 或队列为空
+        
+        Args:
+            put: 放入回调 put(文件路径)，返回 False 表示暂时没有空位
+            
+        Returns:
+            int: 取回的数量
+        """
+        count = 0
+        with self._lock:
+            if not self.depth:
+                return 0
+                
+            # 二进制模式下 tell 返回真实的字节偏移，可以安全地 seek 回来
+            with open(self.path, 'rb') as f:
+                f.seek(self._read_offset)
+                while True:
+                    line = f.readline()
+                    if not line:
+                        break
+                    if line.strip() and not put(Path(json.loads(line))):
+                        break
+                    self._read_offset = f.tell()
+                    if line.strip():
+                        self.depth -= 1
+                        count += 1
+                        
+            # 全部取回后截断文件，避免无限增长
+            if not self.depth:
+                with open(self.path, 'wb'):
+                    pass
+                self._read_offset = 0
+                
+            self.drained += count
+        return count
+    
+    def take_pending(self):
+        """
+        取出并清空所有未取回的记录，启动时用来把上次残留的文件重新走一遍入队流程
+        
+        Returns:
+            list: 文件路径，按写入顺序
+        """
+        with self._lock:
+            if not self.depth:
+                return []
+                
+            with open(self.path, 'rb') as f:
+                f.seek(self._read_offset)
+                file_paths = [Path(json.loads(line)) for line in f if line.strip()]
+            with open(self.path, 'wb'):
+                pass
+            self._read_offset = 0
+            self.depth = 0
+            self.drained += len(file_paths)
+        return file_paths
+    
+    def get_stats(self):
+        """获取溢出统计"""
+        with self._lock:
+            return {
+                'spill_depth': self.depth,
+                'peak_spill_depth': self.peak_depth,
+                'spilled': self.spilled,
+                'drained': self.drained
+            }
+
+class RetryScheduler:
+    """
+    失败重试调度 - 处理失败的文件按指数退避加随机抖动延后重新入队
+    
+    到期时间放在小顶堆中，由一个定时线程等到最早的到期时间再重新入队，处理线程不等待；
+    没有待重试的文件时定时线程一直等待。失败记录表有容量上限，条目按 TTL 过期；
+    超过最大重试次数的文件进入死信列表，存活期内不再接受
+    """
+    
+    def __init__(self, requeue, max_retries=3, base_delay=1.0, max_delay=60.0, jitter=0.5,
+                 ttl=3600.0, max_entries=10000, dead_letter_size=1000):
+        """
+        初始化重试调度
+        
+        Args:
+            requeue: 到期时的回调 requeue(文件路径)，返回是否重新入队成功
+            max_retries: 最大重试次数，第一次处理之外再重试这么多次仍失败则进入死信列表
+            base_delay: 第一次重试前的等待时间(秒)，之后每次翻倍
+            max_delay: 等待时间上限(秒)
+            jitter: 随机抖动比例，实际等待时间在 [delay * (1 - jitter), delay] 之间
+            ttl: 失败记录的存活时间(秒)，不小于 max_delay
+            max_entries: 失败记录表的最大条目数，超过时淘汰最早更新的条目
+            dead_letter_size: 死信列表保留的条目数
+        """
+        self.requeue = requeue
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.ttl = max(ttl, max_delay)
+        self.max_entries = max_entries
+        self.failures = OrderedDict()  # 文件路径 -> [失败次数, 过期时间, 到期时间或 None]，按更新先后排列
+        self.timers = []  # (到期时间, 文件路径) 小顶堆，与记录表中到期时间不一致的条目在到期时跳过
+        self.dead_letters = deque(maxlen=dead_letter_size)  # (文件路径, 失败次数, 时间戳)
+        self.lock = Lock()
+        self.wakeup = Condition(self.lock)
+        self.should_stop = False
+        self.timer_thread = None
+        self.stats = METRICS.register(Counter('renamer_retry_total', "失败重试调度结果", label='result'))
+        METRICS.gauge('retry_pending', "等待重试的文件数", lambda: self.pending_count())
+        METRICS.gauge('dead_letters', "死信列表中的文件数", lambda: len(self.dead_letters))
+        
+    def stop(self):
+        """停止定时线程，待重试的文件不再入队"""
+        with self.lock:
+            self.should_stop = True
+            self.wakeup.notify()
+        if self.timer_thread is not None:
+            self.timer_thread.join()
+    
+    def failed(self, file_path):
+        """
+        记录一次失败，安排重试或放入死信列表
+        
+        Returns:
+            bool: 是否安排了重试
+        """
+        key = str(file_path)
+        now = time.monotonic()
+        with self.lock:
+            self._expire(now)
+            entry = self.failures.pop(key, None)
+            attempts = entry[0] + 1 if entry is not None else 1
+            if attempts > self.max_retries:
+                self.failures[key] = [attempts, now + self.ttl, None]
+                self.dead_letters.append((key, attempts, time.time()))
+                scheduled = False
+            else:
+                delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+                due = now + delay * (1 - self.jitter * random.random())
+                self.failures[key] = [attempts, now + self.ttl, due]
+                heapq.heappush(self.timers, (due, key))
+                if self.timers[0][1] == key:
+                    self.wakeup.notify()
+                scheduled = True
+            if len(self.failures) > self.max_entries:
+                self.failures.popitem(last=False)
+                self.stats.inc('evicted')
+            # 第一次失败时才启动定时线程
+            if scheduled and self.timer_thread is None and not self.should_stop:
+                self.timer_thread = Thread(target=self._run, daemon=True, name="RetryScheduler")
+                self.timer_thread.start()
+                
+        if scheduled:
+            self.stats.inc('scheduled')
+        else:
+            self.stats.inc('dead_letter')
+            logger.warning(f"文件重试 {self.max_retries} 次后仍失败，放入死信列表: {file_path.name}")
+        return scheduled
+    
+    def succeeded(self, file_path):
+        """处理成功，删除失败记录"""
+        with self.lock:
+            entry = self.failures.pop(str(file_path), None)
+        if entry is not None:
+            self.stats.inc('recovered')
+    
+    def forget(self, file_path):
+        """文件已不存在，删除失败记录"""
+        with self.lock:
+            self.failures.pop(str(file_path), None)
+    
+    def is_dead(self, key):
+        """文件是否在死信列表中且记录未过期"""
+        with self.lock:
+            entry = self.failures.get(key)
+            return entry is not None and entry[2] is None and entry[1] > time.monotonic()
+    
+    def pending_count(self):
+        """等待重试的文件数"""
+        with self.lock:
+            return sum(1 for entry in self.failures.values() if entry[2] is not None)
+    
+    def _expire(self, now):
+        """从最早更新的记录开始移除已过期的记录(需持有锁)"""
+        failures = self.failures
+        while failures:
+            key, entry = next(iter(failures.items()))
+            if entry[1] > now:
+                break
+            del failures[key]
+    
+    def _run(self):
+        """等到最早的到期时间，把到期的文件重新入队"""
+        while True:
+            due = []
+            with self.lock:
+                while not self.should_stop:
+                    if not self.timers:
+                        self.wakeup.wait()
+                        continue
+                    remaining = self.timers[0][0] - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.wakeup.wait(remaining)
+                if self.should_stop:
+                    return
+                    
+                now = time.monotonic()
+                while self.timers and self.timers[0][0] <= now:
+                    deadline, key = heapq.heappop(self.timers)
+                    entry = self.failures.get(key)
+                    # 期间已成功、被淘汰或再次失败(有了新的到期时间)
+                    if entry is None or entry[2] != deadline:
+                        continue
+                    entry[2] = 0  # 已入队，等待结果
+                    due.append(key)
+            
+            # 入队在锁外进行
+            for key in due:
+                if self.requeue(Path(key)):
+                    self.stats.inc('retried')
+    
+    def get_stats(self):
+        """获取重试统计，包括死信列表"""
+        with self.lock:
+            pending = sum(1 for entry in self.failures.values() if entry[2] is not None)
+            failures = len(self.failures)
+            dead_letters = [
+                {'path': key, 'attempts': attempts, 'failed_at': failed_at}
+                for key, attempts, failed_at in self.dead_letters
+            ]
+        return {
+            'retry_pending': pending,
+            'failure_entries': failures,
+            'dead_letters': dead_letters
+        }
+
+class FileBuffer:
+    """文件缓冲区 - 管理待处理文件"""
+    
+    OVERFLOW_POLICIES = ('drop', 'spill', 'block')
+    
+    def __init__(self, max_size=1000, batch_size=10, batch_timeout=0.5, num_shards=1,
+                 overflow='drop', spill_file=".rename_spill", block_timeout=None,
+                 max_retries=3, retry_delay=1.0, retry_max_delay=60.0):
+        """
+        初始化文件缓冲区
+        
+        Args:
+            max_size: 最大缓冲区大小
+            batch_size: 批处理大小
+            batch_timeout: 批处理超时时间(秒)，即第一个文件入队后最多等待多久
+            num_shards: 分片数量，同一目录的文件总是进入同一个分片
+            overflow: 缓冲区满时的策略：drop 丢弃，spill 写入磁盘溢出队列，block 阻塞调用方
+            spill_file: spill 策略下的溢出队列文件
+            block_timeout: block 策略下最多阻塞多久(秒)，None 表示一直等待，超时后丢弃
+            max_retries: 处理失败后最多重试几次
+            retry_delay: 第一次重试前的等待时间(秒)，之后每次翻倍
+            retry_max_delay: 重试等待时间上限(秒)
+        """
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError(f"未知的溢出策略: {overflow}")
+            
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.num_shards = max(1, num_shards)
+        shard_size = -(-max_size // self.num_shards)
+        self.queues = [
+            BatchQueue(batch_size=batch_size, max_wait=batch_timeout, max_size=shard_size, wait_histogram=QUEUE_WAIT)
+            for _ in range(self.num_shards)
+        ]
+        self.lock = Lock()
+        self.processing_files = {}  # 文件路径 -> 入队时间
+        self.retry = RetryScheduler(
+            self._retry, max_retries=max_retries, base_delay=retry_delay, max_delay=retry_max_delay
+        )
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self.spill = SpillQueue(spill_file) if overflow == 'spill' else None
+        self.peak_depth = 0
+        self.blocked = 0
+        self.dropped = 0
+        
+        # 上次遗留在溢出队列中的文件重新经过 add_file，登记处理中记录，避免与事件重复入队；
+        # 读取位置不持久化，上次已取回的记录也会读到，已经不存在的文件直接跳过
+        if self.spill is not None:
+            for file_path in self.spill.take_pending():
+                if os.path.lexists(file_path):
+                    self.add_file(file_path)
+        
+    def shard_for(self, file_path):
+        """按所在目录的哈希选择分片"""
+        if self.num_shards == 1:
+            return 0
+        return zlib.crc32(os.fsencode(os.path.abspath(file_path.parent))) % self.num_shards
+        
+    def add_file(self, file_path):
+        """添加文件到缓冲区"""
+        key = str(file_path)
+        with self.lock:
+            if key in self.processing_files:
+                return False
+                
+            # 已进入死信列表的文件不再接受
+            if self.retry.is_dead(key):
+                logger.debug("文件 %s 已达到最大重试次数，跳过", file_path.name)
+                return False
+                
+            self.processing_files[key] = time.monotonic()
+            
+            # 溢出队列非空时新文件也排到溢出队列末尾，保证顺序
+            spilled = self.spill is not None and (len(self.spill) or not self._put(file_path))
+            if spilled:
+                self.spill.append(file_path)
+            elif self.spill is not None:
+                self._update_peak(file_path)
+                
+        if self.spill is not None:
+            # 取回可能与追加交错，缓冲区已有空位时立即取回，避免文件滞留在溢出队列
+            if spilled and any(len(queue) < queue.max_size for queue in self.queues):
+                self._drain_spill()
+            return True
+        
+        # 入队时只唤醒一个消费者；block 策略在锁外等待空位，不影响其他线程标记结果
+        timeout = 0
+        if self.overflow == 'block':
+            timeout = self.block_timeout
+            
+        if self._put(file_path, timeout):
+            with self.lock:
+                self._update_peak(file_path)
+            return True
+        
+        with self.lock:
+            self.processing_files.pop(key, None)
+            self.dropped += 1
+        logger.warning("缓冲区已满，丢弃文件: %s", file_path.name)
+        return False
+    
+    def _retry(self, file_path):
+        """重试到期，文件仍存在时重新放入缓冲区"""
+        if not file_path.exists():
+            self.retry.forget(file_path)
+            return False
+        if self.add_file(file_path):
+            return True
+        with self.lock:
+            in_progress = str(file_path) in self.processing_files
+        if not in_progress:
+            # 缓冲区已满，按再失败一次继续退避
+            self.retry.failed(file_path)
+        return False
+    
+    def _put(self, file_path, timeout=0):
+        """
+        放入对应分片，不记录峰值深度(由调用方在缓冲区锁内调用 _update_peak)
+        
+        timeout 非 0 时(block 策略)调用方不持有缓冲区锁，分片已满时在锁内记录一次阻塞
+        """
+        queue = self.queues[self.shard_for(file_path)]
+        if timeout != 0 and len(queue) >= queue.max_size:
+            with self.lock:
+                self.blocked += 1
+        return queue.put(file_path, timeout)
+    
+    def _update_peak(self, file_path):
+        """记录文件所在分片的峰值深度，调用方需持有缓冲区锁"""
+        self.peak_depth = max(self.peak_depth, len(self.queues[self.shard_for(file_path)]))
+    
+    def _drain_spill(self):
+        """缓冲区有空位时按顺序取回溢出的文件"""
+        if self.spill is not None and len(self.spill):
+            if self.spill.drain(self._put):
+                # 取回时持有溢出队列的锁，不能再取缓冲区锁，取回后再统一记录峰值
+                with self.lock:
+                    self.peak_depth = max(self.peak_depth, max(len(queue) for queue in self.queues))
+                logger.debug(f"从溢出队列取回文件，剩余: {len(self.spill)}")
+    
+    def shard_depth(self, shard):
+        """获取分片中等待处理的文件数"""
+        return len(self.queues[shard % self.num_shards])
+    
+    def get_batch(self, timeout=None, shard=0):
+        """
+        获取一批文件进行处理
+        
+        Args:
+            timeout: 缓冲区为空时最多等待多久(秒)，None 表示一直等到有文件或缓冲区关闭
+            shard: 从哪个分片获取
+        """
+        batch = self.queues[shard % self.num_shards].get_batch(timeout)
+        if batch:
+            self._drain_spill()
+        return batch
+    
+    def set_batch_params(self, batch_size, batch_timeout):
+        """调整所有分片的批次大小和超时时间"""
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        for queue in self.queues:
+            queue.configure(batch_size, batch_timeout)
+    
+    def close(self):
+        """关闭缓冲区，唤醒所有等待中的处理线程，停止重试调度"""
+        for queue in self.queues:
+            queue.close()
+        self.retry.stop()
+    
+    def claim(self, file_paths):
+        """
+        不经过队列直接占用一组文件(存量补编号)，与 add_file 使用同一份处理中记录，
+        占用期间事件和对账扫描不会再把它们放入缓冲区，处理完后调用 release
+        
+        Returns:
+            list: 成功占用的文件(不在处理中也不在死信列表中)
+        """
+        claimed = []
+        now = time.monotonic()
+        with self.lock:
+            for file_path in file_paths:
+                key = str(file_path)
+                if key in self.processing_files or self.retry.is_dead(key):
+                    continue
+                self.processing_files[key] = now
+                claimed.append(file_path)
+        return claimed
+    
+    def release(self, file_paths):
+        """释放 claim 占用的文件"""
+        with self.lock:
+            for file_path in file_paths:
+                self.processing_files.pop(str(file_path), None)
+    
+    def mark_success(self, file_path):
+        """标记文件处理成功"""
+        key = str(file_path)
+        with self.lock:
+            enqueued = self.processing_files.pop(key, None)
+        self.retry.succeeded(file_path)
+        if enqueued is not None:
+            CREATE_TO_RENAME.observe(time.monotonic() - enqueued)
+    
+    def mark_failed(self, file_path):
+        """标记文件处理失败，按退避时间安排重试"""
+        key = str(file_path)
+        with self.lock:
+            self.processing_files.pop(key, None)
+        self.retry.failed(file_path)
+                
+    def get_stats(self):
+        """获取缓冲区统计信息"""
+        with self.lock:
+            stats = {
+                'buffer_size': sum(len(queue) for queue in self.queues),
+                'peak_buffer_size': self.peak_depth,
+                'processing_count': len(self.processing_files),
+                'blocked': self.blocked,
+                'dropped': self.dropped
+            }
+        stats.update(self.retry.get_stats())
+        if self.spill is not None:
+            stats.update(self.spill.get_stats())
+        return stats
+
+class SequenceJournal:
+    """序号日志 - 持久化计数器，避免启动时扫描整个目录"""
+    
+    VERSION = 1
+    
+    def __init__(self, path, signature, checkpoint_interval=100):
+        """
+        初始化序号日志
+        
+        Args:
+            path: 日志文件路径
+            signature: 计数规则签名(序号位数、匹配模式等)，不一致时日志作废
+            checkpoint_interval: 每分配多少个序号写一次检查点
+        """
+        self.path = Path(path)
+        self.signature = signature
+        self.checkpoint_interval = max(1, checkpoint_interval)
+        self.reserved = 0  # 已持久化的序号上限
+        
+    def load(self):
+        """
+        读取日志中的计数器
+        
+        异常退出时日志中只有预留的上限，直接从上限继续分配，
+        宁可留下空号也不会重复编号
+        
+        Returns:
+            int | None: 计数器值，日志不存在或未通过一致性检查时返回 None
+        """
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"序号日志损坏，将重新扫描目录: {e}")
+            return None
+            
+        try:
+            if state['version'] != self.VERSION or state['signature'] != self.signature:
+                logger.info("序号日志与当前配置不一致，将重新扫描目录")
+                return None
+            counter = int(state['counter'])
+            reserved = int(state['reserved'])
+        except (KeyError, TypeError, ValueError) as e:
+            logger.warning(f"序号日志内容无效，将重新扫描目录: {e}")
+            return None
+            
+        if counter < 0 or reserved < counter:
+            logger.warning("序号日志数值不一致，将重新扫描目录")
+            return None
+            
+        return counter if state.get('clean') else reserved
+    
+    def checkpoint(self, counter, clean=False):
+        """
+        写入检查点：先写临时文件并 fsync，再原子替换
+        
+        Args:
+            counter: 当前计数器
+            clean: 是否为正常退出时写入
+        """
+        reserved = counter if clean else counter + self.checkpoint_interval
+        state = {
+            'version': self.VERSION,
+            'signature': self.signature,
+            'counter': counter,
+            'reserved': reserved,
+            'clean': clean
+        }
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+            self._fsync_dir()
+            self.reserved = reserved
+        except OSError as e:
+            logger.warning(f"写入序号日志失败: {e}")
+    
+    def record(self, counter):
+        """分配序号后调用，超出已持久化的上限时写入新的检查点"""
+        if counter >= self.reserved:
+            self.checkpoint(counter)
+    
+    def _fsync_dir(self):
+        """同步日志所在目录，保证 rename 落盘"""
+        if not hasattr(os, 'O_DIRECTORY'):
+            return
+        fd = os.open(self.path.parent, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+class IntentJournal:
+    """
+    重命名意图日志 - 追加写入 (原文件名, 分配的文件名) 意图，整批一次 fsync
+    
+    重命名前先落盘意图，完成记录只追加不 fsync；启动时按文件系统的实际状态
+    重放未完成的意图，使每个分配出去的序号恰好落到一个文件上
+    """
+    
+    def __init__(self, path, compact_threshold=10000):
+        """
+        初始化意图日志
+        
+        Args:
+            path: 日志文件路径
+            compact_threshold: 没有未完成意图且记录数超过该值时清空日志
+        """
+        self.path = Path(path)
+        self.compact_threshold = compact_threshold
+        self._lock = Lock()
+        self._file = None
+        self._records = 0
+        self.pending = set()  # 已落盘但未完成的意图 (原文件名, 新文件名)
+        self.commits = 0
+        
+    def replay(self, directory, temp_dir=None):
+        """
+        重放上次未完成的意图
+        
+        目标文件已存在说明重命名已完成；文件停在临时目录或仍在原位置时
+        用日志中的序号完成重命名(前滚)；文件已不存在时忽略
+        
+        Args:
+            directory: 意图所在目录
+            temp_dir: 临时目录名称，直接重命名模式为 None
+            
+        Returns:
+            dict: {'completed': 已完成, 'rolled_forward': 前滚, 'missing': 文件已不存在}
+        """
+        pending = {}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        op, src, dst = json.loads(line)
+                    except ValueError:
+                        # 崩溃时最后一行可能只写了一半，该意图没有提交，对应文件未被移动
+                        continue
+                    if op == 'intent':
+                        pending[src] = dst
+                    elif pending.get(src) == dst:
+                        del pending[src]
+        except FileNotFoundError:
+            return {'completed': 0, 'rolled_forward': 0, 'missing': 0}
+        
+        result = {'completed': 0, 'rolled_forward': 0, 'missing': 0}
+        directory = Path(directory)
+        for src, dst in pending.items():
+            dst_path = directory / dst
+            candidates = [directory / src]
+            if temp_dir is not None:
+                candidates.insert(0, directory / temp_dir / src)
+                
+            if dst_path.exists():
+                result['completed'] += 1
+                continue
+            
+            for src_path in candidates:
+                try:
+                    move_noreplace(src_path, dst_path)
+                except FileNotFoundError:
+                    continue
+                except OSError as e:
+                    logger.warning(f"前滚重命名失败 {src} -> {dst}: {e}")
+                    break
+                logger.info(f"前滚未完成的重命名: {src} -> {dst}")
+                result['rolled_forward'] += 1
+                break
+            else:
+                result['missing'] += 1
+        
+        if pending:
+            logger.info(
+                f"意图日志重放 ({directory}) - 已完成: {result['completed']}, "
+                f"前滚: {result['rolled_forward']}, 文件已不存在: {result['missing']}"
+            )
+        
+        # 重放后清空日志，之后的记录从头追加
+        with self._lock:
+            self._truncate()
+        return result
+    
+    def log_intents(self, entries):
+        """
+        追加一批意图并 fsync 一次，返回后才能开始重命名
+        
+        Args:
+            entries: [(原文件名, 新文件名)]
+        """
+        if not entries:
+            return
+        data = ''.join(json.dumps(['intent', src, dst], ensure_ascii=False) + '\n' for src, dst in entries)
+        with self._lock:
+            f = self._open()
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+            self._records += len(entries)
+            self.pending.update(entries)
+            self.commits += 1
+    
+    def log_done(self, src, dst):
+        """追加完成记录，不 fsync：丢失时重放会根据文件系统状态判断为已完成"""
+        with self._lock:
+            if (src, dst) not in self.pending:
+                return
+            self.pending.discard((src, dst))
+            self._open().write(json.dumps(['done', src, dst], ensure_ascii=False) + '\n')
+            self._records += 1
+    
+    def flush(self):
+        """批次结束时把完成记录写入操作系统，没有未完成意图且日志过大时清空"""
+        with self._lock:
+            if self._file is None:
+                return
+            if not self.pending and self._records >= self.compact_threshold:
+                self._truncate()
+            else:
+                self._file.flush()
+    
+    def close(self):
+        """正常退出时关闭日志，没有未完成意图时清空"""
+        with self._lock:
+            if not self.pending:
+                self._truncate()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+    
+    def _open(self):
+        """打开日志文件用于追加(需持有锁)"""
+        if self._file is None:
+            self._file = open(self.path, 'a', encoding='utf-8')
+        return self._file
+    
+    def _truncate(self):
+        """清空日志(需持有锁)"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        elif not self.path.exists():
+            return
+        with open(self.path, 'w', encoding='utf-8') as f:
+            os.fsync(f.fileno())
+        self._records = 0
+
+class CounterLease:
+    """
+    序号租约 - 多个进程通过 fcntl 加锁的状态文件按块分配同一目录的序号
+    
+    状态文件只记录下一个未分配的序号。每个进程一次租下一整块，块内的序号
+    在进程内分配，不再跨进程协调；进程退出时如果自己的块仍是最后一块，
+    把没用完的序号还回去，否则留下空号
+    """
+    
+    VERSION = 1
+    
+    def __init__(self, path, signature, block_size=100):
+        """
+        初始化序号租约
+        
+        Args:
+            path: 状态文件路径
+            signature: 计数规则签名，与状态文件不一致时重新扫描目录
+            block_size: 每次租下的序号数
+        """
+        self.path = Path(path)
+        self.signature = signature
+        self.block_size = max(1, block_size)
+    
+    def acquire(self, scan, count=1):
+        """
+        租下一块序号
+        
+        Args:
+            scan: 状态文件不存在或无效时调用，返回目录中已有的最大序号
+            count: 至少需要的序号数
+            
+        Returns:
+            tuple: (第一个序号, 块结束序号(不含))
+        """
+        with open(self.path, 'a+', encoding='utf-8') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                first = self._read(f)
+                if first is None:
+                    first = scan() + 1
+                end = first + max(self.block_size, count)
+                self._write(f, end)
+                return first, end
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    
+    def release(self, next_unused, end):
+        """正常退出时，块仍是最后一块则还回没用完的序号"""
+        try:
+            with open(self.path, 'a+', encoding='utf-8') as f:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                try:
+                    if self._read(f) == end:
+                        self._write(f, next_unused)
+                finally:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        except OSError as e:
+            logger.warning(f"归还序号租约失败: {e}")
+    
+    def _read(self, f):
+        """读取下一个未分配的序号，文件为空或无效时返回 None(需持有锁)"""
+        f.seek(0)
+        content = f.read()
+        if not content:
+            return None
+        try:
+            state = json.loads(content)
+            if state['version'] != self.VERSION or state['signature'] != self.signature:
+                logger.info("序号租约与当前配置不一致，将重新扫描目录")
+                return None
+            return int(state['next'])
+        except (KeyError, TypeError, ValueError) as e:
+            logger.warning(f"序号租约内容无效，将重新扫描目录: {e}")
+            return None
+    
+    def _write(self, f, next_value):
+        """原地写入下一个未分配的序号并落盘(需持有锁)"""
+        f.seek(0)
+        f.truncate()
+        json.dump({'version': self.VERSION, 'signature': self.signature, 'next': next_value}, f)
+        f.flush()
+        os.fsync(f.fileno())
+
+class DirectoryCounter:
+    """单个目录的序号计数器"""
+    
+    PROBE_COUNT = 16  # 信任序号日志前探测其后多少个序号
+    
+    def __init__(self, directory, renamed_files_pattern, journal=None, lease=None, probe=None):
+        """
+        初始化目录计数器
+        
+        Args:
+            directory: 目录路径(绝对路径)
+            renamed_files_pattern: 匹配已重命名文件的正则表达式
+            journal: 该目录的序号日志，为 None 时每次启动都扫描目录
+            lease: 多实例共享目录时的序号租约，设置后不使用序号日志
+            probe: probe(序号) 返回该序号可能对应的文件名列表，用于检查序号日志是否过时，
+                None 表示无法探测(自定义正则)，此时总是扫描目录
+        """
+        self.directory = Path(directory)
+        self.renamed_files_pattern = renamed_files_pattern
+        self.journal = journal
+        self.lease = lease
+        self.probe = probe
+        self.limit = 0  # 租约模式下当前块的结束序号(不含)
+        self.value = 0
+        self.lock = Lock()  # 专门用于计数器的锁，每个目录一把
+        
+    def initialize(self):
+        """初始化计数器，基于序号租约、序号日志或已存在的文件"""
+        if self.lease is not None:
+            self._renew()
+            logger.info(f"计数器从序号租约分配: {self.value + 1} ~ {self.limit - 1} ({self.directory})")
+            return
+        
+        if self.journal is not None:
+            counter = self.journal.load()
+            if counter is not None and not self._journal_current(counter):
+                counter = None
+            if counter is not None:
+                self.value = counter
+                self.journal.checkpoint(self.value)
+                logger.info(f"计数器从序号日志恢复为: {self.value} ({self.directory})")
+                return
+        
+        self.value = self._scan()
+        logger.info(f"计数器初始化为: {self.value} ({self.directory})")
+        
+        if self.journal is not None:
+            self.journal.checkpoint(self.value)
+    
+    def _journal_current(self, counter):
+        """
+        检查序号日志之后的几个序号是否空闲，停止监控期间加入了已编号文件时日志已过时
+        
+        Returns:
+            bool: 是否可以信任序号日志
+        """
+        if self.probe is None:
+            return False
+        for number in range(counter + 1, counter + 1 + self.PROBE_COUNT):
+            for name in self.probe(number):
+                if os.path.lexists(self.directory / name):
+                    logger.info(f"序号 {number} 已被 {name} 占用，序号日志已过时，将重新扫描目录")
+                    return False
+        return True
+    
+    def _scan(self):
+        """扫描目录，返回已有文件的最大序号"""
+        max_num = 0
+        
+        # 扫描目录所有文件，DirEntry 自带类型信息，无需逐个 stat
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                # 使用精确匹配检查文件名是否符合序号格式
+                if not self.renamed_files_pattern.search(entry.name):
+                    continue
+                if not entry.is_file():
+                    continue
+                try:
+                    # 提取数字部分(不带后缀的文件名)
+                    num = int(os.path.splitext(entry.name)[0])
+                    max_num = max(max_num, num)
+                except ValueError:
+                    # 如果不能转换为数字，跳过
+                    continue
+        return max_num
+    
+    def _renew(self, count=1):
+        """当前块剩余的序号不够时租下新的一块，剩余的序号留空(需持有锁或在初始化中)"""
+        first, self.limit = self.lease.acquire(self._scan, count)
+        self.value = first - 1
+    
+    def next(self):
+        """分配下一个序号"""
+        with self.lock:
+            if self.lease is not None and self.value + 1 >= self.limit:
+                self._renew()
+            self.value += 1
+            if self.journal is not None:
+                self.journal.record(self.value)
+            return self.value
+    
+    def reserve(self, count):
+        """
+        一次预留 count 个连续序号，只写一次序号日志
+        
+        Returns:
+            int: 第一个序号
+        """
+        with self.lock:
+            if self.lease is not None and self.value + count >= self.limit:
+                self._renew(count)
+            first = self.value + 1
+            self.value += count
+            if self.journal is not None:
+                self.journal.record(self.value)
+            return first
+    
+    def close(self):
+        """正常退出时写入精确的计数器，或归还租约中没用完的序号"""
+        if self.lease is not None:
+            with self.lock:
+                self.lease.release(self.value + 1, self.limit)
+        if self.journal is not None:
+            with self.lock:
+                self.journal.checkpoint(self.value, clean=True)
+
+class BatchAction:
+    """
+    批处理动作接口 - 监控流水线(缓冲、去重、批处理、处理线程)对每批文件执行的操作
+    
+    子类用 register_action 注册后可按名称创建。FileMonitorHandler 和 ReconcileScanner
+    只调用 filter(对账扫描递归时另外跳过 ignored_dirs)，BatchFileProcessor 和 AsyncPipeline
+    只调用 process_batch；Backfiller 按目录预留序号，只能用于 supports_backfill 的动作
+    """
+    
+    name = None
+    max_concurrency = None  # 同时处理的批次数上限，None 表示只受处理线程数限制
+    ignored_dirs = frozenset()  # 递归扫描时跳过的子目录名(动作自己的内部目录)
+    supports_backfill = False  # 是否支持 Backfiller 存量补编号
+    
+    def filter(self, file_path):
+        """
+        判断事件中的文件是否需要处理
+        
+        Args:
+            file_path: 文件路径(Path)
+            
+        Returns:
+            str | None: None 表示需要处理，否则为跳过原因，作为事件统计键 skipped_<原因>
+        """
+        return None
+    
+    def process_batch(self, file_paths, on_complete=None):
+        """
+        处理一批文件，可在多个处理线程中同时调用(不超过 max_concurrency)
+        
+        Args:
+            file_paths: 文件路径列表
+            on_complete: 每个文件处理完成时的回调 on_complete(文件路径, 成功/失败)
+            
+        Returns:
+            dict: 处理结果 {文件路径: 成功/失败}
+        """
+        raise NotImplementedError
+    
+    def recover(self):
+        """启动监控前调用，恢复上次异常退出时未完成的工作"""
+    
+    def close(self):
+        """停止后调用，释放资源"""
+
+ACTIONS = {}  # 动作名称 -> 动作类
+
+def register_action(cls):
+    """注册批处理动作的类装饰器，按 cls.name 索引"""
+    ACTIONS[cls.name] = cls
+    return cls
+
+def create_action(name, *args, **kwargs):
+    """
+    按名称创建已注册的批处理动作
+    
+    Raises:
+        ValueError: 动作未注册
+    """
+    cls = ACTIONS.get(name)
+    if cls is None:
+        raise ValueError(f"未知的批处理动作: {name}")
+    return cls(*args, **kwargs)
+
+@register_action
+class FileRenamer(BatchAction):
+    """按目录顺序编号重命名文件"""
+    
+    name = "rename"
+    supports_backfill = True
+    
+    def __init__(self, pattern, digit_count=3, flags=0, temp_dir=".temp_rename", max_filename_length=255,
+                 journal_file=".rename_seq", checkpoint_interval=100, direct_rename=False, directories=('.',),
+                 intent_file=".rename_intent", extensions=None, instance=None, lease_file=".rename_lease",
+                 lease_size=100):
+        """
+        初始化文件重命名器
+        
+        Args:
+            pattern: 文件后缀正则表达式模式
+            digit_count: 序号位数
+            flags: 正则表达式标志
+            temp_dir: 临时目录名称，在每个被处理的目录下创建
+            max_filename_length: 最大文件名长度限制
+            journal_file: 序号日志文件名，在每个被处理的目录下创建，为空时每次启动都扫描目录
+            checkpoint_interval: 每分配多少个序号写一次序号日志
+            direct_rename: 是否跳过临时目录，一次原子移动直接重命名为最终文件名
+            directories: recover 时即初始化计数器的目录，其他目录在第一次出现文件时初始化
+            intent_file: 重命名意图日志文件名，在每个被处理的目录下创建，为空时不记录意图
+            extensions: pattern 由后缀列表生成时传入该列表，用集合查找代替正则匹配
+            instance: 多个进程共享目录时本进程的 (编号, 实例总数)，按文件名哈希分担文件，
+                序号通过 lease_file 按块租用，临时目录和意图日志按实例区分
+            lease_file: 多实例模式下的序号租约文件名，在每个被处理的目录下创建
+            lease_size: 多实例模式下每次租用的序号数
+        """
+        self.pattern = re.compile(pattern, flags)
+        self.digit_count = digit_count
+        self.instance = instance
+        self.lease_file = lease_file
+        self.lease_size = lease_size
+        if instance is not None:
+            index, count = instance
+            self.temp_dir = Path(f"{temp_dir}.{index}")
+            if intent_file:
+                intent_file = f"{intent_file}.{index}"
+        else:
+            self.temp_dir = Path(temp_dir)
+        self.max_filename_length = max_filename_length
+        self.renamed_files_pattern = re.compile(r'^\d{' + str(digit_count) + r'}' + pattern)  # 精确匹配已重命名文件
+        self.ignore_case = bool(flags & re.IGNORECASE)
+        self.extensions = None  # 后缀集合，None 表示使用正则匹配
+        self.numbered_extensions = None  # 已编号判断不受 flags 影响，区分大小写
+        if extensions is not None:
+            self.extensions = frozenset(ext.lower() if self.ignore_case else ext for ext in extensions)
+            self.numbered_extensions = frozenset(extensions)
+        self.executor = None  # 可选的并行重命名执行器，见 RenameExecutor
+        self.deduplicator = None  # 可选的内容去重，见 ContentDeduplicator
+        self.ignored_dirs = {self.temp_dir.name}  # 不处理其中文件的子目录名
+        if instance is not None:
+            # 其他实例的临时目录
+            self.ignored_dirs.update(f"{Path(temp_dir).name}.{i}" for i in range(instance[1]))
+        self.access_attempts = 2  # 可访问性检查的尝试次数，文件已确认稳定时设为 1，不在处理线程中等待
+        self.direct_rename = direct_rename
+        self.inflight = {}  # 直接重命名模式下正在处理的文件路径 -> 过期时间，用于过滤自身产生的事件
+        self.inflight_expiry = deque()  # (过期时间, 文件路径)，按过期时间先后排列
+        self.inflight_lock = Lock()
+        self.inflight_grace = 2.0
+        
+        self.journal_file = journal_file
+        self.checkpoint_interval = checkpoint_interval
+        self.journal_signature = f"{digit_count}:{flags}:{pattern}"
+        self.intent_file = intent_file
+        self.intent_journals = {}  # 目录(绝对路径) -> 意图日志
+        
+        # 每个目录独立计数，互不争用同一把锁
+        self.counters = {}
+        self.counters_lock = Lock()
+        self.initial_directories = list(directories)
+    
+    def recover(self):
+        """重放各监控目录上次未完成的重命名并初始化计数器"""
+        for directory in self.initial_directories:
+            self.get_counter(directory)
+        
+    def get_counter(self, directory):
+        """
+        获取目录的计数器，第一次访问时创建临时目录并初始化计数器
+        
+        Args:
+            directory: 目录路径
+            
+        Returns:
+            DirectoryCounter: 目录计数器
+        """
+        key = os.path.abspath(directory)
+        counter = self.counters.get(key)
+        if counter is not None:
+            return counter
+            
+        with self.counters_lock:
+            counter = self.counters.get(key)
+            if counter is None:
+                journal = None
+                lease = None
+                if self.instance is not None:
+                    lease = CounterLease(
+                        os.path.join(key, self.lease_file), self.journal_signature, self.lease_size
+                    )
+                elif self.journal_file:
+                    journal = SequenceJournal(
+                        os.path.join(key, self.journal_file), self.journal_signature, self.checkpoint_interval
+                    )
+                probe = self._probe_names if self.numbered_extensions is not None else None
+                counter = DirectoryCounter(key, self.renamed_files_pattern, journal, lease, probe)
+                
+                # 创建临时目录(直接重命名模式不需要)
+                if not self.direct_rename:
+                    (counter.directory / self.temp_dir).mkdir(exist_ok=True)
+                
+                # 先重放上次未完成的重命名，扫描目录时才能看到它们的序号
+                if self.intent_file:
+                    intents = IntentJournal(os.path.join(key, self.intent_file))
+                    intents.replay(key, None if self.direct_rename else self.temp_dir)
+                    self.intent_journals[key] = intents
+                
+                # 初始化计数器：优先读取序号日志，否则找到已存在文件的最大序号
+                counter.initialize()
+                self.counters[key] = counter
+            return counter
+    
+    def directories(self):
+        """获取所有已初始化的目录"""
+        with self.counters_lock:
+            return [counter.directory for counter in self.counters.values()]
+    
+    def close(self):
+        """正常退出时写入每个目录精确的计数器，关闭意图日志"""
+        with self.counters_lock:
+            counters = list(self.counters.values())
+            intent_journals = list(self.intent_journals.values())
+        for counter in counters:
+            counter.close()
+        for intents in intent_journals:
+            intents.close()
+    
+    def cleanup_temp_dirs(self):
+        """将各目录临时目录中残留的文件移回原位置，并删除临时目录"""
+        for directory in self.directories():
+            temp_dir = directory / self.temp_dir
+            if not temp_dir.exists():
+                continue
+            try:
+                # 先将临时目录中的文件移回原位置
+                for temp_file in temp_dir.iterdir():
+                    if temp_file.is_file():
+                        try:
+                            temp_file.rename(directory / temp_file.name)
+                            logger.info(f"恢复文件: {temp_file.name}")
+                        except Exception as e:
+                            logger.warning(f"恢复文件 {temp_file.name} 失败: {e}")
+                
+                shutil.rmtree(temp_dir)
+                logger.info(f"已清理临时目录: {temp_dir}")
+            except Exception as e:
+                logger.warning(f"清理临时目录时出错: {e}")
+    
+    def log_intents(self, assignments):
+        """
+        重命名前按目录写入一批意图，每个目录 fsync 一次
+        
+        Args:
+            assignments: [(文件路径, 新文件名)]
+        """
+        if not self.intent_file:
+            return
+        by_directory = defaultdict(list)
+        for file_path, new_filename in assignments:
+            by_directory[os.path.abspath(file_path.parent)].append((file_path.name, new_filename))
+        for directory, entries in by_directory.items():
+            self.intent_journals[directory].log_intents(entries)
+    
+    def complete_intent(self, file_path, new_filename):
+        """重命名结束(无论成败)后追加完成记录"""
+        if self.intent_file:
+            self.intent_journals[os.path.abspath(file_path.parent)].log_done(file_path.name, new_filename)
+    
+    def finish_rename(self, file_path, new_filename, success):
+        """重命名结束(或未分配序号就失败，此时 new_filename 为 None)后更新意图日志和内容索引"""
+        if new_filename is not None:
+            self.complete_intent(file_path, new_filename)
+        if self.deduplicator is not None:
+            self.deduplicator.record(file_path, new_filename, success)
+    
+    def flush_intents(self, file_paths):
+        """批次结束时刷新相关目录的意图日志"""
+        if not self.intent_file:
+            return
+        for directory in {os.path.abspath(file_path.parent) for file_path in file_paths}:
+            intents = self.intent_journals.get(directory)
+            if intents is not None:
+                intents.flush()
+    
+    def _probe_names(self, number):
+        """序号可能对应的已编号文件名，只在后缀列表已知时可用"""
+        num_str = str(number).zfill(self.digit_count)
+        return [f"{num_str}.{ext}" for ext in self.numbered_extensions]
+    
+    def get_next_filename(self, original_ext, directory='.'):
+        """获取目录中的下一个文件名"""
+        num_str = str(self.get_counter(directory).next()).zfill(self.digit_count)
+        return f"{num_str}{original_ext}"
+    
+    def is_temp_path(self, file_path):
+        """检查路径是否位于临时目录等内部目录中(递归监控时会收到这些目录内的事件)"""
+        return file_path.parent.name in self.ignored_dirs
+    
+    def is_inflight(self, file_path):
+        """检查文件是否是直接重命名模式下正在处理或刚处理完的文件"""
+        if not self.direct_rename:
+            return False
+        key = os.path.abspath(file_path)
+        with self.inflight_lock:
+            expires = self.inflight.get(key)
+            if expires is None:
+                return False
+            if expires < time.monotonic():
+                del self.inflight[key]
+                return False
+            return True
+    
+    def should_process(self, filename):
+        """检查文件是否符合处理条件"""
+        return self.classify(filename) is None
+    
+    def filter(self, file_path):
+        """判断事件中的文件是否需要重命名，见 BatchAction.filter"""
+        # 临时目录中的文件(递归监控时)
+        if self.is_temp_path(file_path):
+            return 'temp'
+        # 直接重命名模式下自身产生的事件
+        if self.is_inflight(file_path):
+            return 'inflight'
+        reason = self.classify(file_path.name)
+        # 已判定为内容重复、保留原文件名的文件
+        if reason is None and self.deduplicator is not None and self.deduplicator.is_duplicate(file_path):
+            return 'content_duplicate'
+        return reason
+    
+    def classify(self, filename):
+        """
+        一次判断文件名是否需要处理，不需要时给出原因
+        
+        只看文件名本身；临时目录等内部目录中的文件由 filter 按所在目录(is_temp_path)排除，
+        文件名中恰好包含临时目录名的普通文件照常处理
+        
+        Args:
+            filename: 文件名
+            
+        Returns:
+            str | None: None 表示需要处理，否则为跳过原因：
+                too_long / wrong_extension / already_numbered / hidden / other_instance
+        """
+        # 检查文件名长度是否超过限制
+        if len(filename) > self.max_filename_length:
+            logger.warning(f"文件名过长，跳过处理: {filename} (长度: {len(filename)})")
+            return 'too_long'
+        
+        if self.extensions is not None:
+            # 后缀列表：取最后一个点之后的部分查集合，与 "\.后缀$" 的正则等价
+            dot = filename.rfind('.')
+            if dot < 0:
+                return 'wrong_extension'
+            suffix = filename[dot + 1:]
+            if (suffix.lower() if self.ignore_case else suffix) not in self.extensions:
+                return 'wrong_extension'
+            # 只有 "数字+后缀" 格式的文件才被认为是已编号的
+            if (dot == self.digit_count and suffix in self.numbered_extensions
+                    and filename[:dot].isdecimal()):
+                logger.debug("文件已编号，跳过: %s", filename)
+                return 'already_numbered'
+        else:
+            # 检查文件后缀是否符合要求
+            if not self.pattern.search(filename):
+                return 'wrong_extension'
+                
+            # 使用精确匹配检查是否已编号，而不是简单的数字开头
+            if self.renamed_files_pattern.match(filename):
+                logger.debug("文件已编号，跳过: %s", filename)
+                return 'already_numbered'
+            
+        # 不是以点开头的隐藏文件
+        if filename.startswith('.'):
+            return 'hidden'
+        
+        # 多实例时按文件名哈希分担，同一文件总是由同一个实例处理
+        if self.instance is not None and zlib.crc32(os.fsencode(filename)) % self.instance[1] != self.instance[0]:
+            return 'other_instance'
+            
+        return None
+    
+    def process_batch(self, file_paths, on_complete=None):
+        """
+        批量处理文件
+        
+        Args:
+            file_paths: 文件路径列表
+            on_complete: 每个文件处理完成时的回调 on_complete(文件路径, 成功/失败)
+            
+        Returns:
+            dict: 处理结果 {文件路径: 成功/失败}
+        """
+        # 内容重复的文件不分配序号，等其他文件重命名完成后再处理
+        duplicates = []
+        if self.deduplicator is not None:
+            file_paths, duplicates = self.deduplicator.filter_batch(file_paths)
+            
+        if self.executor is not None:
+            results = self.executor.run_batch(file_paths, on_complete)
+        else:
+            results = self._process_serial(file_paths, on_complete)
+            
+        if duplicates:
+            results.update(self.deduplicator.resolve(duplicates, on_complete))
+        return results
+    
+    process_files_batch = process_batch  # 旧名称
+    
+    def _process_serial(self, file_paths, on_complete=None):
+        """在当前线程中逐个处理文件"""
+        results = {}
+        
+        # 先检查并分配序号，整批意图落盘后再重命名
+        assignments = []
+        for file_path in file_paths:
+            new_filename = self._prepare_file(file_path)
+            if new_filename is None:
+                results[file_path] = False
+                self.finish_rename(file_path, None, False)
+                if on_complete is not None:
+                    on_complete(file_path, False)
+            else:
+                assignments.append((file_path, new_filename))
+        
+        try:
+            self.log_intents(assignments)
+        except OSError as e:
+            # 意图未落盘时不能重命名，已分配的序号留空
+            logger.error(f"写入意图日志失败，本批次不重命名: {e}")
+            for file_path, new_filename in assignments:
+                results[file_path] = False
+                self.finish_rename(file_path, new_filename, False)
+                if on_complete is not None:
+                    on_complete(file_path, False)
+            return results
+        
+        for file_path, new_filename in assignments:
+            try:
+                results[file_path] = self._rename_file(file_path, new_filename)
+            except Exception as e:
+                logger.error(f"处理文件 {file_path.name} 时发生未知错误: {e}")
+                results[file_path] = False
+            self.finish_rename(file_path, new_filename, results[file_path])
+            if on_complete is not None:
+                on_complete(file_path, results[file_path])
+        
+        self.flush_intents(file_paths)
+        return results
+    
+    def _prepare_file(self, file_path):
+        """
+        串行处理单个文件的前半部分：检查、分配序号
+        
+        Returns:
+            str | None: 新文件名，文件不可访问或出错时返回 None
+        """
+        try:
+            # 记录文件信息用于诊断
+            file_info = self._get_file_info(file_path)
+            logger.debug(f"处理文件: {file_info}")
+            
+            # 快速检查文件是否可访问
+            if not self._is_file_accessible(file_path, max_attempts=self.access_attempts):
+                logger.warning(f"文件不可访问: {file_path.name}")
+                return None
+                
+            # 生成新文件名
+            return self.get_next_filename(file_path.suffix, file_path.parent)
+            
+        except Exception as e:
+            logger.error(f"处理文件 {file_path.name} 时发生未知错误: {e}")
+            return None
+    
+    def _rename_file(self, file_path, new_filename):
+        """
+        将文件重命名为已分配的新文件名
+        
+        Args:
+            file_path: 文件路径
+            new_filename: 新文件名
+            
+        Returns:
+            bool: 是否成功
+        """
+        new_filepath = file_path.parent / new_filename
+        
+        # 检查新文件名长度
+        if len(new_filename) > self.max_filename_length:
+            logger.error(f"新文件名过长，无法重命名: {new_filename} (长度: {len(new_filename)})")
+            return False
+        
+        if self.direct_rename:
+            return self._rename_direct(file_path, new_filepath)
+        
+        # 先将文件移动到所在目录的临时目录，避免被重复检测
+        temp_filepath = file_path.parent / self.temp_dir / file_path.name
+        started = time.perf_counter()
+        try:
+            file_path.rename(temp_filepath)
+        except (OSError, IOError) as e:
+            logger.warning(f"无法移动文件到临时目录 {file_path.name}: {e}")
+            return False
+        
+        # 从临时目录重命名到目标位置，目标已存在(序号被外部文件占用)时不覆盖
+        try:
+            move_noreplace(temp_filepath, new_filepath)
+            RENAME_SECONDS.observe(time.perf_counter() - started)
+            logger.info(f"重命名: {file_path.name} -> {new_filename}")
+            return True
+        except (OSError, IOError) as e:
+            logger.warning(f"无法从临时目录重命名文件 {file_path.name}: {e}")
+            # 尝试将文件移回原位置
+            try:
+                temp_filepath.rename(file_path)
+            except Exception as restore_error:
+                logger.error(f"恢复文件失败 {file_path.name}: {restore_error}")
+            return False
+    
+    def _rename_direct(self, file_path, new_filepath):
+        """
+        一次原子移动直接重命名到最终文件名，不覆盖已存在的文件
+        
+        Args:
+            file_path: 文件路径
+            new_filepath: 目标路径
+            
+        Returns:
+            bool: 是否成功
+        """
+        source_key = os.path.abspath(file_path)
+        target_key = os.path.abspath(new_filepath)
+        
+        # 处理期间两个路径都标记为处理中；完成后只有目标路径保留一段时间(事件到达有延迟)，
+        # 源路径立即移除，之后同名的新文件照常处理
+        with self.inflight_lock:
+            self.inflight[source_key] = float('inf')
+            self.inflight[target_key] = float('inf')
+        
+        try:
+            started = time.perf_counter()
+            move_noreplace(file_path, new_filepath)
+            RENAME_SECONDS.observe(time.perf_counter() - started)
+            logger.info(f"重命名: {file_path.name} -> {new_filepath.name}")
+            return True
+        except FileExistsError:
+            logger.warning(f"目标文件已存在，跳过重命名 {file_path.name} -> {new_filepath.name}")
+            return False
+        except OSError as e:
+            logger.warning(f"无法重命名文件 {file_path.name}: {e}")
+            return False
+        finally:
+            now = time.monotonic()
+            expires = now + self.inflight_grace
+            with self.inflight_lock:
+                self.inflight.pop(source_key, None)
+                self.inflight[target_key] = expires
+                self.inflight_expiry.append((expires, target_key))
+                # 清理过期条目，防止集合无限增长
+                while self.inflight_expiry and self.inflight_expiry[0][0] < now:
+                    old_expires, key = self.inflight_expiry.popleft()
+                    if self.inflight.get(key) == old_expires:
+                        del self.inflight[key]
+    
+    def _is_file_accessible(self, file_path, max_attempts=2, delay=0.05):
+        """
+        快速检查文件是否可访问
+        
+        Args:
+            file_path: 文件路径
+            max_attempts: 最大尝试次数
+            delay: 检查间隔
+            
+        Returns:
+            bool: 文件是否可访问
+        """
+        for attempt in range(max_attempts):
+            try:
+                # 尝试以读写模式打开文件
+                started = time.perf_counter()
+                with open(file_path, 'rb'):
+                    OPEN_SECONDS.observe(time.perf_counter() - started)
+                    return True
+            except (OSError, IOError) as e:
+                logger.debug(f"文件访问失败 {file_path.name} (尝试 {attempt+1}/{max_attempts}): {e}")
+                if attempt < max_attempts - 1:
+                    time.sleep(delay)
+        return False
+    
+    def _get_file_info(self, file_path):
+        """
+        获取文件信息用于诊断
+        
+        Args:
+            file_path: 文件路径
+            
+        Returns:
+            dict: 文件信息
+        """
+        try:
+            started = time.perf_counter()
+            stat = file_path.stat()
+            STAT_SECONDS.observe(time.perf_counter() - started)
+            return {
+                'name': file_path.name,
+                'name_length': len(file_path.name),
+                'size': stat.st_size,
+                'modified': stat.st_mtime,
+                'exists': file_path.exists()
+            }
+        except Exception as e:
+            return {
+                'name': file_path.name,
+                'name_length': len(file_path.name),
+                'error': str(e)
+            }
+
+class RenameExecutor:
+    """并行重命名执行器 - 把单个文件的检查和重命名提交到有界线程池"""
+    
+    def __init__(self, renamer, max_workers=8, max_attempts=2, retry_delay=0.05):
+        """
+        初始化并行重命名执行器
+        
+        Args:
+            renamer: 文件重命名器
+            max_workers: 线程池大小(所有批次共享)
+            max_attempts: 文件不可访问时的最大尝试次数
+            retry_delay: 重试间隔(秒)，期间继续收集其他文件的完成结果
+        """
+        self.renamer = renamer
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        from concurrent.futures import ThreadPoolExecutor
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="RenameExecutor")
+        
+    def run_batch(self, file_paths, on_complete=None):
+        """
+        并行处理一批文件
+        
+        可访问性检查并行执行，序号按文件到达顺序分配；不可访问的文件
+        延后重试，同一目录中排在它后面的文件也一起延后，不会先拿到更小的序号，
+        其他目录的文件照常重命名。最后一轮仍不可访问的文件交给重试调度，
+        之后只能拿到更大的序号，这一轮不再延后其他文件
+        
+        Args:
+            file_paths: 文件路径列表
+            on_complete: 每个文件处理完成时的回调 on_complete(文件路径, 成功/失败)
+            
+        Returns:
+            dict: 处理结果 {文件路径: 成功/失败}
+        """
+        from concurrent.futures import wait
+        results = {}
+        results_lock = Lock()
+        
+        def finish(file_path, success):
+            with results_lock:
+                results[file_path] = success
+            if on_complete is not None:
+                on_complete(file_path, success)
+        
+        in_flight = set()
+        pending = list(file_paths)
+        
+        for attempt in range(self.max_attempts):
+            probes = [(file_path, self.pool.submit(self._probe, file_path)) for file_path in pending]
+            pending = []
+            
+            # 按到达顺序分配序号，检查本身是并行的
+            assignments = []
+            held_dirs = set()  # 本轮有文件不可访问的目录
+            last_attempt = attempt == self.max_attempts - 1
+            for file_path, probe in probes:
+                if file_path.parent in held_dirs:
+                    pending.append(file_path)
+                    continue
+                if not probe.result():
+                    pending.append(file_path)
+                    if not last_attempt:
+                        held_dirs.add(file_path.parent)
+                    continue
+                assignments.append(
+                    (file_path, self.renamer.get_next_filename(file_path.suffix, file_path.parent))
+                )
+            
+            # 这一轮的意图一起落盘后再提交重命名
+            try:
+                self.renamer.log_intents(assignments)
+            except OSError as e:
+                logger.error(f"写入意图日志失败，本轮不重命名: {e}")
+                for file_path, new_filename in assignments:
+                    self.renamer.finish_rename(file_path, new_filename, False)
+                    finish(file_path, False)
+                continue
+                
+            for file_path, new_filename in assignments:
+                future = self.pool.submit(self._rename, file_path, new_filename)
+                future.add_done_callback(lambda f, path=file_path: finish(path, f.result()))
+                in_flight.add(future)
+                
+            if not pending:
+                break
+                
+            # 等待重试间隔的同时让已提交的重命名继续完成
+            if attempt < self.max_attempts - 1:
+                _, in_flight = wait(in_flight, timeout=self.retry_delay)
+                logger.debug(f"{len(pending)} 个文件暂不可访问或排在不可访问的文件之后，稍后重试")
+        
+        for file_path in pending:
+            logger.warning(f"文件不可访问: {file_path.name}")
+            self.renamer.finish_rename(file_path, None, False)
+            finish(file_path, False)
+            
+        wait(in_flight)
+        self.renamer.flush_intents(file_paths)
+        return results
+    
+    def _probe(self, file_path):
+        """记录文件信息并检查一次文件是否可访问，不做等待"""
+        try:
+            logger.debug(f"处理文件: {self.renamer._get_file_info(file_path)}")
+            return self.renamer._is_file_accessible(file_path, max_attempts=1)
+        except Exception as e:
+            logger.error(f"检查文件 {file_path.name} 时发生未知错误: {e}")
+            return False
+    
+    def _rename(self, file_path, new_filename):
+        """执行重命名并兜住异常"""
+        success = False
+        try:
+            success = self.renamer._rename_file(file_path, new_filename)
+        except Exception as e:
+            logger.error(f"处理文件 {file_path.name} 时发生未知错误: {e}")
+        finally:
+            self.renamer.finish_rename(file_path, new_filename, success)
+        return success
+    
+    def shutdown(self):
+        """等待已提交的任务完成并关闭线程池"""
+        self.pool.shutdown(wait=True)
+
+def hash_file(path, limit=None, chunk_size=1 << 20):
+    """
+    分块读取文件计算 BLAKE2b 摘要，在进程池中运行，不占用主进程的 GIL
+    
+    Args:
+        path: 文件路径
+        limit: 只读取前多少字节，None 表示整个文件
+        chunk_size: 每次读取的字节数
+        
+    Returns:
+        str | None: 十六进制摘要，文件无法读取时返回 None
+    """
+    import hashlib
+    digest = hashlib.blake2b(digest_size=20)
+    remaining = limit
+    try:
+        with open(path, 'rb') as f:
+            while remaining is None or remaining > 0:
+                chunk = f.read(chunk_size if remaining is None else min(chunk_size, remaining))
+                if not chunk:
+                    break
+                digest.update(chunk)
+                if remaining is not None:
+                    remaining -= len(chunk)
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+def _ignore_interrupt():
+    """摘要子进程忽略 Ctrl+C，由主进程负责关闭进程池"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+class ContentIndex:
+    """
+    单个目录的内容索引 - 已编号文件名 -> (大小, 前缀摘要, 完整摘要)，追加写入磁盘
+    
+    同时记录已判定为重复、保留原文件名的文件(文件名 -> (大小, 修改时间))，
+    事件过滤和对账扫描据此跳过它们，不再重复计算摘要
+    """
+    
+    def __init__(self, directory, path):
+        """
+        初始化内容索引并读取已有记录
+        
+        Args:
+            directory: 目录路径
+            path: 索引文件路径
+        """
+        self.directory = Path(directory)
+        self.path = Path(path)
+        self.entries = {}  # 文件名 -> 条目
+        self.by_size = defaultdict(set)  # 大小 -> 文件名集合
+        self.duplicates = {}  # 重复文件名 -> (大小, 修改时间纳秒)
+        self.lock = Lock()
+        self._load()
+        
+    def _load(self):
+        """读取索引，同一文件名以最后一条记录为准"""
+        lines = 0
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    lines += 1
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    name = record.pop('name', None)
+                    if name is None:
+                        continue
+                    if 'dup' in record:
+                        if record['dup'] is None:
+                            self.duplicates.pop(name, None)
+                        else:
+                            self.duplicates[name] = tuple(record['dup'])
+                    elif record.get('removed'):
+                        self._drop(name)
+                    else:
+                        self._add(name, record)
+        except FileNotFoundError:
+            return
+        
+        # 过期记录过多时重写索引
+        if lines > 2 * (len(self.entries) + len(self.duplicates)) + 100:
+            tmp_path = self.path.with_name(self.path.name + '.tmp')
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                for name, entry in self.entries.items():
+                    f.write(self._format(name, entry))
+                for name, key in self.duplicates.items():
+                    f.write(json.dumps({'name': name, 'dup': list(key)}, ensure_ascii=False) + '\n')
+            os.replace(tmp_path, self.path)
+    
+    @staticmethod
+    def _format(name, entry):
+        record = {'name': name}
+        record.update((key, entry[key]) for key in ('size', 'partial', 'full') if entry.get(key) is not None)
+        return json.dumps(record, ensure_ascii=False) + '\n'
+    
+    def _add(self, name, entry):
+        self._drop(name)
+        entry.setdefault('name', name)
+        self.entries[name] = entry
+        self.by_size[entry['size']].add(name)
+    
+    def _drop(self, name):
+        entry = self.entries.pop(name, None)
+        if entry is not None:
+            names = self.by_size.get(entry['size'])
+            if names is not None:
+                names.discard(name)
+                if not names:
+                    del self.by_size[entry['size']]
+        return entry
+    
+    def candidates(self, size):
+        """获取同样大小的条目(需持有锁)"""
+        return [self.entries[name] for name in self.by_size.get(size, ())]
+    
+    def add(self, name, entry, persist=True):
+        """添加或更新条目(需持有锁)"""
+        self._add(name, entry)
+        if persist:
+            self._append(self._format(name, entry))
+    
+    def remove(self, name, persist=True):
+        """移除条目(需持有锁)"""
+        if self._drop(name) is not None and persist:
+            self._append(json.dumps({'name': name, 'removed': True}, ensure_ascii=False) + '\n')
+    
+    def add_duplicate(self, name, size, mtime_ns):
+        """记录一个保留原文件名的重复文件(需持有锁)"""
+        self.duplicates[name] = (size, mtime_ns)
+        self._append(json.dumps({'name': name, 'dup': [size, mtime_ns]}, ensure_ascii=False) + '\n')
+    
+    def remove_duplicate(self, name):
+        """移除重复文件记录(需持有锁)"""
+        if self.duplicates.pop(name, None) is not None:
+            self._append(json.dumps({'name': name, 'dup': None}, ensure_ascii=False) + '\n')
+    
+    def _append(self, line):
+        try:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line)
+        except OSError as e:
+            logger.warning(f"写入内容索引失败: {e}")
+
+class ContentDeduplicator:
+    """
+    内容去重 - 编号前按文件内容识别重复文件
+    
+    先比较大小，大小相同才计算前 partial_size 字节的摘要，前缀也相同才计算
+    完整摘要；没有同样大小的已编号文件时不读取文件内容。摘要在进程池中计算，
+    已算出的摘要写入每个目录的内容索引，下次启动直接使用
+    """
+    
+    ACTIONS = ('skip', 'link', 'aside')
+    
+    def __init__(self, renamer, action='skip', index_file=".rename_hashes", duplicates_dir=".duplicates",
+                 pool_size=2, partial_size=64 * 1024):
+        """
+        初始化内容去重
+        
+        Args:
+            renamer: 文件重命名器
+            action: 重复文件的处理方式：skip 保留原样不编号，link 替换为指向已编号文件的硬链接，
+                    aside 移到 duplicates_dir 目录
+            index_file: 内容索引文件名，在每个被处理的目录下创建
+            duplicates_dir: aside 方式下存放重复文件的子目录名
+            pool_size: 计算摘要的进程数
+            partial_size: 前缀摘要读取的字节数
+        """
+        if action not in self.ACTIONS:
+            raise ValueError(f"未知的重复文件处理方式: {action}")
+            
+        self.renamer = renamer
+        self.action = action
+        self.index_file = index_file
+        self.duplicates_dir = duplicates_dir
+        self.pool_size = pool_size
+        self.partial_size = partial_size
+        self.pool = None
+        self.pool_lock = Lock()
+        self.indexes = {}  # 目录(绝对路径) -> 内容索引
+        self.indexes_lock = Lock()
+        self.stats = METRICS.register(Counter('renamer_content_dedup_total', "内容去重各步骤次数", label='step'))
+        renamer.ignored_dirs.add(duplicates_dir)
+        
+    def _get_pool(self):
+        with self.pool_lock:
+            if self.pool is None:
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+                # spawn 启动的子进程不会继承监控线程持有的锁
+                self.pool = ProcessPoolExecutor(
+                    max_workers=self.pool_size, mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_ignore_interrupt
+                )
+            return self.pool
+    
+    def _get_index(self, directory):
+        key = os.path.abspath(directory)
+        with self.indexes_lock:
+            index = self.indexes.get(key)
+            if index is None:
+                index = ContentIndex(key, os.path.join(key, self.index_file))
+                self.indexes[key] = index
+            return index
+    
+    def _hashes(self, paths, limit):
+        """并行计算一组文件的摘要"""
+        pool = self._get_pool()
+        futures = [pool.submit(hash_file, str(path), limit) for path in paths]
+        self.stats.inc('partial_hashes' if limit else 'full_hashes', len(paths))
+        return [future.result() for future in futures]
+    
+    def is_duplicate(self, file_path, stat=None):
+        """
+        检查文件是否是已处理过的重复文件(文件名、大小和修改时间都与记录一致)
+        
+        Args:
+            file_path: 文件路径
+            stat: 已有的 stat 结果，None 时只在文件名有记录时才 stat
+        """
+        recorded = self._get_index(file_path.parent).duplicates.get(file_path.name)
+        if recorded is None:
+            return False
+        if stat is None:
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                return False
+        return (stat.st_size, stat.st_mtime_ns) == recorded
+    
+    def filter_batch(self, file_paths):
+        """
+        从批次中找出重复文件
+        
+        Args:
+            file_paths: 文件路径列表
+            
+        Returns:
+            tuple: (需要编号的文件列表, [(重复文件路径, 匹配的条目)])
+        """
+        unique = []
+        duplicates = []
+        for file_path in file_paths:
+            try:
+                size = os.stat(file_path).st_size
+            except OSError:
+                # 交给重命名流程报告错误
+                unique.append(file_path)
+                continue
+                
+            index = self._get_index(file_path.parent)
+            match = self._find_match(index, file_path, size)
+            with index.lock:
+                # 内容已变化的重复文件重新判断
+                index.remove_duplicate(file_path.name)
+                if match is None:
+                    # 先以原文件名登记，同批次后面的副本也能匹配到，重命名成功后改为新文件名
+                    index.add(file_path.name, {'size': size, 'pending': True}, persist=False)
+                    
+            if match is None:
+                self.stats.inc('unique')
+                unique.append(file_path)
+            else:
+                self.stats.inc('duplicate')
+                duplicates.append((file_path, match))
+        return unique, duplicates
+    
+    def _find_match(self, index, file_path, size):
+        """在索引中查找内容相同的条目，摘要在索引锁外计算"""
+        with index.lock:
+            candidates = [entry for entry in index.candidates(size) if entry['name'] != file_path.name]
+        if not candidates:
+            self.stats.inc('size_unique')
+            return None
+        
+        for level, limit in (('partial', self.partial_size), ('full', None)):
+            # 大小不超过前缀长度时前缀摘要就是完整摘要
+            if level == 'full' and size <= self.partial_size:
+                return candidates[0]
+            
+            missing = [entry for entry in candidates if entry.get(level) is None]
+            digests = self._hashes([file_path] + [index.directory / entry['name'] for entry in missing], limit)
+            own = digests[0]
+            if own is None:
+                return None
+            with index.lock:
+                for entry, digest in zip(missing, digests[1:]):
+                    if digest is None:
+                        # 等待重命名的文件可能已被其他线程移入临时目录，读取失败不代表它不存在，
+                        # 保留登记，只是这次无法比较；已编号文件读取失败说明它不存在了
+                        if not entry.get('pending'):
+                            index.remove(entry['name'])
+                        continue
+                    entry[level] = digest
+                    if not entry.get('pending'):
+                        index.add(entry['name'], entry)
+                        
+                candidates = [
+                    entry for entry in candidates
+                    if entry.get(level) == own and index.entries.get(entry['name']) is entry
+                ]
+            if not candidates:
+                self.stats.inc(f'{level}_unique')
+                return None
+        return candidates[0]
+    
+    def record(self, file_path, new_filename, success):
+        """文件重命名结束后把登记的条目改为新文件名，失败时移除"""
+        index = self._get_index(file_path.parent)
+        with index.lock:
+            entry = index.entries.get(file_path.name)
+            if entry is None or not entry.get('pending'):
+                return
+            index.remove(file_path.name, persist=False)
+            if success:
+                del entry['pending']
+                entry['name'] = new_filename
+                index.add(new_filename, entry)
+    
+    def resolve(self, duplicates, on_complete=None):
+        """
+        在批次中其他文件重命名完成后处理重复文件
+        
+        Returns:
+            dict: 处理结果 {文件路径: 成功/失败}
+        """
+        results = {}
+        for file_path, entry in duplicates:
+            # 匹配的文件在同一批次中且重命名失败时，本文件下次作为新文件重新处理
+            if entry.get('pending') or entry['name'] not in self._get_index(file_path.parent).entries:
+                success = False
+            else:
+                success = self._apply(file_path, file_path.parent / entry['name'])
+            results[file_path] = success
+            if on_complete is not None:
+                on_complete(file_path, success)
+        return results
+    
+    def _apply(self, file_path, original):
+        """按配置的方式处理一个重复文件"""
+        try:
+            if self.action == 'link':
+                tmp_path = file_path.with_name(f".{file_path.name}.link")
+                os.link(original, tmp_path)
+                os.replace(tmp_path, file_path)
+                logger.info(f"重复文件，已替换为硬链接: {file_path.name} -> {original.name}")
+            elif self.action == 'aside':
+                target_dir = file_path.parent / self.duplicates_dir
+                target_dir.mkdir(exist_ok=True)
+                target = target_dir / file_path.name
+                suffix = 1
+                while True:
+                    try:
+                        move_noreplace(file_path, target)
+                        break
+                    except FileExistsError:
+                        target = target_dir / f"{file_path.stem}_{suffix}{file_path.suffix}"
+                        suffix += 1
+                logger.info(f"重复文件，已移到 {self.duplicates_dir}: {file_path.name} (与 {original.name} 相同)")
+            else:
+                logger.info(f"重复文件，跳过: {file_path.name} (与 {original.name} 相同)")
+            
+            # 保留原文件名的重复文件记入索引，之后的事件和对账扫描不再处理它
+            if self.action != 'aside':
+                stat = os.stat(file_path)
+                index = self._get_index(file_path.parent)
+                with index.lock:
+                    index.add_duplicate(file_path.name, stat.st_size, stat.st_mtime_ns)
+        except OSError as e:
+            logger.warning(f"处理重复文件 {file_path.name} 失败: {e}")
+            return False
+        self.stats.inc(self.action)
+        return True
+    
+    def shutdown(self):
+        """关闭摘要进程池"""
+        with self.pool_lock:
+            if self.pool is not None:
+                self.pool.shutdown(wait=True)
+                self.pool = None
+
+class DedupIndex:
+    """事件去重索引 - 每个条目按 TTL 单独过期，容量有上限，线程安全"""
+    
+    def __init__(self, ttl=10.0, max_entries=10000):
+        """
+        初始化去重索引
+        
+        Args:
+            ttl: 条目存活时间(秒)
+            max_entries: 最大条目数，超过时淘汰最早的条目
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # 键 -> 过期时间，按过期时间先后排列
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        
+    def seen(self, key):
+        """
+        检查键是否在存活期内出现过，没有则记录下来
+        
+        Returns:
+            bool: 是否为重复键
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            if key in self._entries:
+                self.hits += 1
+                return True
+                
+            self.misses += 1
+            self._entries[key] = now + self.ttl
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            return False
+    
+    def discard(self, key):
+        """移除键(例如文件已被移走或删除)"""
+        with self._lock:
+            self._entries.pop(key, None)
+    
+    def purge_expired(self):
+        """清理所有已过期的条目"""
+        with self._lock:
+            self._expire(time.monotonic())
+    
+    def _expire(self, now):
+        """从最早的条目开始移除已过期条目(需持有锁)"""
+        entries = self._entries
+        while entries:
+            key, expires = next(iter(entries.items()))
+            if expires > now:
+                break
+            del entries[key]
+    
+    def get_stats(self):
+        """获取去重统计"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0
+            }
+
+class StabilityTracker:
+    """
+    文件稳定性跟踪 - 新文件先放入待定集合，大小和修改时间在静默期内不再变化后才交给缓冲区
+    
+    修改事件只推迟截止时间，不做 stat；由一个定时线程在截止时间到达时 stat 一次，
+    变化了就重新计时。收到写关闭事件说明写入方已完成，立即交给缓冲区。
+    待定集合为空时定时线程一直等待，没有定期唤醒
+    """
+    
+    def __init__(self, release, quiet_period=1.0, max_pending=10000):
+        """
+        初始化稳定性跟踪
+        
+        Args:
+            release: 文件稳定后的回调 release(文件路径)
+            quiet_period: 静默期(秒)
+            max_pending: 待定集合上限，超过时新文件直接交给缓冲区
+        """
+        self.release = release
+        self.quiet_period = quiet_period
+        self.max_pending = max_pending
+        self.pending = {}  # 文件路径 -> [截止时间, 大小, 修改时间]
+        self.timers = []  # (截止时间, 文件路径) 小顶堆，截止时间推迟后旧条目在到期时跳过
+        self.lock = Lock()
+        self.wakeup = Condition(self.lock)
+        self.should_stop = False
+        self.timer_thread = None
+        self.stats = METRICS.register(Counter('renamer_stability_total', "文件稳定性检查结果", label='result'))
+        METRICS.gauge('stability_pending', "等待文件稳定的文件数", lambda: len(self.pending))
+        
+    def start(self):
+        """启动定时线程"""
+        self.timer_thread = Thread(target=self._run, daemon=True, name="StabilityTracker")
+        self.timer_thread.start()
+        
+    def stop(self):
+        """停止定时线程，待定的文件不再交给缓冲区"""
+        with self.lock:
+            self.should_stop = True
+            self.wakeup.notify()
+        if self.timer_thread is not None:
+            self.timer_thread.join()
+    
+    def track(self, file_path):
+        """开始跟踪一个新文件，记录当前的大小和修改时间"""
+        key = str(file_path)
+        try:
+            stat = os.stat(key)
+        except OSError:
+            self.stats.inc('vanished')
+            return
+            
+        with self.lock:
+            if key in self.pending:
+                self.pending[key][0] = time.monotonic() + self.quiet_period
+                return
+            if len(self.pending) >= self.max_pending:
+                overflow = True
+            else:
+                overflow = False
+                deadline = time.monotonic() + self.quiet_period
+                self.pending[key] = [deadline, stat.st_size, stat.st_mtime_ns]
+                heapq.heappush(self.timers, (deadline, key))
+                if self.timers[0][1] == key:
+                    self.wakeup.notify()
+        if overflow:
+            self.stats.inc('overflow')
+            self.release(file_path)
+    
+    def touch(self, file_path):
+        """文件被修改，推迟截止时间"""
+        key = str(file_path)
+        with self.lock:
+            entry = self.pending.get(key)
+            if entry is not None:
+                entry[0] = time.monotonic() + self.quiet_period
+    
+    def closed(self, file_path):
+        """写入方关闭了文件，立即交给缓冲区"""
+        key = str(file_path)
+        with self.lock:
+            entry = self.pending.pop(key, None)
+        if entry is not None:
+            self.stats.inc('closed')
+            self.release(file_path)
+    
+    def forget(self, file_path):
+        """文件被移走或删除，停止跟踪"""
+        with self.lock:
+            self.pending.pop(str(file_path), None)
+    
+    def _run(self):
+        """等到最早的截止时间，检查到期的文件"""
+        while True:
+            due = []
+            with self.lock:
+                while not self.should_stop:
+                    if not self.timers:
+                        self.wakeup.wait()
+                        continue
+                    remaining = self.timers[0][0] - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.wakeup.wait(remaining)
+                if self.should_stop:
+                    return
+                    
+                now = time.monotonic()
+                while self.timers and self.timers[0][0] <= now:
+                    _, key = heapq.heappop(self.timers)
+                    entry = self.pending.get(key)
+                    if entry is None:
+                        continue
+                    if entry[0] > now:
+                        # 期间收到修改事件，按新的截止时间重新排队
+                        heapq.heappush(self.timers, (entry[0], key))
+                        continue
+                    due.append((key, entry[1], entry[2]))
+            
+            # stat 和交给缓冲区都在锁外进行
+            for key, size, mtime in due:
+                self._check(key, size, mtime)
+    
+    def _check(self, key, size, mtime):
+        """大小和修改时间与上次相同则交给缓冲区，否则重新计时"""
+        try:
+            stat = os.stat(key)
+        except OSError:
+            with self.lock:
+                self.pending.pop(key, None)
+            self.stats.inc('vanished')
+            return
+            
+        with self.lock:
+            entry = self.pending.get(key)
+            if entry is None:
+                return
+            if (stat.st_size, stat.st_mtime_ns) != (size, mtime) or entry[0] > time.monotonic():
+                entry[1], entry[2] = stat.st_size, stat.st_mtime_ns
+                entry[0] = max(entry[0], time.monotonic() + self.quiet_period)
+                heapq.heappush(self.timers, (entry[0], key))
+                changed = True
+            else:
+                del self.pending[key]
+                changed = False
+                
+        if changed:
+            self.stats.inc('changed')
+        else:
+            self.stats.inc('stable')
+            self.release(Path(key))
+
+TRACE_MAGIC = b'RNTRACE2'
+TRACE_RECORD = struct.Struct('<IBHqHH')  # 距上一事件的微秒数, 事件类型, 目录序号, 文件大小, 源路径长度, 目标路径长度
+TRACE_EVENT_TYPES = ('created', 'moved', 'deleted', 'modified', 'closed')  # 事件处理器会响应的事件
+TRACE_ABSOLUTE = 0xFFFF  # 目录序号：路径不在任何监控目录下，按绝对路径保存
+
+class EventTraceRecorder(FileSystemEventHandler):
+    """
+    事件记录器 - 把 watchdog 事件连同时间和文件大小写入紧凑的二进制日志，再交给实际的处理器
+    
+    日志由文件头(魔数 + JSON 元数据)和定长记录 + 路径组成，路径保存为相对所在监控目录的
+    路径，可以在合成目录中按原有时间间隔回放，见 read_trace 和 bench.py replay
+    """
+    
+    def __init__(self, handler, path, directories, metadata=None, flush_interval=1.0):
+        """
+        初始化事件记录器
+        
+        Args:
+            handler: 实际的事件处理器，记录后原样转发
+            path: 日志文件路径，已存在时覆盖
+            directories: 监控目录列表
+            metadata: 写入文件头的其他信息(匹配模式、序号位数等)，回放时用来重建相同配置
+            flush_interval: 至少每隔多久(秒)把缓冲写入文件
+        """
+        super().__init__()
+        self.handler = handler
+        self.path = Path(path)
+        self.directories = [os.path.abspath(directory) for directory in directories]
+        self.flush_interval = flush_interval
+        self._lock = Lock()
+        self._codes = {event_type: code for code, event_type in enumerate(TRACE_EVENT_TYPES)}
+        self._last = None
+        self._last_flush = time.monotonic()
+        self.recorded = 0
+        
+        header = dict(metadata or {}, directories=self.directories, started=time.time())
+        header = json.dumps(header, ensure_ascii=False).encode('utf-8')
+        self._file = open(self.path, 'wb')
+        self._file.write(TRACE_MAGIC + struct.pack('<I', len(header)) + header)
+        
+    def dispatch(self, event):
+        """记录事件后交给实际的处理器"""
+        code = self._codes.get(event.event_type)
+        if code is not None and not event.is_directory:
+            self._record(code, event)
+        self.handler.dispatch(event)
+        
+    def _relative(self, path):
+        """返回 (目录序号, 相对路径字节串)"""
+        path = os.path.abspath(path)
+        for index, directory in enumerate(self.directories[:TRACE_ABSOLUTE]):
+            if path.startswith(directory + os.sep):
+                return index, os.fsencode(path[len(directory) + 1:])
+        return TRACE_ABSOLUTE, os.fsencode(path)
+        
+    def _record(self, code, event):
+        """
+        追加一条记录，文件大小在收到事件时读取，读取失败记为 -1
+        
+        写入过程中每次写都会产生 modified 事件，记录器运行在 watchdog 线程上，
+        modified 不读取大小(记为 -1)，写完后的 closed 事件带有最终大小
+        """
+        now = time.monotonic()
+        target = event.dest_path if event.event_type == 'moved' else event.src_path
+        size = -1
+        if event.event_type not in ('deleted', 'modified'):
+            try:
+                size = os.stat(target).st_size
+            except OSError:
+                pass
+        
+        index, src = self._relative(event.src_path)
+        dest = b''
+        if event.event_type == 'moved':
+            dest_index, dest = self._relative(event.dest_path)
+            if dest_index != index:
+                # 跨目录移动时两个路径都按绝对路径保存
+                index, src = TRACE_ABSOLUTE, os.fsencode(os.path.abspath(event.src_path))
+                dest = os.fsencode(os.path.abspath(event.dest_path))
+        
+        with self._lock:
+            if self._file is None:
+                return
+            delta = 0 if self._last is None else min(0xFFFFFFFF, int((now - self._last) * 1e6))
+            self._last = now
+            self._file.write(TRACE_RECORD.pack(delta, code, index, size, len(src), len(dest)) + src + dest)
+            self.recorded += 1
+            if now - self._last_flush >= self.flush_interval:
+                self._file.flush()
+                self._last_flush = now
+        
+    def close(self):
+        """写入剩余缓冲并关闭日志"""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        logger.info(f"事件日志已写入 {self.path}，共 {self.recorded} 个事件")
+
+def read_trace(path):
+    """
+    读取事件日志
+    
+    Args:
+        path: 日志文件路径
+        
+    Returns:
+        tuple: (文件头元数据, 事件迭代器)，每个事件为
+            (相对第一个事件的秒数, 事件类型, 目录序号, 源路径, 目标路径, 文件大小)，
+            目录序号为 TRACE_ABSOLUTE 时路径是绝对路径，目标路径只有 moved 事件有
+    """
+    f = open(path, 'rb')
+    if f.read(len(TRACE_MAGIC)) != TRACE_MAGIC:
+        f.close()
+        raise ValueError(f"不是事件日志文件: {path}")
+    header_size, = struct.unpack('<I', f.read(4))
+    metadata = json.loads(f.read(header_size).decode('utf-8'))
+    
+    def events():
+        offset = 0
+        with f:
+            while True:
+                record = f.read(TRACE_RECORD.size)
+                if len(record) < TRACE_RECORD.size:
+                    return  # 文件末尾(或记录时被中断，丢弃不完整的最后一条)
+                delta, code, index, size, src_len, dest_len = TRACE_RECORD.unpack(record)
+                src = f.read(src_len)
+                dest = f.read(dest_len)
+                if len(src) < src_len or len(dest) < dest_len:
+                    return
+                offset += delta
+                yield (
+                    offset / 1e6, TRACE_EVENT_TYPES[code], index,
+                    os.fsdecode(src), os.fsdecode(dest) if dest_len else None, size
+                )
+    
+    return metadata, events()
+
+# 跳过原因 -> 事件统计键
+SKIP_STATS = {
+    reason: f'skipped_{reason}'
+    for reason in ('temp', 'inflight', 'too_long', 'wrong_extension', 'already_numbered', 'hidden', 'other_instance',
+                   'content_duplicate', 'other')
+}
+
+class FileMonitorHandler(FileSystemEventHandler):
+    """文件系统事件处理器 - 修复已编号判断问题"""
+    
+    def __init__(self, file_buffer, action, dedup_ttl=10.0, dedup_max_entries=10000):
+        super().__init__()
+        self.file_buffer = file_buffer
+        self.action = action  # 批处理动作，这里只用它的 filter
+        self.should_stop = False
+        self.recent_events = DedupIndex(ttl=dedup_ttl, max_entries=dedup_max_entries)  # 近期事件索引，用于去重
+        self.event_processor_thread = None
+        self.process_event = Event()
+        self.event_stats = METRICS.register(Counter('renamer_events_total', "文件事件及其处理结果", label='event'))  # 事件统计，按线程累加
+        self.stability = None  # 可选的文件稳定性跟踪，见 StabilityTracker
+        
+    def on_created(self, event):
+        """文件创建事件处理"""
+        if not event.is_directory:
+            self._handle_file_event(event.src_path, 'created')
+    
+    def on_moved(self, event):
+        """文件移动事件处理"""
+        if not event.is_directory:
+            # 原路径上的文件已经离开，之后同名的新文件不算重复
+            self.recent_events.discard(str(Path(event.src_path)))
+            if self.stability is not None:
+                self.stability.forget(Path(event.src_path))
+            self._handle_file_event(event.dest_path, 'moved')
+    
+    def on_deleted(self, event):
+        """文件删除事件处理"""
+        if not event.is_directory:
+            self.recent_events.discard(str(Path(event.src_path)))
+            if self.stability is not None:
+                self.stability.forget(Path(event.src_path))
+            self.event_stats.inc('deleted')
+    
+    def on_modified(self, event):
+        """文件修改事件处理，跟踪稳定性时推迟该文件的截止时间"""
+        if not event.is_directory:
+            self.event_stats.inc('modified')
+            if self.stability is not None:
+                self.stability.touch(Path(event.src_path))
+    
+    def on_closed(self, event):
+        """文件写入后关闭(inotify IN_CLOSE_WRITE)，写入方已完成"""
+        if not event.is_directory and self.stability is not None:
+            self.event_stats.inc('closed')
+            self.stability.closed(Path(event.src_path))
+    
+    def _handle_file_event(self, file_path, event_type):
+        """处理文件事件"""
+        path_obj = Path(file_path)
+        if not self.filter_event(path_obj, event_type):
+            return
+        
+        # 新创建的文件可能还在写入，等稳定后再交给缓冲区；移入的文件通常已写完(先写临时文件再改名)
+        if self.stability is not None and event_type == 'created':
+            self.stability.track(path_obj)
+            self.event_stats.inc('held_for_stability')
+            return
+        self.add_to_buffer(path_obj, event_type)
+    
+    def add_to_buffer(self, path_obj, event_type='stable'):
+        """添加到缓冲区"""
+        if self.file_buffer.add_file(path_obj):
+            logger.debug(f"添加到缓冲区: {path_obj.name} (事件: {event_type})")
+            self.event_stats.inc('added_to_buffer')
+        else:
+            self.event_stats.inc('buffer_rejected')
+    
+    def filter_event(self, path_obj, event_type):
+        """
+        记录事件统计并判断事件是否需要处理(过滤 + 去重)
+        
+        Args:
+            path_obj: 文件路径
+            event_type: 事件类型
+            
+        Returns:
+            bool: 是否需要交给缓冲区
+        """
+        # 记录事件统计
+        self.event_stats.inc(event_type)
+        
+        # 交给动作判断是否需要处理，并记录被跳过的原因
+        reason = self.action.filter(path_obj)
+        if reason is not None:
+            self.event_stats.inc(SKIP_STATS.get(reason) or f'skipped_{reason}')
+            return False
+        
+        # 以文件路径作为去重键，文件被移走或删除时移除，不需要额外 stat
+        if self.recent_events.seen(str(path_obj)):
+            self.event_stats.inc('duplicate')
+            return False
+            
+        return True
+        
+    def start_event_cleaner(self):
+        """启动事件清理线程"""
+        self.event_processor_thread = Thread(target=self._clean_events, daemon=True)
+        self.event_processor_thread.start()
+        
+    def _clean_events(self):
+        """定期清理近期事件索引中已过期的条目"""
+        while not self.should_stop:
+            time.sleep(10)  # 每10秒清理一次
+            self.recent_events.purge_expired()
+    
+    def get_event_stats(self):
+        """获取事件统计"""
+        return self.event_stats.values()
+    
+    def get_dedup_stats(self):
+        """获取去重统计"""
+        return self.recent_events.get_stats()
+
+class BatchFileProcessor:
+    """批量文件处理器 - 常驻线程数固定，积压时在上限内临时扩容"""
+    
+    def __init__(self, file_buffer, action, num_workers=3, max_workers=None, idle_timeout=30.0):
+        """
+        初始化批量文件处理器
+        
+        Args:
+            file_buffer: 文件缓冲区
+            action: 批处理动作，见 BatchAction
+            num_workers: 常驻处理线程数，也是线程数下限
+            max_workers: 处理线程数上限，None 表示不扩容
+            idle_timeout: 临时线程空闲多久(秒)后退出
+        """
+        self.file_buffer = file_buffer
+        self.action = action
+        self.num_workers = num_workers
+        self.max_workers = max(num_workers, max_workers or num_workers)
+        # 动作声明了并发上限时，超出的线程等待名额，也不再为它扩容
+        self.action_slots = None
+        if action.max_concurrency is not None:
+            self.action_slots = BoundedSemaphore(action.max_concurrency)
+            self.max_workers = max(num_workers, min(self.max_workers, action.max_concurrency))
+        self.idle_timeout = idle_timeout
+        self.workers = []
+        self.shard_workers = defaultdict(int)  # 分片 -> 线程数
+        self.shard_busy = defaultdict(int)  # 分片 -> 正在处理批次的线程数
+        self.pool_lock = Lock()
+        self.next_worker_id = 0
+        self.should_stop = False
+        self.stats = {
+            'processed': 0,
+            'succeeded': 0,
+            'failed': 0,
+            'batches': 0
+        }
+        self.stats_lock = Lock()
+        
+        self.scaling = METRICS.register(
+            Counter('renamer_worker_scaling_total', "处理线程扩容/缩容次数", label='action')
+        )
+        METRICS.gauge('workers', "当前处理线程数", lambda: len(self.workers))
+        METRICS.gauge('busy_workers', "正在处理批次的线程数", self.busy_count)
+        
+    def busy_count(self):
+        """正在处理批次的线程数，指标接口在自己的线程中读取，需在锁内遍历"""
+        with self.pool_lock:
+            return sum(self.shard_busy.values())
+    
+    def start(self):
+        """启动常驻处理线程，线程按实际分片分配，未分片时全部处理分片 0"""
+        with self.pool_lock:
+            for i in range(self.num_workers):
+                self._spawn(i % self.file_buffer.num_shards, core=True)
+    
+    def join(self):
+        """等待所有处理线程退出"""
+        with self.pool_lock:
+            workers = list(self.workers)
+        for worker in workers:
+            worker.join()
+    
+    def _spawn(self, shard, core):
+        """启动一个处理线程(需持有 pool_lock)"""
+        worker = Thread(
+            target=self._process_batches, args=(shard, core), daemon=True,
+            name=f"BatchProcessor-{self.next_worker_id}"
+        )
+        self.next_worker_id += 1
+        self.workers.append(worker)
+        self.shard_workers[shard] += 1
+        worker.start()
+        
+    def _process_batches(self, shard, core=True):
+        """
+        处理文件批次，分片模式下每个线程只处理自己的分片
+        
+        常驻线程空闲时一直阻塞在缓冲区上，没有定期唤醒；临时线程空闲超过
+        idle_timeout 后退出
+        """
+        timeout = None if core else self.idle_timeout
+        try:
+            while not self.should_stop:
+                # 获取一批文件(阻塞直到批次就绪、空闲超时或缓冲区关闭)
+                batch = self.file_buffer.get_batch(timeout=timeout, shard=shard)
+                
+                if not batch:
+                    if not core and self._retire(shard):
+                        return
+                    continue
+                
+                with self.pool_lock:
+                    self.shard_busy[shard] += 1
+                    self._maybe_scale_up(shard)
+                
+                BATCH_SIZE.observe(len(batch))
+                
+                # 处理批次，每个文件完成时立即更新结果
+                try:
+                    if self.action_slots is None:
+                        results = self.action.process_batch(batch, on_complete=self._on_file_done)
+                    else:
+                        with self.action_slots:
+                            results = self.action.process_batch(batch, on_complete=self._on_file_done)
+                finally:
+                    with self.pool_lock:
+                        self.shard_busy[shard] -= 1
+                
+                # 更新统计
+                with self.stats_lock:
+                    self.stats['processed'] += len(batch)
+                    self.stats['batches'] += 1
+                
+                logger.debug(f"处理批次: {len(batch)} 个文件, 成功: {sum(results.values())}")
+        finally:
+            # 临时线程会反复创建和退出，退出时回收它的指标单元
+            retire_thread_cells()
+    
+    def _maybe_scale_up(self, shard):
+        """
+        分片的线程都在忙且仍积压至少一批时为该分片增加一个线程(需持有 pool_lock)
+        
+        分片模式下每个分片只由一个线程处理，保证同一目录的文件严格按顺序编号，
+        所以只在未分片时扩容
+        """
+        count = len(self.workers)
+        if count >= self.max_workers or self.shard_busy.get(shard, 0) < self.shard_workers.get(shard, 0):
+            return
+        if self.file_buffer.num_shards > 1:
+            return
+        backlog = self.file_buffer.shard_depth(shard)
+        if backlog < self.file_buffer.batch_size:
+            return
+            
+        self._spawn(shard, core=False)
+        self.scaling.inc('up')
+        logger.info(f"扩容处理线程: {count} -> {count + 1} (分片 {shard} 积压: {backlog})")
+    
+    def _retire(self, shard):
+        """
+        临时线程空闲超时后退出
+        
+        Returns:
+            bool: 是否退出
+        """
+        with self.pool_lock:
+            if self.should_stop:
+                return True
+            self.workers.remove(current_thread())
+            self.shard_workers[shard] -= 1
+            count = len(self.workers)
+        self.scaling.inc('down')
+        logger.info(f"缩容处理线程: {count + 1} -> {count}")
+        return True
+    
+    def _on_file_done(self, file_path, success):
+        """单个文件处理完成"""
+        if success:
+            self.file_buffer.mark_success(file_path)
+            with self.stats_lock:
+                self.stats['succeeded'] += 1
+        else:
+            self.file_buffer.mark_failed(file_path)
+            with self.stats_lock:
+                self.stats['failed'] += 1
+    
+    def get_stats(self):
+        """获取处理统计"""
+        with self.stats_lock:
+            return self.stats.copy()
+
+class BatchController:
+    """自适应批处理控制器 - 根据到达速率、积压和 p99 延迟在运行中调整批次大小和超时时间"""
+    
+    def __init__(self, file_buffer, batch_processor, target_latency=0.2, min_batch_size=1, max_batch_size=100,
+                 min_timeout=0.005, max_timeout=0.5, interval=1.0, step=5):
+        """
+        初始化自适应批处理控制器
+        
+        Args:
+            file_buffer: 文件缓冲区(需提供 set_batch_params)
+            batch_processor: 批处理器
+            target_latency: p99 端到端延迟目标(秒)
+            min_batch_size: 批次大小下限
+            max_batch_size: 批次大小上限
+            min_timeout: 超时时间下限(秒)
+            max_timeout: 超时时间上限(秒)
+            interval: 控制周期(秒)
+            step: 每次加性增大的批次大小
+        """
+        self.file_buffer = file_buffer
+        self.batch_processor = batch_processor
+        self.target_latency = target_latency
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max(min_batch_size, max_batch_size)
+        self.min_timeout = min_timeout
+        self.max_timeout = max(min_timeout, max_timeout)
+        self.interval = interval
+        self.step_size = step
+        self.batch_size = file_buffer.batch_size
+        self.batch_timeout = file_buffer.batch_timeout
+        self.arrival_rate = 0.0
+        self.should_stop = Event()
+        self.controller_thread = None
+        self._last = None
+        
+        self.adjustments = METRICS.register(
+            Counter('renamer_batch_adjustments_total', "自适应批处理的决策次数", label='action')
+        )
+        METRICS.gauge('batch_size_target', "当前的批次大小", lambda: self.batch_size)
+        METRICS.gauge('batch_timeout_seconds', "当前的批处理超时时间", lambda: self.batch_timeout)
+        METRICS.gauge('arrival_rate', "最近一个控制周期的文件到达速率(个/秒)", lambda: self.arrival_rate)
+        
+    def start(self):
+        """启动控制线程"""
+        self._last = self._sample()
+        self.controller_thread = Thread(target=self._run, daemon=True, name="BatchController")
+        self.controller_thread.start()
+        
+    def stop(self):
+        """停止控制线程"""
+        self.should_stop.set()
+        if self.controller_thread is not None:
+            self.controller_thread.join()
+            
+    def _run(self):
+        while not self.should_stop.wait(self.interval):
+            self.step()
+    
+    def _sample(self):
+        """采样 (时间, 已处理数, 积压数, 延迟直方图的桶)"""
+        processed = self.batch_processor.get_stats()['processed']
+        backlog = self.file_buffer.get_stats()['buffer_size']
+        buckets = CREATE_TO_RENAME.collect()[0]
+        return time.monotonic(), processed, backlog, buckets
+    
+    def step(self):
+        """
+        执行一次控制决策
+        
+        积压时加性增大批次，减少取批次时的加锁和唤醒；无积压但 p99 超出目标时
+        乘性减小。超时时间按到达速率估算：半个延迟预算内能凑满一批时等到凑满为止，
+        否则等待只会增加延迟，立即刷新
+        
+        Returns:
+            str: 决策 increase / decrease / hold
+        """
+        sample = self._sample()
+        now, processed, backlog, buckets = sample
+        last_time, last_processed, last_backlog, last_buckets = self._last
+        self._last = sample
+        elapsed = now - last_time
+        if elapsed <= 0:
+            return 'hold'
+            
+        processed -= last_processed
+        self.arrival_rate = max(0, processed + backlog - last_backlog) / elapsed
+        window = [n - p for n, p in zip(buckets, last_buckets)]
+        p99 = CREATE_TO_RENAME.quantiles(window, (0.99,)).get(0.99)
+        
+        batch_size = self.batch_size
+        if backlog >= batch_size:
+            batch_size = min(self.max_batch_size, batch_size + self.step_size)
+        elif p99 is not None and p99 > self.target_latency:
+            batch_size = max(self.min_batch_size, batch_size // 2)
+            
+        budget = min(self.max_timeout, self.target_latency / 2)
+        if self.arrival_rate * budget < batch_size:
+            timeout = self.min_timeout
+        else:
+            timeout = max(self.min_timeout, batch_size / self.arrival_rate)
+        
+        action = 'hold'
+        if batch_size > self.batch_size:
+            action = 'increase'
+        elif batch_size < self.batch_size:
+            action = 'decrease'
+        self.adjustments.inc(action)
+        
+        if batch_size != self.batch_size or abs(timeout - self.batch_timeout) > 1e-3:
+            logger.debug(
+                f"自适应批处理 - 批大小: {self.batch_size} -> {batch_size}, "
+                f"超时: {self.batch_timeout * 1000:.0f}ms -> {timeout * 1000:.0f}ms, "
+                f"到达速率: {self.arrival_rate:.1f}/秒, 积压: {backlog}, "
+                f"p99: {'-' if p99 is None else f'{p99 * 1000:.1f}ms'}"
+            )
+            self.batch_size = batch_size
+            self.batch_timeout = timeout
+            self.file_buffer.set_batch_params(batch_size, timeout)
+        return action
+
+class ReconcileScanner:
+    """对账扫描器 - 增量扫描监控目录，补处理漏掉事件的文件"""
+    
+    def __init__(self, file_buffer, action, directories, recursive=False, budget=1000,
+                 tick_interval=0.1, min_interval=1.0, max_interval=300.0, min_age=2.0):
+        """
+        初始化对账扫描器
+        
+        Args:
+            file_buffer: 文件缓冲区
+            action: 批处理动作，用它的 filter 判断文件是否需要补处理，见 BatchAction
+            directories: 要扫描的目录
+            recursive: 是否递归扫描子目录
+            budget: 每次扫描最多检查多少个目录项
+            tick_interval: 同一轮扫描中两次扫描之间的间隔(秒)
+            min_interval: 发现事件丢失时两轮扫描的最短间隔(秒)
+            max_interval: 没有丢失时两轮扫描的最长间隔(秒)
+            min_age: 只补处理变更时间早于这么久(秒)的文件，更新的文件交给事件处理
+        """
+        self.file_buffer = file_buffer
+        self.action = action
+        self.directories = list(directories)
+        self.recursive = recursive
+        self.budget = budget
+        self.tick_interval = tick_interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = max_interval
+        self.min_age = min_age
+        self.should_stop = False
+        self.scanner_thread = None
+        self._wake = Event()  # 开始新一轮扫描
+        self._stopped = Event()  # 只在停止时设置，用于扫描中的节流等待
+        self._loss_signaled = False
+        self._last_dropped = 0
+        self.stats = {
+            'passes': 0,
+            'scanned': 0,
+            'found': 0
+        }
+        self.stats_lock = Lock()
+        
+    def start(self):
+        """启动对账扫描线程"""
+        self.scanner_thread = Thread(target=self._run, daemon=True, name="ReconcileScanner")
+        self.scanner_thread.start()
+    
+    def stop(self):
+        """停止扫描并立即唤醒扫描线程"""
+        self.should_stop = True
+        self._stopped.set()
+        self._wake.set()
+        
+    def notify_loss(self):
+        """报告可能的事件丢失(例如 inotify 队列溢出)，立即开始新一轮扫描"""
+        self._loss_signaled = True
+        self._wake.set()
+    
+    def _run(self):
+        """按自适应间隔循环执行对账扫描"""
+        while not self.should_stop:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            if self.should_stop:
+                break
+                
+            self._loss_signaled = False
+            found = self._scan_pass()
+            
+            # watchdog 不会把 IN_Q_OVERFLOW 交给事件处理器，
+            # 用扫描补到的文件数和缓冲区丢弃数作为事件丢失的信号
+            dropped = self.file_buffer.get_stats()['dropped']
+            lost = found > 0 or dropped > self._last_dropped or self._loss_signaled
+            self._last_dropped = dropped
+            
+            if lost:
+                self.interval = self.min_interval
+            else:
+                self.interval = min(self.max_interval, self.interval * 2)
+                
+            logger.debug(f"对账扫描完成: 补处理 {found} 个文件, 下次间隔 {self.interval:.1f}秒")
+    
+    def _iter_entries(self):
+        """依次遍历各目录的目录项，生成器本身就是扫描游标"""
+        pending = [os.path.abspath(directory) for directory in self.directories]
+        while pending:
+            directory = pending.pop()
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if self.recursive and entry.is_dir(follow_symlinks=False):
+                            if entry.name not in self.action.ignored_dirs:
+                                pending.append(entry.path)
+                            continue
+                        yield entry
+            except OSError as e:
+                logger.debug(f"对账扫描无法读取目录 {directory}: {e}")
+    
+    def _scan_pass(self):
+        """
+        执行一轮扫描，每次最多检查 budget 个目录项，之间让出 tick_interval
+        
+        Returns:
+            int: 补处理的文件数
+        """
+        found = 0
+        scanned = 0
+        # 本轮开始前的唤醒已经生效；扫描中再次报告丢失时，本轮结束后立即开始下一轮
+        self._wake.clear()
+        for entry in self._iter_entries():
+            if self.should_stop:
+                break
+                
+            scanned += 1
+            if scanned % self.budget == 0:
+                # 不能等 _wake：它被设置后会一直立即返回，预算限制就失效了
+                self._stopped.wait(self.tick_interval)
+            
+            # 与事件使用同一个过滤(重命名时包括处理中、已编号和内容重复的文件)
+            file_path = Path(entry.path)
+            if self.action.filter(file_path) is not None:
+                continue
+            if not entry.is_file():
+                continue
+                
+            # 只有候选文件才 stat；刚变更的文件事件可能还在路上，也可能已被重命名
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            if time.time() - max(stat.st_mtime, stat.st_ctime) < self.min_age:
+                continue
+                
+            if self.file_buffer.add_file(file_path):
+                logger.info(f"对账扫描发现未处理文件: {file_path.name}")
+                found += 1
+                
+        with self.stats_lock:
+            self.stats['passes'] += 1
+            self.stats['scanned'] += scanned
+            self.stats['found'] += found
+        return found
+    
+    def get_stats(self):
+        """获取对账扫描统计"""
+        with self.stats_lock:
+            stats = self.stats.copy()
+        stats['interval'] = self.interval
+        return stats
+
+class Backfiller:
+    """存量补编号 - 扫描目录中已存在的未编号文件，按确定顺序批量预留序号并行重命名"""
+    
+    ORDERS = ("mtime", "name")
+    
+    def __init__(self, renamer, directories, recursive=False, order="mtime", workers=8, chunk_size=10000,
+                 since=None, file_buffer=None):
+        """
+        初始化存量补编号
+        
+        Args:
+            renamer: 文件重命名器
+            directories: 要处理的目录
+            recursive: 是否递归处理子目录
+            order: 编号顺序，mtime 按修改时间(相同时按文件名)，name 按文件名
+            workers: 并行重命名的线程数
+            chunk_size: 每次预留序号、写入意图的文件数
+            since: 只处理变更时间早于该时间戳的文件，之后的文件交给事件处理，None 表示不限制
+            file_buffer: 与实时监控同时运行时的缓冲区(FileBuffer 或 AsyncPipeline)，
+                重命名前通过它占用文件，避免事件或对账扫描同时处理同一个文件
+                
+        Raises:
+            ValueError: 动作不支持存量补编号(supports_backfill 为 False)
+        """
+        if not renamer.supports_backfill:
+            raise ValueError(f"批处理动作 {renamer.name} 不支持存量补编号")
         self.renamer = renamer
-        self.num_workers = num_workers
-        self.workers = []
+        self.directories = list(directories)
+        self.recursive = recursive
+        self.order = order
+        self.workers = workers
+        self.chunk_size = max(1, chunk_size)
+        self.since = since
+        self.file_buffer = file_buffer
         self.should_stop = False
+        self.backfill_thread = None
         self.stats = {
-            'processed': 0,
+            'directories': 0,
+            'scanned': 0,
+            'candidates': 0,
             'succeeded': 0,
             'failed': 0,
-            'batches': 0
+            'duplicates': 0,
+            'busy': 0
         }
         self.stats_lock = Lock()
+        self.results = METRICS.register(Counter('renamer_backfill_total', "存量补编号处理的文件数", label='result'))
         
     def start(self):
-        """启动处理线程"""
-        for i in range(self.num_workers):
-            worker = Thread(target=self._process_batches, daemon=True, name=f"BatchProcessor-{i}")
-            worker.start()
-            self.workers.append(worker)
-        
-    def _process_batches(self):
-        """处理文件批次"""
-        while not self.should_stop:
-            # 获取一批文件
-            batch = self.file_buffer.get_batch()
+        """在后台线程中运行，与实时监控同时进行"""
+        self.backfill_thread = Thread(target=self.run, daemon=True, name="Backfiller")
+        self.backfill_thread.start()
+    
+    def stop(self):
+        """当前批次完成后停止"""
+        self.should_stop = True
+    
+    def join(self, timeout=None):
+        """等待后台线程结束"""
+        if self.backfill_thread is not None:
+            self.backfill_thread.join(timeout)
+    
+    def run(self):
+        """
+        依次处理每个目录
+        
+        Returns:
+            dict: 统计信息
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="Backfill") as pool:
+            for directory in self._iter_directories():
+                if self.should_stop:
+                    break
+                self._backfill_directory(directory, pool)
+                
+        stats = self.get_stats()
+        elapsed = time.perf_counter() - started
+        logger.info(
+            f"存量补编号完成 - 目录: {stats['directories']}, 检查: {stats['scanned']}, "
+            f"待编号: {stats['candidates']}, 成功: {stats['succeeded']}, 失败: {stats['failed']}, "
+            f"重复: {stats['duplicates']}, 已由事件处理: {stats['busy']}, 耗时: {elapsed:.2f}秒 "
+            f"({stats['succeeded'] / elapsed if elapsed > 0 else 0:.0f} 个/秒)"
+        )
+        return stats
+    
+    def _iter_directories(self):
+        """依次给出要处理的目录，递归时跳过临时目录等内部目录"""
+        pending = [os.path.abspath(directory) for directory in reversed(self.directories)]
+        while pending:
+            directory = pending.pop()
+            yield directory
+            if not self.recursive:
+                continue
+            try:
+                with os.scandir(directory) as entries:
+                    subdirs = sorted(
+                        entry.path for entry in entries
+                        if entry.is_dir(follow_symlinks=False) and entry.name not in self.renamer.ignored_dirs
+                    )
+            except OSError as e:
+                logger.warning(f"存量补编号无法读取目录 {directory}: {e}")
+                continue
+            pending.extend(reversed(subdirs))
+    
+    def _collect(self, directory):
+        """
+        扫描目录，按编号顺序返回待处理的文件
+        
+        Returns:
+            list: 文件路径列表
+        """
+        need_stat = self.order == "mtime" or self.since is not None
+        candidates = []
+        scanned = 0
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    scanned += 1
+                    # 先用文件名过滤，只有候选文件才 stat
+                    if self.renamer.classify(entry.name) is not None:
+                        continue
+                    if not entry.is_file():
+                        continue
+                    if not need_stat:
+                        candidates.append((entry.name, entry.name))
+                        continue
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    if self.since is not None and max(stat.st_mtime, stat.st_ctime) >= self.since:
+                        continue
+                    key = (stat.st_mtime_ns, entry.name) if self.order == "mtime" else entry.name
+                    candidates.append((key, entry.name))
+        except OSError as e:
+            logger.warning(f"存量补编号无法读取目录 {directory}: {e}")
             
-            if not batch:
+        candidates.sort()
+        with self.stats_lock:
+            self.stats['directories'] += 1
+            self.stats['scanned'] += scanned
+            self.stats['candidates'] += len(candidates)
+        base = Path(directory)
+        return [base / name for _, name in candidates]
+    
+    def _backfill_directory(self, directory, pool):
+        """处理单个目录：分块占用文件、预留序号、写入意图、并行重命名"""
+        file_paths = self._collect(directory)
+        if not file_paths:
+            return
+        logger.info(f"存量补编号: {directory} 有 {len(file_paths)} 个待编号文件")
+        
+        counter = self.renamer.get_counter(directory)
+        for i in range(0, len(file_paths), self.chunk_size):
+            if self.should_stop:
+                logger.info("存量补编号已中断，剩余文件留待下次处理")
+                break
+            chunk = file_paths[i:i + self.chunk_size]
+            if self.file_buffer is None:
+                if not self._backfill_chunk(counter, chunk, pool):
+                    break
                 continue
-                
-            # 处理批次
-            results = self.renamer.process_files_batch(batch)
             
-            # 更新结果
-            for file_path, success in results.items():
-                if success:
-                    self.file_buffer.mark_success(file_path.name)
-                    with self.stats_lock:
-                        self.stats['succeeded'] += 1
-                else:
-                    self.file_buffer.mark_failed(file_path.name)
-                    with self.stats_lock:
-                        self.stats['failed'] += 1
+            # 先占用文件再分配序号：正在由事件处理的文件跳过，占用前已被处理(改名)的文件不再存在
+            claimed = self.file_buffer.claim(chunk)
+            try:
+                available = [file_path for file_path in claimed if os.path.lexists(file_path)]
+                with self.stats_lock:
+                    self.stats['busy'] += len(chunk) - len(available)
+                if not self._backfill_chunk(counter, available, pool):
+                    break
+            finally:
+                self.file_buffer.release(claimed)
+    
+    def _backfill_chunk(self, counter, chunk, pool):
+        """
+        处理一块文件：预留序号、写入意图、并行重命名
+        
+        Returns:
+            bool: 是否继续处理，意图日志写入失败时返回 False
+        """
+        # 内容重复的文件不占用序号，等本块重命名完成后再处理
+        deduplicator = self.renamer.deduplicator
+        duplicates = []
+        if deduplicator is not None:
+            chunk, duplicates = deduplicator.filter_batch(chunk)
+        
+        # 整块只预留一次序号，意图一起落盘
+        first = counter.reserve(len(chunk)) if chunk else 0
+        assignments = [
+            (file_path, f"{str(first + offset).zfill(self.renamer.digit_count)}{file_path.suffix}")
+            for offset, file_path in enumerate(chunk)
+        ]
+        try:
+            self.renamer.log_intents(assignments)
+        except OSError as e:
+            # 意图未落盘时不能重命名，已预留的序号留空
+            logger.error(f"写入意图日志失败，停止存量补编号: {e}")
+            for file_path, new_filename in assignments:
+                self.renamer.finish_rename(file_path, new_filename, False)
+            self._record(0, len(assignments))
+            return False
             
-            # 更新统计
+        succeeded = sum(pool.map(self._rename, assignments))
+        self._record(succeeded, len(assignments) - succeeded)
+        self.renamer.flush_intents(chunk[:1])  # 整块都在同一目录
+        
+        if duplicates:
+            deduplicator.resolve(duplicates)
             with self.stats_lock:
-                self.stats['processed'] += len(batch)
-                self.stats['batches'] += 1
-            
-            logger.debug(f"处理批次: {len(batch)} 个文件, 成功: {sum(results.values())}")
+                self.stats['duplicates'] += len(duplicates)
+            self.results.inc('duplicate', len(duplicates))
+        return True
+    
+    def _rename(self, assignment):
+        """执行重命名并兜住异常"""
+        file_path, new_filename = assignment
+        success = False
+        try:
+            success = self.renamer._rename_file(file_path, new_filename)
+        except Exception as e:
+            logger.error(f"处理文件 {file_path.name} 时发生未知错误: {e}")
+        finally:
+            self.renamer.finish_rename(file_path, new_filename, success)
+        return success
+    
+    def _record(self, succeeded, failed):
+        """累加成功、失败计数"""
+        with self.stats_lock:
+            self.stats['succeeded'] += succeeded
+            self.stats['failed'] += failed
+        self.results.inc('succeeded', succeeded)
+        self.results.inc('failed', failed)
     
     def get_stats(self):
-        """获取处理统计"""
+        """获取存量补编号统计"""
         with self.stats_lock:
             return self.stats.copy()
 
@@ -488,42 +3948,404 @@ class StatsReporter:
         """定期报告统计信息"""
         while not self.should_stop:
             time.sleep(self.report_interval)
+            self.report_once()
             
-            buffer_stats = self.file_buffer.get_stats()
-            processor_stats = self.batch_processor.get_stats()
-            event_stats = self.event_handler.get_event_stats()
-            
-            # 基础统计
+    def report_once(self):
+        """输出一次统计信息"""
+        buffer_stats = self.file_buffer.get_stats()
+        processor_stats = self.batch_processor.get_stats()
+        event_stats = self.event_handler.get_event_stats()
+        
+        # 基础统计
+        logger.info(
+            f"统计 - 缓冲区: {buffer_stats['buffer_size']}, "
+            f"处理中: {buffer_stats['processing_count']}, "
+            f"已处理: {processor_stats['processed']}, "
+            f"成功: {processor_stats['succeeded']}, "
+            f"失败: {processor_stats['failed']}, "
+            f"批次: {processor_stats['batches']}"
+        )
+        
+        # 延迟统计(来自指标直方图)
+        latency = CREATE_TO_RENAME.snapshot()
+        if latency['count']:
+            queue_wait = QUEUE_WAIT.snapshot()['quantiles']
+            rename = RENAME_SECONDS.snapshot()['quantiles']
+            logger.info(
+                f"延迟统计 - 排队 p99: {queue_wait.get(0.99, 0) * 1000:.1f}ms, "
+                f"重命名 p99: {rename.get(0.99, 0) * 1000:.2f}ms, "
+                f"端到端 p50: {latency['quantiles'][0.5] * 1000:.1f}ms, "
+                f"p99: {latency['quantiles'][0.99] * 1000:.1f}ms"
+            )
+        
+        # 溢出统计
+        if 'spilled' in buffer_stats:
             logger.info(
-                f"统计 - 缓冲区: {buffer_stats['buffer_size']}, "
-                f"处理中: {buffer_stats['processing_count']}, "
-                f"已处理: {processor_stats['processed']}, "
-                f"成功: {processor_stats['succeeded']}, "
-                f"失败: {processor_stats['failed']}, "
-                f"批次: {processor_stats['batches']}"
+                f"溢出统计 - 队列深度: {buffer_stats['spill_depth']}, "
+                f"峰值深度: {buffer_stats['peak_spill_depth']}, "
+                f"已溢出: {buffer_stats['spilled']}, "
+                f"已取回: {buffer_stats['drained']}"
+            )
+        
+        # 事件统计（调试模式）
+        if logger.getEffectiveLevel() <= logging.DEBUG:
+            logger.debug(
+                f"事件统计 - 创建: {event_stats.get('created', 0)}, "
+                f"移动: {event_stats.get('moved', 0)}, "
+                f"删除: {event_stats.get('deleted', 0)}, "
+                f"修改: {event_stats.get('modified', 0)}, "
+                f"添加到缓冲区: {event_stats.get('added_to_buffer', 0)}, "
+                f"缓冲区拒绝: {event_stats.get('buffer_rejected', 0)}, "
+                f"重复事件: {event_stats.get('duplicate', 0)}"
+            )
+            
+            dedup_stats = self.event_handler.get_dedup_stats()
+            logger.debug(
+                f"去重统计 - 条目: {dedup_stats['entries']}, "
+                f"命中: {dedup_stats['hits']}, "
+                f"未命中: {dedup_stats['misses']}, "
+                f"淘汰: {dedup_stats['evictions']}, "
+                f"命中率: {dedup_stats['hit_rate']:.1%}"
             )
             
-            # 事件统计（调试模式）
-            if logger.getEffectiveLevel() <= logging.DEBUG:
+            # 跳过原因统计
+            if any(key.startswith('skipped_') for key in event_stats):
                 logger.debug(
-                    f"事件统计 - 创建: {event_stats.get('created', 0)}, "
-                    f"移动: {event_stats.get('moved', 0)}, "
-                    f"删除: {event_stats.get('deleted', 0)}, "
-                    f"修改: {event_stats.get('modified', 0)}, "
-                    f"添加到缓冲区: {event_stats.get('added_to_buffer', 0)}, "
-                    f"缓冲区拒绝: {event_stats.get('buffer_rejected', 0)}, "
-                    f"重复事件: {event_stats.get('duplicate', 0)}"
+                    f"跳过统计 - 文件名过长: {event_stats.get('skipped_too_long', 0)}, "
+                    f"扩展名不符: {event_stats.get('skipped_wrong_extension', 0)}, "
+                    f"已编号: {event_stats.get('skipped_already_numbered', 0)}, "
+                    f"隐藏文件: {event_stats.get('skipped_hidden', 0)}, "
+                    f"其他: {event_stats.get('skipped_other', 0)}"
                 )
+
+class AsyncEventBridge(FileMonitorHandler):
+    """asyncio 引擎的事件入口 - 把 watchdog 线程中的事件原样转交给事件循环"""
+    
+    def __init__(self, pipeline, action, dedup_ttl=10.0, dedup_max_entries=10000):
+        super().__init__(None, action, dedup_ttl=dedup_ttl, dedup_max_entries=dedup_max_entries)
+        self.pipeline = pipeline
+        
+    def _handle_file_event(self, file_path, event_type):
+        """过滤和去重在事件循环中进行，这里只负责转交"""
+        self.pipeline.submit(file_path, event_type)
+
+class AsyncPipeline:
+    """asyncio 处理流水线 - 事件接收、去重、批处理、重命名和统计都是协程，通过 asyncio.Queue 连接"""
+    
+    OVERFLOW_POLICIES = ('drop', 'block')
+    
+    def __init__(self, action, buffer_size=1000, batch_size=10, batch_timeout=0.5, num_workers=3,
+                 dedup_ttl=10.0, dedup_max_entries=10000, report_interval=10,
+                 max_retries=3, retry_delay=1.0, retry_max_delay=60.0,
+                 overflow='drop', block_timeout=None):
+        """
+        初始化 asyncio 处理流水线
+        
+        Args:
+            action: 批处理动作，见 BatchAction
+            buffer_size: 原始事件队列和待处理队列的大小，待处理队列满时去重协程等待，
+                背压传到原始事件队列，原始事件队列满时按 overflow 处理
+            batch_size: 批处理大小
+            batch_timeout: 第一个文件入队后最多等待多久(秒)
+            num_workers: 重命名协程数量，也是执行重命名的线程池大小，不超过动作的并发上限
+            dedup_ttl: 事件去重条目的存活时间(秒)
+            dedup_max_entries: 事件去重索引的最大条目数
+            report_interval: 统计报告间隔(秒)
+            max_retries: 处理失败后最多重试几次
+            retry_delay: 第一次重试前的等待时间(秒)，之后每次翻倍
+            retry_max_delay: 重试等待时间上限(秒)
+            overflow: 原始事件队列满时的策略：drop 丢弃，block 阻塞提交事件的线程(watchdog 线程)
+            block_timeout: block 策略下最多阻塞多久(秒)，None 表示一直等待，超时后丢弃
+        """
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError(f"asyncio 引擎不支持的溢出策略: {overflow}")
+            
+        self.action = action
+        self.buffer_size = buffer_size
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.num_workers = min(num_workers, action.max_concurrency or num_workers)
+        self.report_interval = report_interval
+        self.event_handler = AsyncEventBridge(self, action, dedup_ttl, dedup_max_entries)
+        self.loop = None
+        self.events = None  # 原始事件
+        self.pending = None  # 去重后等待批处理的文件
+        self.batches = None  # 等待重命名的批次
+        self.executor = None
+        self.tasks = []
+        self.processing_files = {}  # 文件路径 -> 入队时间
+        self.retry = RetryScheduler(
+            self._requeue, max_retries=max_retries, base_delay=retry_delay, max_delay=retry_max_delay
+        )
+        self.stats = {
+            'processed': 0,
+            'succeeded': 0,
+            'failed': 0,
+            'batches': 0,
+            'peak_buffer_size': 0,
+            'blocked': 0,
+            'dropped': 0
+        }
+        
+    def submit(self, file_path, event_type):
+        """提交一个原始文件事件，可在任意线程调用(不能在事件循环线程中调用)"""
+        import asyncio
+        from concurrent.futures import CancelledError, TimeoutError as FutureTimeoutError
+        loop = self.loop
+        if loop is None:
+            return
+        item = (file_path, event_type)
+        try:
+            if self.overflow != 'block':
+                loop.call_soon_threadsafe(self._put_event, item)
+                return
+            # block 策略：在锁外等待事件循环放入，队列有空位前阻塞调用方
+            future = asyncio.run_coroutine_threadsafe(self._put_event_blocking(item), loop)
+        except RuntimeError:
+            # 事件循环已关闭
+            return
+        try:
+            future.result(self.block_timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            self._drop_event(item)
+        except CancelledError:
+            # 停止时被取消
+            pass
+    
+    def _put_event(self, item):
+        """在事件循环中放入原始事件，队列已满时丢弃"""
+        import asyncio
+        try:
+            self.events.put_nowait(item)
+        except asyncio.QueueFull:
+            self._drop_event(item)
+    
+    async def _put_event_blocking(self, item):
+        """block 策略下放入原始事件，队列已满时等待空位"""
+        if self.events.full():
+            self.stats['blocked'] += 1
+        await self.events.put(item)
+    
+    def _drop_event(self, item):
+        """原始事件队列已满，丢弃事件；重试事件按再失败一次继续退避"""
+        file_path, event_type = item
+        if event_type == 'retry':
+            self.retry.failed(file_path)
+            return
+        self.stats['dropped'] += 1
+        logger.warning("事件队列已满，丢弃文件: %s", Path(file_path).name)
+    
+    async def start(self):
+        """创建队列并启动所有协程，需在事件循环中调用"""
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+        self.loop = asyncio.get_running_loop()
+        self.events = asyncio.Queue(maxsize=self.buffer_size)
+        self.pending = asyncio.Queue(maxsize=self.buffer_size)
+        self.batches = asyncio.Queue(maxsize=self.num_workers)
+        self.executor = ThreadPoolExecutor(max_workers=self.num_workers, thread_name_prefix="AsyncRename")
+        
+        coroutines = [self._dedup(), self._batcher(), self._reporter(), self._cleaner()]
+        coroutines += [self._rename_worker() for _ in range(self.num_workers)]
+        self.tasks = [asyncio.create_task(coroutine) for coroutine in coroutines]
+    
+    async def stop(self):
+        """取消所有协程，正在执行的重命名批次会先完成"""
+        import asyncio
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        self.loop = None
+        self.executor.shutdown(wait=True)
+        self.retry.stop()
+    
+    def claim(self, file_paths):
+        """占用一组文件，见 FileBuffer.claim，在事件循环以外的线程中调用"""
+        import asyncio
+        loop = self.loop
+        if loop is None:
+            return []
+        
+        async def claim():
+            claimed = []
+            now = time.monotonic()
+            for file_path in file_paths:
+                key = str(file_path)
+                if key in self.processing_files or self.retry.is_dead(key):
+                    continue
+                self.processing_files[key] = now
+                claimed.append(file_path)
+            return claimed
+        
+        return asyncio.run_coroutine_threadsafe(claim(), loop).result()
+    
+    def release(self, file_paths):
+        """释放 claim 占用的文件，可在任意线程调用"""
+        loop = self.loop
+        if loop is None:
+            return
+        
+        def release():
+            for file_path in file_paths:
+                self.processing_files.pop(str(file_path), None)
+        
+        try:
+            loop.call_soon_threadsafe(release)
+        except RuntimeError:
+            # 事件循环已关闭
+            pass
+    
+    def _requeue(self, file_path):
+        """重试到期(在调度线程中调用)，文件仍存在时作为重试事件交给事件循环"""
+        if not file_path.exists():
+            self.retry.forget(file_path)
+            return False
+        loop = self.loop
+        if loop is None:
+            return False
+        try:
+            loop.call_soon_threadsafe(self._put_event, (file_path, 'retry'))
+        except RuntimeError:
+            # 事件循环已关闭
+            return False
+        return True
+    
+    async def _dedup(self):
+        """过滤、去重，并把需要处理的文件放入待处理队列"""
+        event_stats = self.event_handler.event_stats
+        while True:
+            file_path, event_type = await self.events.get()
+            path_obj = Path(file_path)
+            # 重试的文件已经过滤过，也不能被事件去重拦下
+            if event_type != 'retry' and not self.event_handler.filter_event(path_obj, event_type):
+                continue
                 
-                # 跳过原因统计
-                if any(key.startswith('skipped_') for key in event_stats):
-                    logger.debug(
-                        f"跳过统计 - 文件名过长: {event_stats.get('skipped_too_long', 0)}, "
-                        f"扩展名不符: {event_stats.get('skipped_wrong_extension', 0)}, "
-                        f"已编号: {event_stats.get('skipped_already_numbered', 0)}, "
-                        f"隐藏文件: {event_stats.get('skipped_hidden', 0)}, "
-                        f"其他: {event_stats.get('skipped_other', 0)}"
-                    )
+            key = str(path_obj)
+            if key in self.processing_files or self.retry.is_dead(key):
+                event_stats.inc('buffer_rejected')
+                continue
+                
+            self.processing_files[key] = time.monotonic()
+            if self.pending.full():
+                self.stats['blocked'] += 1
+            await self.pending.put(path_obj)
+            self.stats['peak_buffer_size'] = max(self.stats['peak_buffer_size'], self.pending.qsize())
+            event_stats.inc('added_to_buffer')
+    
+    async def _batcher(self):
+        """凑满 batch_size 个文件，或第一个文件等待满 batch_timeout 后交给重命名协程"""
+        import asyncio
+        while True:
+            batch = [await self.pending.get()]
+            deadline = self.loop.time() + self.batch_timeout
+            while len(batch) < self.batch_size:
+                remaining = deadline - self.loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.pending.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+                    
+            now = time.monotonic()
+            for file_path in batch:
+                enqueued = self.processing_files.get(str(file_path))
+                if enqueued is not None:
+                    QUEUE_WAIT.observe(now - enqueued)
+            BATCH_SIZE.observe(len(batch))
+            await self.batches.put(batch)
+    
+    async def _rename_worker(self):
+        """在线程池中执行重命名，不阻塞事件循环"""
+        import asyncio
+        while True:
+            batch = await self.batches.get()
+            future = self.loop.run_in_executor(self.executor, self.action.process_batch, batch)
+            try:
+                results = await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # 停止时等当前批次完成再退出，保证统计准确
+                self._record(batch, await future)
+                raise
+            self._record(batch, results)
+    
+    def _record(self, batch, results):
+        """记录一个批次的处理结果"""
+        now = time.monotonic()
+        for file_path, success in results.items():
+            key = str(file_path)
+            enqueued = self.processing_files.pop(key, None)
+            if success:
+                if enqueued is not None:
+                    CREATE_TO_RENAME.observe(now - enqueued)
+                self.retry.succeeded(file_path)
+                self.stats['succeeded'] += 1
+            else:
+                self.retry.failed(file_path)
+                self.stats['failed'] += 1
+        self.stats['processed'] += len(batch)
+        self.stats['batches'] += 1
+        logger.debug(f"处理批次: {len(batch)} 个文件, 成功: {sum(results.values())}")
+    
+    async def _reporter(self):
+        """定期报告统计信息"""
+        import asyncio
+        reporter = StatsReporter(self, self, self.event_handler, self.report_interval)
+        while True:
+            await asyncio.sleep(self.report_interval)
+            reporter.report_once()
+    
+    async def _cleaner(self):
+        """定期清理去重索引中已过期的条目"""
+        import asyncio
+        while True:
+            await asyncio.sleep(10)
+            self.event_handler.recent_events.purge_expired()
+    
+    def set_batch_params(self, batch_size, batch_timeout):
+        """调整批次大小和超时时间，从下一个批次开始生效"""
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+    
+    def get_stats(self):
+        """获取统计信息，同时提供缓冲区和批处理器两类统计字段"""
+        stats = self.stats.copy()
+        stats['buffer_size'] = self.pending.qsize() if self.pending is not None else 0
+        stats['processing_count'] = len(self.processing_files)
+        stats.update(self.retry.get_stats())
+        return stats
+
+class StartupProfiler:
+    """启动耗时统计 - 记录从导入模块到开始监控的各阶段耗时，以及后台初始化的耗时"""
+    
+    def __init__(self, started=_IMPORT_STARTED):
+        self.started = started
+        self.last = started
+        self.phases = []  # (阶段, 开始时间, 耗时)
+        self.lock = Lock()
+        
+    def mark(self, phase):
+        """记录从上一阶段结束到现在的耗时"""
+        now = time.perf_counter()
+        with self.lock:
+            self.phases.append((phase, self.last, now - self.last))
+            self.last = now
+        
+    def record(self, phase, started):
+        """记录一个与主流程并行的阶段(从 started 到现在)"""
+        with self.lock:
+            self.phases.append((phase, started, time.perf_counter() - started))
+    
+    def report(self):
+        """输出各阶段耗时(毫秒)，开始时间相对于开始导入本模块"""
+        with self.lock:
+            phases = list(self.phases)
+        for phase, started, elapsed in phases:
+            logger.info(f"启动耗时 - {phase}: {elapsed * 1000:.1f}ms (开始于 {(started - self.started) * 1000:.1f}ms)")
 
 class GracefulExiter:
     """优雅退出处理器"""
@@ -542,59 +4364,297 @@ def parse_arguments():
     """解析命令行参数"""
     parser = argparse.ArgumentParser(description="文件监控与重命名脚本")
     parser.add_argument(
-        "-e", "--extension", 
-        required=True,
-        help="要监控的文件后缀，例如: jpg, png, gif 等。支持多个后缀，用逗号分隔，如: jpg,png,gif"
+        "directories", 
+        nargs="*",
+        default=["."],
+        help="要监控的目录，可指定多个，每个目录独立编号，默认是当前目录"
+    )
+    parser.add_argument(
+        "-r", "--recursive", 
+        action="store_true",
+        help="递归监控子目录，每个子目录独立编号"
+    )
+    parser.add_argument(
+        "-e", "--extension", 
+        required=True,
+        help="要监控的文件后缀，例如: jpg, png, gif 等。支持多个后缀，用逗号分隔，如: jpg,png,gif"
+    )
+    parser.add_argument(
+        "-d", "--digits", 
+        type=int, 
+        default=3,
+        help="序号的位数，默认是 3"
+    )
+    parser.add_argument(
+        "-i", "--ignore-case", 
+        action="store_true",
+        help="是否忽略文件后缀的大小写"
+    )
+    parser.add_argument(
+        "-p", "--pattern", 
+        help="直接指定正则表达式模式，覆盖 --extension 参数"
+    )
+    parser.add_argument(
+        "--engine", 
+        choices=["thread", "asyncio"],
+        default="thread",
+        help="运行引擎：thread 每个组件一个线程，asyncio 所有组件作为协程运行在同一个事件循环中，默认是 thread"
+    )
+    parser.add_argument(
+        "-w", "--workers", 
+        type=int, 
+        default=3,
+        help="处理线程数量，默认是 3"
+    )
+    parser.add_argument(
+        "--max-workers", 
+        type=int, 
+        default=None,
+        help="处理线程数上限，积压时在 --workers 与该值之间自动扩容，默认不扩容；多目录或递归监控时每个目录分片只有一个线程，不扩容"
+    )
+    parser.add_argument(
+        "--worker-idle-timeout", 
+        type=float, 
+        default=30.0,
+        help="扩容出的处理线程空闲多久(秒)后退出，默认是 30"
+    )
+    parser.add_argument(
+        "--rename-executor", 
+        choices=["serial", "pool"],
+        default="serial",
+        help="重命名执行方式：serial 在处理线程内逐个处理，pool 提交到共享线程池并行处理，默认是 serial"
+    )
+    parser.add_argument(
+        "--rename-pool-size", 
+        type=int, 
+        default=8,
+        help="pool 执行方式下的线程池大小，默认是 8"
+    )
+    parser.add_argument(
+        "--direct-rename", 
+        action="store_true",
+        help="不经过临时目录，一次原子移动直接重命名为最终文件名"
+    )
+    parser.add_argument(
+        "-t", "--temp-dir", 
+        default=".temp_rename",
+        help="临时目录名称，默认是 .temp_rename"
+    )
+    parser.add_argument(
+        "--buffer-size", 
+        type=int, 
+        default=1000,
+        help="缓冲区大小，默认是 1000"
+    )
+    parser.add_argument(
+        "--overflow", 
+        choices=FileBuffer.OVERFLOW_POLICIES,
+        default="drop",
+        help="缓冲区满时的策略：drop 丢弃，spill 写入磁盘溢出队列后按顺序取回(asyncio 引擎不支持)，block 阻塞监控线程，默认是 drop"
+    )
+    parser.add_argument(
+        "--spill-file", 
+        default=".rename_spill",
+        help="spill 策略下的溢出队列文件，默认是 .rename_spill"
+    )
+    parser.add_argument(
+        "--block-timeout", 
+        type=float, 
+        default=None,
+        help="block 策略下最多阻塞多久(秒)，超时后丢弃，默认一直等待"
+    )
+    parser.add_argument(
+        "--batch-size", 
+        type=int, 
+        default=10,
+        help="批处理大小，默认是 10"
+    )
+    parser.add_argument(
+        "--batch-timeout", 
+        type=float, 
+        default=0.5,
+        help="批处理超时时间(秒)，默认是 0.5"
+    )
+    parser.add_argument(
+        "--adaptive-batch", 
+        action="store_true",
+        help="根据到达速率和延迟在运行中自动调整批处理大小和超时时间，--batch-size 和 --batch-timeout 作为初始值"
+    )
+    parser.add_argument(
+        "--target-latency", 
+        type=float, 
+        default=0.2,
+        help="自适应批处理的 p99 端到端延迟目标(秒)，默认是 0.2"
+    )
+    parser.add_argument(
+        "--max-batch-size", 
+        type=int, 
+        default=100,
+        help="自适应批处理的批次大小上限，默认是 100"
+    )
+    parser.add_argument(
+        "--content-dedup", 
+        choices=("off",) + ContentDeduplicator.ACTIONS,
+        default="off",
+        help="按文件内容识别重复文件，重复文件不编号：skip 保留原样，link 替换为指向已编号文件的硬链接，aside 移到 --duplicates-dir 目录，默认是 off"
+    )
+    parser.add_argument(
+        "--duplicates-dir", 
+        default=".duplicates",
+        help="aside 方式下存放重复文件的子目录名，默认是 .duplicates"
+    )
+    parser.add_argument(
+        "--hash-workers", 
+        type=int, 
+        default=2,
+        help="计算文件摘要的进程数，默认是 2"
+    )
+    parser.add_argument(
+        "--max-retries", 
+        type=int, 
+        default=3,
+        help="处理失败的文件最多重试几次，仍失败则放入死信列表，默认是 3"
+    )
+    parser.add_argument(
+        "--retry-delay", 
+        type=float, 
+        default=1.0,
+        help="第一次重试前的等待时间(秒)，之后每次翻倍并加入随机抖动，默认是 1"
+    )
+    parser.add_argument(
+        "--retry-max-delay", 
+        type=float, 
+        default=60.0,
+        help="重试等待时间上限(秒)，默认是 60"
+    )
+    parser.add_argument(
+        "--max-filename-length", 
+        type=int, 
+        default=255,
+        help="最大文件名长度限制，默认是 255"
+    )
+    parser.add_argument(
+        "--stable-quiet", 
+        type=float, 
+        default=0,
+        help="新文件的大小和修改时间在这段时间(秒)内不再变化才处理，收到写关闭事件时立即处理，默认 0 表示不等待"
     )
     parser.add_argument(
-        "-d", "--digits", 
+        "--stable-max-pending", 
         type=int, 
-        default=3,
-        help="序号的位数，默认是 3"
+        default=10000,
+        help="等待稳定的文件数上限，超过时直接处理，默认是 10000"
     )
     parser.add_argument(
-        "-i", "--ignore-case", 
+        "--dedup-ttl", 
+        type=float, 
+        default=10.0,
+        help="事件去重条目的存活时间(秒)，默认是 10"
+    )
+    parser.add_argument(
+        "--dedup-max-entries", 
+        type=int, 
+        default=10000,
+        help="事件去重索引的最大条目数，默认是 10000"
+    )
+    parser.add_argument(
+        "--reconcile-interval", 
+        type=float, 
+        default=0,
+        help="对账扫描的最长间隔(秒)，用于补处理漏掉事件的文件，发现丢失时自动加快，默认 0 表示不启用"
+    )
+    parser.add_argument(
+        "--reconcile-budget", 
+        type=int, 
+        default=1000,
+        help="对账扫描每次最多检查的目录项数，默认是 1000"
+    )
+    parser.add_argument(
+        "--backfill", 
         action="store_true",
-        help="是否忽略文件后缀的大小写"
+        help="启动时给目录中已存在的未编号文件补编号，与实时监控同时进行"
     )
     parser.add_argument(
-        "-p", "--pattern", 
-        help="直接指定正则表达式模式，覆盖 --extension 参数"
+        "--backfill-only", 
+        action="store_true",
+        help="只给目录中已存在的未编号文件补编号，完成后退出，不启动监控"
     )
     parser.add_argument(
-        "-w", "--workers", 
+        "--backfill-order", 
+        choices=Backfiller.ORDERS,
+        default="mtime",
+        help="补编号顺序：mtime 按修改时间(相同时按文件名)，name 按文件名，默认是 mtime"
+    )
+    parser.add_argument(
+        "--backfill-workers", 
         type=int, 
-        default=3,
-        help="处理线程数量，默认是 3"
+        default=8,
+        help="补编号时并行重命名的线程数，默认是 8"
     )
     parser.add_argument(
-        "-t", "--temp-dir", 
-        default=".temp_rename",
-        help="临时目录名称，默认是 .temp_rename"
+        "--backfill-chunk", 
+        type=int, 
+        default=10000,
+        help="补编号时每次预留序号、写入意图的文件数，默认是 10000"
     )
     parser.add_argument(
-        "--buffer-size", 
+        "--instance", 
+        default=None,
+        help="多个进程共享同一目录时本进程的编号/实例总数，如 0/2，按文件名哈希分担文件，序号按块租用，默认单实例"
+    )
+    parser.add_argument(
+        "--lease-file", 
+        default=".rename_lease",
+        help="多实例模式下的序号租约文件，默认是 .rename_lease"
+    )
+    parser.add_argument(
+        "--lease-size", 
         type=int, 
-        default=1000,
-        help="缓冲区大小，默认是 1000"
+        default=100,
+        help="多实例模式下每次租用的序号数，退出时未用完的序号可能留空，默认是 100"
     )
     parser.add_argument(
-        "--batch-size", 
+        "--journal-file", 
+        default=".rename_seq",
+        help="序号日志文件，用于快速恢复计数器，默认是 .rename_seq，设为空字符串则禁用"
+    )
+    parser.add_argument(
+        "--intent-file", 
+        default=".rename_intent",
+        help="重命名意图日志文件，每批次 fsync 一次，启动时完成崩溃前未完成的重命名，默认是 .rename_intent，设为空字符串则禁用"
+    )
+    parser.add_argument(
+        "--checkpoint-interval", 
         type=int, 
-        default=10,
-        help="批处理大小，默认是 10"
+        default=100,
+        help="每分配多少个序号写一次序号日志，默认是 100"
     )
     parser.add_argument(
-        "--batch-timeout", 
+        "--metrics-port", 
+        type=int, 
+        default=0,
+        help="在本机该端口提供 HTTP /metrics(Prometheus 文本格式)和 /metrics.json 接口，默认 0 表示不启用"
+    )
+    parser.add_argument(
+        "--metrics-file", 
+        default="",
+        help="定期写入 JSON 格式指标快照的文件，默认不写入"
+    )
+    parser.add_argument(
+        "--metrics-interval", 
         type=float, 
-        default=0.5,
-        help="批处理超时时间(秒)，默认是 0.5"
+        default=10.0,
+        help="写入指标快照的间隔(秒)，默认是 10"
     )
     parser.add_argument(
-        "--max-filename-length", 
-        type=int, 
-        default=255,
-        help="最大文件名长度限制，默认是 255"
+        "--startup-profile", 
+        action="store_true",
+        help="输出启动各阶段的耗时：导入、解析参数、创建组件、开始监控和后台初始化计数器"
+    )
+    parser.add_argument(
+        "--record-trace", 
+        default="",
+        help="把收到的文件事件(含时间和文件大小)写入二进制事件日志，可用 bench.py replay 回放，默认不记录"
     )
     parser.add_argument(
         "--debug", 
@@ -602,7 +4662,51 @@ def parse_arguments():
         help="启用调试模式，显示更详细的日志"
     )
     
-    return parser.parse_args()
+    args = parser.parse_args()
+    for directory in args.directories:
+        if not os.path.isdir(directory):
+            parser.error(f"目录不存在: {directory}")
+    if args.instance is not None:
+        try:
+            index, count = (int(part) for part in args.instance.split('/'))
+        except ValueError:
+            parser.error(f"--instance 格式应为 编号/实例总数，如 0/2: {args.instance}")
+        if not 0 <= index < count:
+            parser.error(f"--instance 编号应在 0 到 {count - 1} 之间: {args.instance}")
+        if fcntl is None:
+            parser.error("当前平台不支持 fcntl，不能使用 --instance")
+        args.instance = (index, count)
+    if args.engine == "asyncio":
+        if args.overflow not in AsyncPipeline.OVERFLOW_POLICIES:
+            parser.error(f"asyncio 引擎不支持 --overflow {args.overflow}，可选: {', '.join(AsyncPipeline.OVERFLOW_POLICIES)}")
+        if args.reconcile_interval > 0:
+            parser.error("asyncio 引擎暂不支持 --reconcile-interval")
+        if args.max_workers is not None and args.max_workers > args.workers:
+            parser.error("asyncio 引擎的重命名协程数固定，不支持 --max-workers")
+        if args.stable_quiet > 0:
+            parser.error("asyncio 引擎暂不支持 --stable-quiet")
+    return args
+
+def parse_extension_list(extension):
+    """
+    把 --extension 参数拆分为后缀列表
+    
+    Args:
+        extension: 文件后缀，如 "jpg" 或 "jpg,png,gif"
+        
+    Returns:
+        list | None: 后缀列表，含有正则元字符等无法用集合查找的后缀时返回 None
+    """
+    # 拆分规则与 create_pattern_from_extension 保持一致
+    if ',' in extension:
+        extensions = [ext.strip() for ext in extension.split(',')]
+    elif '|' in extension:
+        extensions = [ext.strip() for ext in extension.split('|')]
+    else:
+        extensions = [extension]
+    if all(ext and ext.isascii() and ext.replace('_', '').replace('-', '').isalnum() for ext in extensions):
+        return extensions
+    return None
 
 def create_pattern_from_extension(extension, ignore_case=False):
     """
@@ -633,84 +4737,263 @@ def create_pattern_from_extension(extension, ignore_case=False):
     
     return pattern, flags
 
-def main():
-    """主函数"""
-    # 解析命令行参数
-    args = parse_arguments()
+def log_final_stats(batch_processor, file_buffer, event_handler):
+    """输出最终统计"""
+    final_stats = batch_processor.get_stats()
+    event_stats = event_handler.get_event_stats()
+    buffer_stats = file_buffer.get_stats()
     
-    # 设置日志级别
-    if args.debug:
-        logging.getLogger().setLevel(logging.DEBUG)
-        logger.info("启用调试模式")
+    logger.info(
+        f"最终统计 - 已处理: {final_stats['processed']}, "
+        f"成功: {final_stats['succeeded']}, "
+        f"失败: {final_stats['failed']}, "
+        f"批次: {final_stats['batches']}"
+    )
     
-    # 创建正则表达式模式
-    if args.pattern:
-        # 使用用户直接提供的正则表达式
-        pattern = args.pattern
-        flags = re.IGNORECASE if args.ignore_case else 0
-        logger.info(f"使用自定义正则表达式: {pattern}")
-    else:
-        # 根据文件后缀创建正则表达式
-        pattern, flags = create_pattern_from_extension(args.extension, args.ignore_case)
-        logger.info(f"监控文件后缀: {args.extension}")
+    logger.info(
+        f"缓冲区统计 - 峰值深度: {buffer_stats['peak_buffer_size']}, "
+        f"阻塞: {buffer_stats['blocked']}, "
+        f"丢弃: {buffer_stats['dropped']}"
+    )
+    if buffer_stats['retry_pending'] or buffer_stats['dead_letters']:
+        logger.info(
+            f"重试统计 - 等待重试: {buffer_stats['retry_pending']}, "
+            f"死信: {len(buffer_stats['dead_letters'])}"
+        )
+        for entry in buffer_stats['dead_letters'][-10:]:
+            logger.info(f"死信: {entry['path']} (失败 {entry['attempts']} 次)")
+    if 'spilled' in buffer_stats:
+        logger.info(
+            f"溢出统计 - 剩余: {buffer_stats['spill_depth']}, "
+            f"峰值深度: {buffer_stats['peak_spill_depth']}, "
+            f"已溢出: {buffer_stats['spilled']}, "
+            f"已取回: {buffer_stats['drained']}"
+        )
     
-    if args.ignore_case:
-        logger.info("启用忽略大小写")
+    # 输出事件统计
+    logger.info(
+        f"事件统计 - 创建: {event_stats.get('created', 0)}, "
+        f"移动: {event_stats.get('moved', 0)}, "
+        f"添加到缓冲区: {event_stats.get('added_to_buffer', 0)}"
+    )
     
-    print("=" * 50)
-    print("文件监控重命名脚本 - 修复已编号判断问题")
-    print(f"监控文件模式: {pattern}")
-    print(f"序号位数: {args.digits}")
-    print(f"处理线程数: {args.workers}")
-    print(f"缓冲区大小: {args.buffer_size}")
-    print(f"批处理大小: {args.batch_size}")
-    print(f"批处理超时: {args.batch_timeout}秒")
-    print(f"最大文件名长度: {args.max_filename_length}")
-    print(f"临时目录: {args.temp_dir}")
-    print("按 Ctrl+C 退出")
-    print("=" * 50)
+    dedup_stats = event_handler.get_dedup_stats()
+    logger.info(
+        f"去重统计 - 命中: {dedup_stats['hits']}, "
+        f"未命中: {dedup_stats['misses']}, "
+        f"淘汰: {dedup_stats['evictions']}"
+    )
+    
+    # 输出跳过统计
+    if any(key.startswith('skipped_') for key in event_stats):
+        logger.info(
+            f"跳过统计 - 文件名过长: {event_stats.get('skipped_too_long', 0)}, "
+            f"扩展名不符: {event_stats.get('skipped_wrong_extension', 0)}, "
+            f"已编号: {event_stats.get('skipped_already_numbered', 0)}, "
+            f"隐藏文件: {event_stats.get('skipped_hidden', 0)}"
+        )
+    if 'skipped_other_instance' in event_stats:
+        logger.info(f"多实例统计 - 由其他实例处理: {event_stats['skipped_other_instance']}")
+    if 'skipped_content_duplicate' in event_stats:
+        logger.info(f"内容去重统计 - 已知重复文件: {event_stats['skipped_content_duplicate']}")
+
+def create_trace_recorder(args, handler):
+    """
+    根据命令行参数包装事件处理器，未指定 --record-trace 时原样返回
+    
+    Returns:
+        tuple: (交给 observer 的事件处理器, 事件记录器或 None)
+    """
+    if not args.record_trace:
+        return handler, None
+    metadata = {
+        'extension': args.extension,
+        'pattern': args.pattern,
+        'ignore_case': args.ignore_case,
+        'digits': args.digits,
+        'recursive': args.recursive,
+        'max_filename_length': args.max_filename_length
+    }
+    recorder = EventTraceRecorder(handler, args.record_trace, args.directories, metadata=metadata)
+    logger.info(f"记录事件日志: {args.record_trace}")
+    return recorder, recorder
+
+def start_observer(args, handler):
+    """
+    创建并启动文件监控器，watchdog.observers 在这里才导入
+    
+    Returns:
+        tuple: (observer, 事件记录器或 None)
+    """
+    from watchdog.observers import Observer
+    watch_handler, trace_recorder = create_trace_recorder(args, handler)
+    observer = Observer()
+    for directory in args.directories:
+        observer.schedule(watch_handler, directory, recursive=args.recursive)
+    observer.start()
+    return observer, trace_recorder
+
+def start_recovery(renamer, profiler, on_error):
+    """
+    开始监控后在后台线程中恢复未完成的重命名并初始化计数器
+    
+    期间到达的事件照常进入缓冲区；处理线程第一次用到某个目录时，会等该目录的计数器
+    初始化完成(见 FileRenamer.get_counter)，不会在恢复完成前分配序号
+    
+    Args:
+        renamer: 文件重命名器
+        profiler: 启动耗时统计，None 表示不统计
+        on_error: 初始化失败时的回调，通常用来停止监控
+        
+    Returns:
+        Thread: 后台线程
+    """
+    def run():
+        started = time.perf_counter()
+        try:
+            renamer.recover()
+        except Exception as e:
+            logger.error(f"初始化计数器失败: {e}")
+            on_error()
+            return
+        if profiler is not None:
+            profiler.record("后台初始化计数器", started)
+            profiler.report()
+    
+    thread = Thread(target=run, daemon=True, name="Recovery")
+    thread.start()
+    return thread
+
+def create_backfiller(args, renamer, since=None, file_buffer=None):
+    """根据命令行参数创建存量补编号"""
+    return Backfiller(
+        renamer,
+        args.directories,
+        recursive=args.recursive,
+        order=args.backfill_order,
+        workers=args.backfill_workers,
+        chunk_size=args.backfill_chunk,
+        since=since,
+        file_buffer=file_buffer
+    )
+
+def run_backfill_only(args, renamer):
+    """只补编号已存在的文件，不启动监控"""
+    graceful_exiter = GracefulExiter()
+    renamer.recover()
+    backfiller = create_backfiller(args, renamer)
+    backfiller.start()
     
+    # 主线程保持可响应信号，收到信号后处理完当前批次再退出
+    while backfiller.backfill_thread.is_alive():
+        backfiller.join(0.5)
+        if graceful_exiter.shutdown:
+            backfiller.stop()
+
+def run_thread_engine(args, renamer, profiler):
+    """线程引擎：监控、去重清理、批处理和统计各自运行在独立线程中"""
     # 初始化组件
     graceful_exiter = GracefulExiter()
     
-    # 创建文件缓冲区和重命名器
+    # 监控多个目录或递归监控时按目录分片，不同目录的文件由不同线程处理
+    sharded = args.recursive or len(args.directories) > 1
+    
+    # 创建文件缓冲区
     file_buffer = FileBuffer(
         max_size=args.buffer_size,
         batch_size=args.batch_size,
-        batch_timeout=args.batch_timeout
-    )
-    
-    renamer = FileRenamer(
-        pattern=pattern, 
-        digit_count=args.digits, 
-        flags=flags,
-        temp_dir=args.temp_dir,
-        max_filename_length=args.max_filename_length
+        batch_timeout=args.batch_timeout,
+        num_shards=args.workers if sharded else 1,
+        overflow=args.overflow,
+        spill_file=args.spill_file,
+        block_timeout=args.block_timeout,
+        max_retries=args.max_retries,
+        retry_delay=args.retry_delay,
+        retry_max_delay=args.retry_max_delay
     )
     
     # 创建监控处理器
-    event_handler = FileMonitorHandler(file_buffer, renamer)
+    event_handler = FileMonitorHandler(
+        file_buffer, 
+        renamer, 
+        dedup_ttl=args.dedup_ttl,
+        dedup_max_entries=args.dedup_max_entries
+    )
     event_handler.start_event_cleaner()
     
+    # 创建文件稳定性跟踪
+    stability = None
+    if args.stable_quiet > 0:
+        stability = StabilityTracker(
+            event_handler.add_to_buffer,
+            quiet_period=args.stable_quiet,
+            max_pending=args.stable_max_pending
+        )
+        stability.start()
+        event_handler.stability = stability
+        # 交给缓冲区的文件都已稳定，处理线程中不再重试等待
+        renamer.access_attempts = 1
+    profiler.mark("创建组件")
+    
+    # 缓冲区和事件处理器就绪后立即开始监控，其余组件和计数器初始化都在之后进行
+    observer, trace_recorder = start_observer(args, event_handler)
+    profiler.mark("开始监控")
+    recovery = start_recovery(
+        renamer, profiler if args.startup_profile else None, lambda: setattr(graceful_exiter, 'shutdown', True)
+    )
+    
     # 创建批处理器
     batch_processor = BatchFileProcessor(
         file_buffer, 
         renamer, 
-        num_workers=args.workers
+        num_workers=args.workers,
+        max_workers=args.max_workers,
+        idle_timeout=args.worker_idle_timeout
     )
     batch_processor.start()
     
+    # 创建对账扫描器
+    reconciler = None
+    if args.reconcile_interval > 0:
+        reconciler = ReconcileScanner(
+            file_buffer,
+            renamer,
+            args.directories,
+            recursive=args.recursive,
+            budget=args.reconcile_budget,
+            min_interval=min(1.0, args.reconcile_interval),
+            max_interval=args.reconcile_interval
+        )
+    
     # 创建统计报告器
     stats_reporter = StatsReporter(file_buffer, batch_processor, event_handler)
     stats_reporter.start()
+    register_pipeline_metrics(file_buffer, batch_processor, event_handler)
     
-    # 创建文件监控器
-    observer = Observer()
-    observer.schedule(event_handler, '.', recursive=False)
-    observer.start()
+    # 创建自适应批处理控制器
+    batch_controller = None
+    if args.adaptive_batch:
+        batch_controller = BatchController(
+            file_buffer,
+            batch_processor,
+            target_latency=args.target_latency,
+            max_batch_size=args.max_batch_size,
+            max_timeout=args.batch_timeout
+        )
+        batch_controller.start()
+    
+    # 监控启动后再开始对账，避免漏掉两者之间的文件
+    if reconciler is not None:
+        reconciler.start()
+    
+    # 同理，监控启动后才开始补编号，之后变更的文件交给事件处理
+    backfiller = None
+    if args.backfill:
+        backfiller = create_backfiller(args, renamer, since=time.time(), file_buffer=file_buffer)
+        backfiller.start()
     
     try:
-        logger.info("文件监控已启动，正在监控当前目录...")
+        logger.info(f"文件监控已启动，正在监控: {', '.join(args.directories)}")
         
         # 主循环
         while not graceful_exiter.shutdown:
@@ -724,53 +5007,238 @@ def main():
         event_handler.should_stop = True
         batch_processor.should_stop = True
         stats_reporter.should_stop = True
+        if batch_controller is not None:
+            batch_controller.stop()
+        if stability is not None:
+            stability.stop()
+        if reconciler is not None:
+            reconciler.stop()
+        if backfiller is not None:
+            backfiller.stop()
+            backfiller.join()
+        file_buffer.close()
         observer.stop()
         observer.join()
+        if trace_recorder is not None:
+            trace_recorder.close()
+        recovery.join()
+        
+        # 等处理线程完成手头的批次，之后才能清理临时目录和关闭日志
+        batch_processor.join()
         
-        # 清理临时目录
-        if renamer.temp_dir.exists():
-            try:
-                # 先将临时目录中的文件移回原位置
-                for temp_file in renamer.temp_dir.iterdir():
-                    if temp_file.is_file():
-                        try:
-                            original_path = Path.cwd() / temp_file.name
-                            temp_file.rename(original_path)
-                            logger.info(f"恢复文件: {temp_file.name}")
-                        except Exception as e:
-                            logger.warning(f"恢复文件 {temp_file.name} 失败: {e}")
-                
-                shutil.rmtree(renamer.temp_dir)
-                logger.info(f"已清理临时目录: {renamer.temp_dir}")
-            except Exception as e:
-                logger.warning(f"清理临时目录时出错: {e}")
-                
         # 输出最终统计
-        final_stats = batch_processor.get_stats()
-        event_stats = event_handler.get_event_stats()
+        log_final_stats(batch_processor, file_buffer, event_handler)
         
-        logger.info(
-            f"最终统计 - 已处理: {final_stats['processed']}, "
-            f"成功: {final_stats['succeeded']}, "
-            f"失败: {final_stats['failed']}, "
-            f"批次: {final_stats['batches']}"
+        if reconciler is not None:
+            reconcile_stats = reconciler.get_stats()
+            logger.info(
+                f"对账统计 - 扫描轮数: {reconcile_stats['passes']}, "
+                f"检查目录项: {reconcile_stats['scanned']}, "
+                f"补处理: {reconcile_stats['found']}"
+            )
+
+def run_asyncio_engine(args, renamer, profiler):
+    """asyncio 引擎：除 watchdog 外所有组件都是同一个事件循环中的协程"""
+    import asyncio
+    pipeline = AsyncPipeline(
+        renamer,
+        buffer_size=args.buffer_size,
+        batch_size=args.batch_size,
+        batch_timeout=args.batch_timeout,
+        num_workers=args.workers,
+        dedup_ttl=args.dedup_ttl,
+        dedup_max_entries=args.dedup_max_entries,
+        max_retries=args.max_retries,
+        retry_delay=args.retry_delay,
+        retry_max_delay=args.retry_max_delay,
+        overflow=args.overflow,
+        block_timeout=args.block_timeout
+    )
+    register_pipeline_metrics(pipeline, pipeline, pipeline.event_handler)
+    
+    # 控制器在独立线程中运行，调整的参数从下一个批次开始生效
+    batch_controller = None
+    if args.adaptive_batch:
+        batch_controller = BatchController(
+            pipeline,
+            pipeline,
+            target_latency=args.target_latency,
+            max_batch_size=args.max_batch_size,
+            max_timeout=args.batch_timeout
         )
+    
+    async def run():
+        loop = asyncio.get_running_loop()
+        stop_event = asyncio.Event()
         
-        # 输出事件统计
-        logger.info(
-            f"事件统计 - 创建: {event_stats.get('created', 0)}, "
-            f"移动: {event_stats.get('moved', 0)}, "
-            f"添加到缓冲区: {event_stats.get('added_to_buffer', 0)}"
+        def request_stop():
+            logger.info("接收到退出信号，正在关闭...")
+            stop_event.set()
+        
+        # 信号直接唤醒事件循环，不需要轮询
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, request_stop)
+            except NotImplementedError:
+                signal.signal(sig, lambda signum, frame: loop.call_soon_threadsafe(request_stop))
+        
+        await pipeline.start()
+        profiler.mark("创建组件")
+        observer, trace_recorder = start_observer(args, pipeline.event_handler)
+        profiler.mark("开始监控")
+        recovery = start_recovery(
+            renamer, profiler if args.startup_profile else None, lambda: loop.call_soon_threadsafe(request_stop)
         )
+        if batch_controller is not None:
+            batch_controller.start()
+        logger.info(f"文件监控已启动(asyncio 引擎)，正在监控: {', '.join(args.directories)}")
         
-        # 输出跳过统计
-        if any(key.startswith('skipped_') for key in event_stats):
-            logger.info(
-                f"跳过统计 - 文件名过长: {event_stats.get('skipped_too_long', 0)}, "
-                f"扩展名不符: {event_stats.get('skipped_wrong_extension', 0)}, "
-                f"已编号: {event_stats.get('skipped_already_numbered', 0)}, "
-                f"隐藏文件: {event_stats.get('skipped_hidden', 0)}"
-            )
+        # 补编号在独立线程中运行，监控启动后才开始
+        backfiller = None
+        if args.backfill:
+            backfiller = create_backfiller(args, renamer, since=time.time(), file_buffer=pipeline)
+            backfiller.start()
+        
+        try:
+            await stop_event.wait()
+        finally:
+            logger.info("正在停止监控...")
+            observer.stop()
+            await loop.run_in_executor(None, observer.join)
+            if trace_recorder is not None:
+                trace_recorder.close()
+            await loop.run_in_executor(None, recovery.join)
+            if backfiller is not None:
+                backfiller.stop()
+                await loop.run_in_executor(None, backfiller.join)
+            if batch_controller is not None:
+                batch_controller.stop()
+            await pipeline.stop()
+    
+    asyncio.run(run())
+    
+    # 输出最终统计
+    log_final_stats(pipeline, pipeline, pipeline.event_handler)
+
+def main():
+    """主函数"""
+    profiler = StartupProfiler()
+    profiler.mark("导入模块")
+    
+    # 解析命令行参数
+    args = parse_arguments()
+    
+    # 设置日志级别
+    setup_logging(args.debug)
+    if args.debug:
+        logger.info("启用调试模式")
+    profiler.mark("解析参数")
+    
+    # 创建正则表达式模式
+    if args.pattern:
+        # 使用用户直接提供的正则表达式
+        pattern = args.pattern
+        extensions = None
+        flags = re.IGNORECASE if args.ignore_case else 0
+        logger.info(f"使用自定义正则表达式: {pattern}")
+    else:
+        # 根据文件后缀创建正则表达式
+        pattern, flags = create_pattern_from_extension(args.extension, args.ignore_case)
+        extensions = parse_extension_list(args.extension)
+        logger.info(f"监控文件后缀: {args.extension}")
+    
+    if args.ignore_case:
+        logger.info("启用忽略大小写")
+    
+    print("=" * 50)
+    print("文件监控重命名脚本 - 修复已编号判断问题")
+    print(f"监控目录: {', '.join(args.directories)}{' (递归)' if args.recursive else ''}")
+    print(f"监控文件模式: {pattern}")
+    print(f"序号位数: {args.digits}")
+    print(f"运行引擎: {args.engine}")
+    print(f"处理线程数: {args.workers}{f' ~ {args.max_workers}' if args.max_workers and args.max_workers > args.workers else ''}")
+    print(f"重命名执行方式: {args.rename_executor}")
+    print(f"缓冲区大小: {args.buffer_size}")
+    print(f"溢出策略: {args.overflow}")
+    print(f"批处理大小: {args.batch_size}")
+    print(f"批处理超时: {args.batch_timeout}秒")
+    if args.adaptive_batch:
+        print(f"自适应批处理: p99 目标 {args.target_latency}秒, 批大小上限 {args.max_batch_size}")
+    print(f"最大文件名长度: {args.max_filename_length}")
+    print(f"临时目录: {'不使用(直接重命名)' if args.direct_rename else args.temp_dir}")
+    if args.instance is not None:
+        print(f"多实例: 第 {args.instance[0]} 个 / 共 {args.instance[1]} 个, 每次租用 {args.lease_size} 个序号")
+    else:
+        print(f"序号日志: {args.journal_file or '禁用'}")
+    print(f"意图日志: {args.intent_file or '禁用'}")
+    print(f"内容去重: {args.content_dedup}")
+    if args.record_trace:
+        print(f"事件日志: {args.record_trace}")
+    if args.backfill or args.backfill_only:
+        print(f"存量补编号: 按 {args.backfill_order} 排序, {args.backfill_workers} 个线程{', 完成后退出' if args.backfill_only else ''}")
+    print("按 Ctrl+C 退出")
+    print("=" * 50)
+    
+    renamer = FileRenamer(
+        pattern=pattern, 
+        digit_count=args.digits, 
+        flags=flags,
+        temp_dir=args.temp_dir,
+        max_filename_length=args.max_filename_length,
+        journal_file=args.journal_file,
+        checkpoint_interval=args.checkpoint_interval,
+        direct_rename=args.direct_rename,
+        directories=args.directories,
+        intent_file=args.intent_file,
+        extensions=extensions,
+        instance=args.instance,
+        lease_file=args.lease_file,
+        lease_size=args.lease_size
+    )
+    
+    # 上次未完成的重命名和计数器初始化在开始监控后于后台进行，见 start_recovery
+    if args.rename_executor == "pool":
+        renamer.executor = RenameExecutor(renamer, max_workers=args.rename_pool_size)
+    
+    if args.content_dedup != "off":
+        renamer.deduplicator = ContentDeduplicator(
+            renamer,
+            action=args.content_dedup,
+            duplicates_dir=args.duplicates_dir,
+            pool_size=args.hash_workers
+        )
+    
+    # 指标接口和快照文件
+    metrics_exporter = MetricsExporter(
+        METRICS,
+        port=args.metrics_port,
+        snapshot_file=args.metrics_file,
+        snapshot_interval=args.metrics_interval
+    )
+    metrics_exporter.start()
+    
+    try:
+        if args.backfill_only:
+            run_backfill_only(args, renamer)
+        elif args.engine == "asyncio":
+            run_asyncio_engine(args, renamer, profiler)
+        else:
+            run_thread_engine(args, renamer, profiler)
+    finally:
+        # 等待并行重命名完成
+        if renamer.executor is not None:
+            renamer.executor.shutdown()
+        if renamer.deduplicator is not None:
+            renamer.deduplicator.shutdown()
+        
+        # 清理临时目录
+        renamer.cleanup_temp_dirs()
+        
+        # 写入最终计数器
+        renamer.close()
+        
+        # 停止指标导出，写入最后一次快照
+        metrics_exporter.stop()
         
         logger.info("监控已停止")
 
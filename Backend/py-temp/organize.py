@@ -1,38 +1,453 @@
 import os
-import shutil
 import re
+import time
+import errno
+import shutil
+import logging
+import argparse
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# 正则表达式：匹配文件名开头的题号（字母+数字组合，后跟空格）
+# 例如：P2397、B1234、CF1039D、ABC1234E 等
+PROBLEM_ID_PATTERN = re.compile(r'^([A-Za-z0-9]+)\s')
+
+
+def problem_id_of(filename):
+    """
+    提取文件名开头的题号
+
+    Args:
+        filename: 文件名
+
+    Returns:
+        str | None: 题号（保留原始大小写），不匹配题号格式时返回 None
+    """
+    match = PROBLEM_ID_PATTERN.match(filename)
+    return match.group(1) if match else None
+
+
+def move_file(source_path, target_path):
+    """同一文件系统内直接 rename，跨文件系统(目标目录是挂载点)时退回 shutil.move"""
+    try:
+        os.rename(source_path, target_path)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(source_path, target_path)
+
+
+def make_target_dir(directory, problem_id):
+    """
+    创建题号目录
+
+    Returns:
+        tuple: (是否新建了目录, 错误信息或 None)
+    """
+    target_dir = os.path.join(directory, problem_id)
+    try:
+        os.mkdir(target_dir)
+        return True, None
+    except FileExistsError:
+        if os.path.isdir(target_dir):
+            return False, None
+        return False, f"{problem_id} exists and is not a directory"
+    except OSError as e:
+        return False, str(e)
+
+
+class Organizer:
+    """按题号整理文件 - 一次扫描、内存中分组、每个目标目录只创建一次、分批并行移动"""
+
+    def __init__(self, directory='.', workers=8, batch_size=1000, dry_run=False):
+        """
+        初始化整理器
+
+        Args:
+            directory: 要整理的目录
+            workers: 并行移动的线程数
+            batch_size: 每个任务移动的文件数
+            dry_run: 只输出计划，不创建目录也不移动文件
+        """
+        self.directory = os.path.abspath(directory)
+        self.workers = max(1, workers)
+        self.batch_size = max(1, batch_size)
+        self.dry_run = dry_run
+
+    def scan(self):
+        """
+        扫描目录一次，按题号分组
+
+        Returns:
+            tuple: ({题号: [文件名]}, [不匹配题号格式的文件名], 跳过的目录和隐藏文件数)
+        """
+        groups = {}
+        unmatched = []
+        ignored = 0
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                # 跳过目录和隐藏文件，DirEntry 自带类型信息，无需逐个 stat
+                if entry.name.startswith('.') or entry.is_dir():
+                    ignored += 1
+                    continue
+
+                # 检查文件名是否以题号开头（题号后必须有空格）
+                problem_id = problem_id_of(entry.name)
+                if problem_id is None:
+                    # 不匹配题号格式的文件保留原位置
+                    unmatched.append(entry.name)
+                else:
+                    groups.setdefault(problem_id, []).append(entry.name)
+        return groups, unmatched, ignored
+
+    def run(self):
+        """
+        执行整理(或 dry-run 时只生成计划)
+
+        Returns:
+            dict: 汇总报告，包含分组计划 plan 和失败列表 errors
+        """
+        started = time.perf_counter()
+        groups, unmatched, ignored = self.scan()
+        scanned = time.perf_counter()
+
+        report = {
+            'directory': self.directory,
+            'dry_run': self.dry_run,
+            'groups': len(groups),
+            'matched': sum(len(filenames) for filenames in groups.values()),
+            'unmatched': len(unmatched),
+            'ignored': ignored,
+            'created_dirs': 0,
+            'moved': 0,
+            'failed': 0,
+            'plan': groups,
+            'unmatched_files': unmatched,
+            'errors': [],
+        }
+
+        if not self.dry_run and groups:
+            self._execute(groups, report)
+
+        finished = time.perf_counter()
+        report['scan_seconds'] = scanned - started
+        report['total_seconds'] = finished - started
+        return report
+
+    def _execute(self, groups, report):
+        """创建目标目录后把移动任务分批提交到线程池"""
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            # 每个题号只创建一次目录，失败的分组整组跳过
+            batches = []
+            made = pool.map(lambda problem_id: make_target_dir(self.directory, problem_id), groups)
+            for (problem_id, filenames), (created, error) in zip(groups.items(), made):
+                if error is not None:
+                    report['failed'] += len(filenames)
+                    report['errors'].extend((filename, error) for filename in filenames)
+                    continue
+                if created:
+                    report['created_dirs'] += 1
+                for i in range(0, len(filenames), self.batch_size):
+                    batches.append((problem_id, filenames[i:i + self.batch_size]))
+
+            for moved, errors in pool.map(self._move_batch, batches):
+                report['moved'] += moved
+                report['failed'] += len(errors)
+                report['errors'].extend(errors)
+
+    def _move_batch(self, batch):
+        """
+        移动一批属于同一题号的文件
+
+        Returns:
+            tuple: (成功数, [(文件名, 错误信息)])
+        """
+        problem_id, filenames = batch
+        target_dir = os.path.join(self.directory, problem_id)
+        moved = 0
+        errors = []
+        for filename in filenames:
+            try:
+                move_file(os.path.join(self.directory, filename), os.path.join(target_dir, filename))
+                moved += 1
+            except OSError as e:
+                errors.append((filename, str(e)))
+        return moved, errors
+
+
+_organize_action = None  # 整理动作类，第一次进入监控模式时定义，见 organize_action_class
+
+
+def organize_action_class():
+    """
+    定义并注册按题号整理的批处理动作
+
+    BatchAction 接口和监控流水线来自 main.py(依赖 watchdog)，只在 --watch 时导入，
+    单次整理只依赖标准库
+
+    Returns:
+        type: OrganizeAction 类
+    """
+    global _organize_action
+    if _organize_action is not None:
+        return _organize_action
+    from main import BatchAction, register_action
+
+    @register_action
+    class OrganizeAction(BatchAction):
+        """按题号整理的批处理动作 - 代替 main.FileRenamer 交给监控流水线使用"""
+
+        name = "organize"
+
+        def __init__(self, directory):
+            """
+            初始化整理动作
+
+            Args:
+                directory: 被监控的目录，只整理直接位于其中的文件
+            """
+            self.directory = os.path.abspath(directory)
+            self.known_dirs = set()  # 已确认存在的题号目录
+            self.lock = Lock()
+            self.stats = {
+                'created_dirs': 0,
+                'moved': 0,
+                'failed': 0
+            }
+
+        def filter(self, file_path):
+            """
+            判断文件是否需要整理
+
+            Returns:
+                str | None: None 表示需要整理，否则为跳过原因：temp / hidden / other
+            """
+            # 题号目录中的文件(例如移入事件的目标)不再处理
+            if os.path.abspath(file_path.parent) != self.directory:
+                return 'temp'
+            if file_path.name.startswith('.'):
+                return 'hidden'
+            if problem_id_of(file_path.name) is None:
+                return 'other'
+            return None
+
+        def process_batch(self, file_paths, on_complete=None):
+            """
+            整理一批文件：按题号分组，每个目录只检查一次
+
+            Args:
+                file_paths: 文件路径列表
+                on_complete: 每个文件处理完成时的回调 on_complete(文件路径, 成功/失败)
+
+            Returns:
+                dict: 处理结果 {文件路径: 成功/失败}
+            """
+            groups = {}
+            for file_path in file_paths:
+                groups.setdefault(problem_id_of(file_path.name), []).append(file_path)
+
+            results = {}
+            for problem_id, group in groups.items():
+                error = self._ensure_dir(problem_id)
+                target_dir = os.path.join(self.directory, problem_id)
+                for file_path in group:
+                    success = error is None and self._move(file_path, os.path.join(target_dir, file_path.name))
+                    if error is not None:
+                        logger.warning(f"无法整理 {file_path.name}: {error}")
+                    results[file_path] = success
+                    if on_complete is not None:
+                        on_complete(file_path, success)
+
+            succeeded = sum(results.values())
+            with self.lock:
+                self.stats['moved'] += succeeded
+                self.stats['failed'] += len(results) - succeeded
+            return results
+
+        def _ensure_dir(self, problem_id):
+            """创建题号目录(每个题号只创建一次)，返回错误信息或 None"""
+            if problem_id in self.known_dirs:
+                return None
+            created, error = make_target_dir(self.directory, problem_id)
+            if error is None:
+                with self.lock:
+                    self.known_dirs.add(problem_id)
+                    self.stats['created_dirs'] += created
+            return error
+
+        def _move(self, file_path, target_path):
+            """移动单个文件，文件已被移走(例如启动时的整理先处理了它)时视为成功"""
+            try:
+                move_file(file_path, target_path)
+                logger.info(f"整理: {file_path.name} -> {os.path.basename(os.path.dirname(target_path))}/")
+                return True
+            except FileNotFoundError:
+                if os.path.exists(target_path):
+                    return True
+                logger.warning(f"文件已不存在: {file_path.name}")
+                return False
+            except OSError as e:
+                logger.warning(f"无法整理 {file_path.name}: {e}")
+                return False
+
+        def get_stats(self):
+            """获取整理统计"""
+            with self.lock:
+                return self.stats.copy()
+
+    _organize_action = OrganizeAction
+    return OrganizeAction
+
+
+def run_watch(args):
+    """持续监控目录，新文件到达时整理到题号目录，复用 main.py 的监控流水线"""
+    from watchdog.observers import Observer
+    from main import (
+        create_action, setup_logging,
+        FileBuffer, FileMonitorHandler, BatchFileProcessor, StatsReporter, GracefulExiter, log_final_stats
+    )
+    setup_logging()
+    graceful_exiter = GracefulExiter()
+    action = create_action(organize_action_class().name, args.directory)
+    action.recover()
+
+    file_buffer = FileBuffer(
+        max_size=args.buffer_size,
+        batch_size=args.batch_size,
+        batch_timeout=args.batch_timeout
+    )
+    event_handler = FileMonitorHandler(file_buffer, action)
+    event_handler.start_event_cleaner()
+    batch_processor = BatchFileProcessor(file_buffer, action, num_workers=args.workers)
+    batch_processor.start()
+    stats_reporter = StatsReporter(file_buffer, batch_processor, event_handler)
+    stats_reporter.start()
+
+    observer = Observer()
+    observer.schedule(event_handler, args.directory, recursive=False)
+    observer.start()
+    logger.info(f"整理监控已启动，正在监控: {args.directory}")
+
+    try:
+        # 监控启动后整理已有文件，代替定时任务的全量扫描
+        report = Organizer(args.directory, workers=args.workers).run()
+        logger.info(
+            f"已有文件整理完成 - 题号: {report['groups']}, 移动: {report['moved']}, 失败: {report['failed']}, "
+            f"新建目录: {report['created_dirs']}, 耗时: {report['total_seconds']:.2f}秒"
+        )
+
+        while not graceful_exiter.shutdown:
+            time.sleep(0.5)
+    except Exception as e:
+        logger.error(f"发生错误: {e}")
+    finally:
+        logger.info("正在停止监控...")
+        event_handler.should_stop = True
+        batch_processor.should_stop = True
+        stats_reporter.should_stop = True
+        file_buffer.close()
+        observer.stop()
+        observer.join()
+        batch_processor.join()
+
+        log_final_stats(batch_processor, file_buffer, event_handler)
+        action.close()
+        action_stats = action.get_stats()
+        logger.info(
+            f"整理统计 - 移动: {action_stats['moved']}, 失败: {action_stats['failed']}, "
+            f"新建目录: {action_stats['created_dirs']}"
+        )
+
+
+def print_plan(report, verbose=False):
+    """输出 dry-run 计划：每个题号一行，verbose 时列出每个文件"""
+    for problem_id in sorted(report['plan']):
+        filenames = report['plan'][problem_id]
+        exists = os.path.isdir(os.path.join(report['directory'], problem_id))
+        print(f"{problem_id}/ <- {len(filenames)} file(s){'' if exists else ' (new)'}")
+        if verbose:
+            for filename in sorted(filenames):
+                print(f"    {filename}")
+
+
+def print_report(report, verbose=False):
+    """输出汇总报告，代替逐个文件的输出"""
+    if report['dry_run']:
+        print_plan(report, verbose)
+        print()
+    elif verbose:
+        for problem_id in sorted(report['plan']):
+            print(f"{problem_id}/ <- {len(report['plan'][problem_id])} file(s)")
+
+    if verbose and report['unmatched_files']:
+        print("Skipped (non-matching):")
+        for filename in sorted(report['unmatched_files']):
+            print(f"    {filename}")
+
+    total = report['total_seconds']
+    print(f"Directory: {report['directory']}{' (dry run)' if report['dry_run'] else ''}")
+    print(f"Problem IDs: {report['groups']}, matched files: {report['matched']}")
+    print(f"Skipped: {report['unmatched']} non-matching, {report['ignored']} directories/hidden")
+    if not report['dry_run']:
+        print(f"Created directories: {report['created_dirs']}")
+        print(f"Moved: {report['moved']}, failed: {report['failed']}")
+        for filename, error in report['errors'][:20]:
+            print(f"    {filename}: {error}")
+        if len(report['errors']) > 20:
+            print(f"    ... {len(report['errors']) - 20} more")
+    rate = report['moved'] / total if total > 0 and report['moved'] else 0
+    print(f"Time: {total:.2f}s (scan {report['scan_seconds']:.2f}s){f', {rate:.0f} files/s' if rate else ''}")
+
+
+def organize_by_problem_id(directory=None, workers=8, batch_size=1000, dry_run=False):
+    """
+    按题号整理目录中的文件
+
+    Args:
+        directory: 要整理的目录，默认是当前目录
+        workers: 并行移动的线程数
+        batch_size: 每个任务移动的文件数
+        dry_run: 只生成计划，不移动文件
+
+    Returns:
+        dict: 汇总报告
+    """
+    organizer = Organizer(directory or os.getcwd(), workers=workers, batch_size=batch_size, dry_run=dry_run)
+    return organizer.run()
+
+
+def parse_arguments():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description="按题号整理文件")
+    parser.add_argument("directory", nargs="?", default=".", help="要整理的目录，默认是当前目录")
+    parser.add_argument("-n", "--dry-run", action="store_true", help="只输出整理计划，不创建目录也不移动文件")
+    parser.add_argument("-w", "--workers", type=int, default=8, help="并行移动的线程数，默认是 8")
+    parser.add_argument(
+        "--batch-size", type=int, default=None,
+        help="每个任务移动的文件数，监控模式下为批处理大小，默认是 1000(监控模式下是 10)"
+    )
+    parser.add_argument("--watch", action="store_true", help="整理已有文件后持续监控目录，新文件到达时立即整理")
+    parser.add_argument("--batch-timeout", type=float, default=0.5, help="监控模式的批处理超时时间(秒)，默认是 0.5")
+    parser.add_argument("--buffer-size", type=int, default=1000, help="监控模式的缓冲区大小，默认是 1000")
+    parser.add_argument("-v", "--verbose", action="store_true", help="列出每个文件")
+    args = parser.parse_args()
+    if not os.path.isdir(args.directory):
+        parser.error(f"目录不存在: {args.directory}")
+    if args.watch and args.dry_run:
+        parser.error("--watch 不支持 --dry-run")
+    if args.batch_size is None:
+        args.batch_size = 10 if args.watch else 1000
+    return args
 
-def organize_by_problem_id():
-    current_dir = os.getcwd()
-    # 正则表达式：匹配文件名开头的题号（字母+数字组合，后跟空格）
-    # 例如：P2397、B1234、CF1039D、ABC1234E 等
-    problem_id_pattern = r'^([A-Za-z0-9]+)\s'
-    
-    for filename in os.listdir(current_dir):
-        # 跳过目录和隐藏文件
-        if os.path.isdir(os.path.join(current_dir, filename)) or filename.startswith('.'):
-            continue
-            
-        # 检查文件名是否以题号开头（题号后必须有空格）
-        match = re.match(problem_id_pattern, filename)
-        if match:
-            problem_id = match.group(1)  # 提取题号（保留原始大小写）
-            target_dir = os.path.join(current_dir, problem_id)
-            
-            # 创建目标文件夹
-            os.makedirs(target_dir, exist_ok=True)
-            
-            # 移动文件
-            source_path = os.path.join(current_dir, filename)
-            target_path = os.path.join(target_dir, filename)
-            
-            if source_path != target_path:
-                shutil.move(source_path, target_path)
-                print(f"Moved: {filename} -> {problem_id}/{filename}")
-        else:
-            # 不匹配题号格式的文件保留原位置
-            print(f"Skipped (non-matching): {filename}")
 
 if __name__ == "__main__":
-    organize_by_problem_id()
-    print("\nOrganization completed! (Supported formats: PXXXX, BXXXX, CF1039D, etc.)")
\ No newline at end of file
+    args = parse_arguments()
+    if args.watch:
+        run_watch(args)
+    else:
+        report = organize_by_problem_id(args.directory, args.workers, args.batch_size, args.dry_run)
+        print_report(report, args.verbose)
+        if not args.dry_run:
+            print("\nOrganization completed! (Supported formats: PXXXX, BXXXX, CF1039D, etc.)")